@@ -22,8 +22,14 @@
 #    WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE
 
 import can
+import heapq
 import os
-import RPi.GPIO as GPIO
+import struct
+import sys
+import threading
+import time
+import traceback
+from collections import namedtuple
 
 # CBUS opcodes
 OPC_ACK = 0x00     #  General affirmative acknowledge
@@ -166,19 +172,36 @@ CBUS_ID = 0x2FF           # value is 0 to 2047
 CBUS_MAJOR_PRIORITY = 0   # value is 0 (max) to 2 (3 is not allowed)
 CBUS_MINOR_PRIORITY = 0   # value is 0 (max) to 3
 bus = 0
+GPIO = 0                  # RPi.GPIO module, imported by setup or by the first LED / button call (None if not available)
+
+# *** ERRORS ***
+# Exception raised when a node answers a configuration request with OPC_CMDERR
+class CBUSCommandError (Exception):
+    def __init__ (self, node_number, error):
+        Exception.__init__ (self, 'Node %d reported CBUS error %d' % (node_number, error))
+        self.node_number = node_number
+        self.error = error
 
 # *** MODULE CONFIGURATION ***
-# Configure the RPi GPIO and CAN adapter
-def setup ():
-    global bus
-    bus = can.interface.Bus (channel = 'can0', bustype = 'socketcan')
-    GPIO.setmode (GPIO.BCM)   #  Use BCM processor pin numbering (GPIOxx)
-    GPIO.setwarnings(False)
-    GPIO.setup (PUSH_BUTTON, GPIO.IN)
-    GPIO.setup (RED_LED, GPIO.OUT)
-    GPIO.setup (YELLOW_LED, GPIO.OUT)
-    GPIO.setup (GREEN_LED, GPIO.OUT)
-    
+# Open the CAN adapter on the default interface (see CBUSInterface) and configure the CANPiCAP GPIO
+# channel, bustype : python-can channel and interface, for example ('can0', 'socketcan'), ('vcan0', 'socketcan'),
+# ('/dev/ttyACM0', 'slcan') or ('test', 'virtual'). Other python-can parameters (bitrate, ...) are given in config
+# If bustype is None, python-can reads the channel and interface from its configuration (~/.canrc, CAN_INTERFACE, ...)
+# bus : an already opened python-can bus (BusABC) to use instead of opening a channel
+# canpicap : True to configure the CANPiCAP LEDs and button, False to never use them (headless computer),
+# None to use them only when RPi.GPIO is installed
+def setup (channel = 'can0', bustype = 'socketcan', bus = None, canpicap = None, **config):
+    global GPIO
+    if bus == None:
+        defaultInterface.open (channel, bustype, **config)
+    else:
+        defaultInterface.bus = bus
+    globals()['bus'] = defaultInterface.bus     # Module variable bus is hidden by the parameter
+    if canpicap == False:
+        GPIO = None
+    elif _loadGPIO() == None and canpicap == True:
+        raise ImportError ('RPi.GPIO is needed to use the CANPiCAP LEDs and button')
+
 # Activate can0 socket (sudo is allowed like this on RPi)
 # This function should return 0 when can0 adapter is created successfully
 # can0 socket an also be activated automatically when RPi is starting :
@@ -197,255 +220,973 @@ def activateSocketCAN ():
     return os.system ('sudo ip link set can0 up type can bitrate 125000')
     
 # *** CANPICAP LED AND BUTTON CONTROL ***
+# RPi.GPIO is only imported when the LEDs or the button are used, so pyCBUS can be used (and starts faster)
+# on computers without CANPiCAP. On these computers, the LED functions do nothing and S1 is never depressed
+def _loadGPIO ():
+    global GPIO
+    if GPIO != 0:
+        return GPIO
+    try:
+        import RPi.GPIO
+    except (ImportError, RuntimeError):    # RuntimeError : RPi.GPIO installed on a computer which is not a RPi
+        GPIO = None
+        return None
+    RPi.GPIO.setmode (RPi.GPIO.BCM)   #  Use BCM processor pin numbering (GPIOxx)
+    RPi.GPIO.setwarnings(False)
+    RPi.GPIO.setup (PUSH_BUTTON, RPi.GPIO.IN)
+    RPi.GPIO.setup (RED_LED, RPi.GPIO.OUT)
+    RPi.GPIO.setup (YELLOW_LED, RPi.GPIO.OUT)
+    RPi.GPIO.setup (GREEN_LED, RPi.GPIO.OUT)
+    GPIO = RPi.GPIO
+    return GPIO
+
 # Control of CANPiCAP red LED D4
 def setRedLED (state):
-    GPIO.output (RED_LED, state)
+    if _loadGPIO() != None:
+        GPIO.output (RED_LED, state)
     
 # Control of CANPiCAP yellow LED D3
 def setYellowLED (state):
-    GPIO.output (YELLOW_LED, state)
+    if _loadGPIO() != None:
+        GPIO.output (YELLOW_LED, state)
     
 # Control of CANPiCAP green LED D5
 def setGreenLED (state):
-    GPIO.output (GREEN_LED, state)
+    if _loadGPIO() != None:
+        GPIO.output (GREEN_LED, state)
 
 # Return state of S1 pushbutton
 def isS1Depressed ():
+    if _loadGPIO() == None:
+        return False
     if GPIO.input (PUSH_BUTTON) == False:
         return True;
     else:
         return False;
 
-# Set CAN identifier used in CBUS messages
-def setCBUS_ID (can_id):
-    global CBUS_ID
-    CBUS_ID=can_id+(CBUS_MAJOR_PRIORITY<<9)+(CBUS_MINOR_PRIORITY<<7)
-
-# Get next CBUS message in reception queue
-# Function is non blocking and returns None if no CAN message has been received
-def getNextCBUSMessage ():
-    msg = bus.recv (0)    # 0 : Make bus.recv non blocking
-    return msg
-
 # Utility function to display CBUS message dump from a Python-CAN Msg
 def dumpCBUSMessage (msg):
     if msg == None:
         return
     print ('CBUS ID:', msg.arbitration_id, 'DLC:', msg.dlc, 'Data:', ' '.join(format(x, '02x') for x in msg.data))
 
-# *** CBUS control messages ***
-def setTrackPower (power_on):
-    if power_on == True:
-        msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_RTON], is_extended_id=False)
+# *** MESSAGE DECODING ***
+# Decoded messages are named tuples : they are compact (no per instance dictionary), fast to create
+# and fields can be read by name or by position. Field "opcode" is always the first one
+CBUSMessage = namedtuple ('CBUSMessage', 'opcode data')        # Any opcode without a specific layout
+NodeMessage = namedtuple ('NodeMessage', 'opcode node_number')
+NodeIndexMessage = namedtuple ('NodeIndexMessage', 'opcode node_number index')
+NodeVariableAnswer = namedtuple ('NodeVariableAnswer', 'opcode node_number index value')
+ParameterAnswer = namedtuple ('ParameterAnswer', 'opcode node_number index value')
+NodeReport = namedtuple ('NodeReport', 'opcode node_number manufacturer module_id flags')
+NodeName = namedtuple ('NodeName', 'opcode name')
+CommandError = namedtuple ('CommandError', 'opcode node_number error')
+EventCount = namedtuple ('EventCount', 'opcode node_number count')
+EventResponse = namedtuple ('EventResponse', 'opcode node_number event_node event_number index')
+EventVariableAnswer = namedtuple ('EventVariableAnswer', 'opcode node_number index ev_index value')
+EventVariableRequest = namedtuple ('EventVariableRequest', 'opcode node_number index ev_index')
+EventMessage = namedtuple ('EventMessage', 'opcode node_number event_number')
+EventVariableRead = namedtuple ('EventVariableRead', 'opcode node_number event_number ev_index')
+EventLearn = namedtuple ('EventLearn', 'opcode node_number event_number ev_index value')
+AccessoryEvent = namedtuple ('AccessoryEvent', 'opcode node_number event_number is_on is_short is_response data')
+SessionMessage = namedtuple ('SessionMessage', 'opcode session')
+SpeedDirection = namedtuple ('SpeedDirection', 'opcode session speed forward')
+EngineFunction = namedtuple ('EngineFunction', 'opcode session function is_on')
+EngineFunctionGroup = namedtuple ('EngineFunctionGroup', 'opcode session group value')
+EngineRequest = namedtuple ('EngineRequest', 'opcode address is_long_address flags')
+EngineReport = namedtuple ('EngineReport', 'opcode session address is_long_address speed forward functions1 functions2 functions3')
+CommandStationError = namedtuple ('CommandStationError', 'opcode data1 data2 error')
+
+# Accessory event opcodes, indexed by (is_short, is_response, is_on)
+# Each entry gives the opcodes used with 0, 1, 2 and 3 added data bytes
+ACCESSORY_OPCODES = {
+    (False, False, True): (OPC_ACON, OPC_ACON1, OPC_ACON2, OPC_ACON3),
+    (False, False, False): (OPC_ACOF, OPC_ACOF1, OPC_ACOF2, OPC_ACOF3),
+    (False, True, True): (OPC_ARON, OPC_ARON1, OPC_ARON2, OPC_ARON3),
+    (False, True, False): (OPC_AROF, OPC_AROF1, OPC_AROF2, OPC_AROF3),
+    (True, False, True): (OPC_ASON, OPC_ASON1, OPC_ASON2, OPC_ASON3),
+    (True, False, False): (OPC_ASOF, OPC_ASOF1, OPC_ASOF2, OPC_ASOF3),
+    (True, True, True): (OPC_ARSON, OPC_ARSON1, OPC_ARSON2, OPC_ARSON3),
+    (True, True, False): (OPC_ARSOF, OPC_ARSOF1, OPC_ARSOF2, OPC_ARSOF3),
+}
+
+# Layout of the opcodes decoded with a fixed binary format (big endian, opcode included)
+# B : one byte, H : 16 bits value (node number, event number, ...)
+_MESSAGE_LAYOUTS = (
+    (NodeMessage, '>BH', (OPC_SNN, OPC_RQNN, OPC_NNREL, OPC_NNACK, OPC_NNLRN, OPC_NNULN, OPC_NNCLR, OPC_NNEVN, \
+                          OPC_NERD, OPC_RQEVN, OPC_WRACK, OPC_RQDAT, OPC_BOOTM)),
+    (NodeIndexMessage, '>BHB', (OPC_NVRD, OPC_NENRD, OPC_RQNPN)),
+    (NodeVariableAnswer, '>BHBB', (OPC_NVANS, OPC_NVSET)),
+    (ParameterAnswer, '>BHBB', (OPC_PARAN,)),
+    (NodeReport, '>BHBBB', (OPC_PNN,)),
+    (CommandError, '>BHB', (OPC_CMDERR,)),
+    (EventCount, '>BHB', (OPC_NUMEV, OPC_EVNLF)),
+    (EventResponse, '>BHHHB', (OPC_ENRSP,)),
+    (EventVariableAnswer, '>BHBBB', (OPC_NEVAL,)),
+    (EventVariableRequest, '>BHBB', (OPC_REVAL,)),
+    (EventMessage, '>BHH', (OPC_AREQ, OPC_ASRQ, OPC_EVULN)),
+    (EventVariableRead, '>BHHB', (OPC_REQEV,)),
+    (EventLearn, '>BHHBB', (OPC_EVLRN, OPC_EVANS)),
+    (SessionMessage, '>BB', (OPC_KLOC, OPC_QLOC, OPC_DKEEP)),
+    (EngineFunctionGroup, '>BBBB', (OPC_DFUN,)),
+    (CommandStationError, '>BBBB', (OPC_ERR,)),
+)
+
+# Name of each opcode, built from the OPC_xxx constants
+OPCODE_NAMES = {}
+for _name, _value in list (globals().items()):
+    if _name.startswith ('OPC_'):
+        OPCODE_NAMES.setdefault (_value, _name[4:])
+
+# Description of each opcode, indexed by opcode value
+# data_bytes : number of data bytes following the opcode (given by the 3 upper bits of the opcode)
+# message_type : decoded message type
+# layout : binary format of the frame for fixed layouts, None otherwise
+OpcodeInfo = namedtuple ('OpcodeInfo', 'name data_bytes message_type layout')
+OPCODE_TABLE = [OpcodeInfo (OPCODE_NAMES.get (opcode, 'UNKNOWN_%02X' % opcode), opcode>>5, CBUSMessage, None) \
+                for opcode in range (256)]
+# Decoding functions and minimum frame length (opcode included), indexed by opcode
+_decoders = [None] * 256
+_frameLengths = [1 + (opcode>>5) for opcode in range (256)]
+
+def _genericDecoder (data):
+    return CBUSMessage (data[0], bytes (data[1:_frameLengths[data[0]]]))
+
+def _layoutDecoder (message_type, layout):
+    unpack = struct.Struct (layout).unpack_from
+    make = message_type._make
+    def decode (data):
+        return make (unpack (data))
+    return decode
+
+def _accessoryDecoder (opcode, is_on, is_short, is_response, data_bytes):
+    end = 5 + data_bytes
+    def decode (data):
+        return AccessoryEvent (opcode, (data[1]<<8) | data[2], (data[3]<<8) | data[4], is_on, is_short, is_response, \
+                               tuple (data[5:end]))
+    return decode
+
+def _engineRequestDecoder (data):
+    return EngineRequest (data[0], ((data[1]&0x3F)<<8) | data[2], (data[1]&0xC0) == 0xC0, data[3] if data[0] == OPC_GLOC else 0)
+
+def _engineReportDecoder (data):
+    return EngineReport (data[0], data[1], ((data[2]&0x3F)<<8) | data[3], (data[2]&0xC0) == 0xC0, \
+                         data[4]&0x7F, (data[4]&0x80) != 0, data[5], data[6], data[7])
+
+def _speedDirectionDecoder (data):
+    return SpeedDirection (data[0], data[1], data[2]&0x7F, (data[2]&0x80) != 0)
+
+def _engineFunctionDecoder (data):
+    return EngineFunction (data[0], data[1], data[2], data[0] == OPC_DFNON)
+
+def _nodeNameDecoder (data):
+    return NodeName (data[0], bytes (data[1:8]).rstrip (b'\x00 ').decode ('ascii', 'replace'))
+
+def _setDecoder (opcode, message_type, layout, decoder):
+    OPCODE_TABLE[opcode] = OPCODE_TABLE[opcode]._replace (message_type=message_type, layout=layout)
+    _decoders[opcode] = decoder
+
+def _buildDecoders ():
+    for opcode in range (256):
+        _decoders[opcode] = _genericDecoder
+    for message_type, layout, opcodes in _MESSAGE_LAYOUTS:
+        decoder = _layoutDecoder (message_type, layout)
+        for opcode in opcodes:
+            _setDecoder (opcode, message_type, layout, decoder)
+    for (is_short, is_response, is_on), opcodes in ACCESSORY_OPCODES.items():
+        for data_bytes, opcode in enumerate (opcodes):
+            _setDecoder (opcode, AccessoryEvent, None, _accessoryDecoder (opcode, is_on, is_short, is_response, data_bytes))
+    _setDecoder (OPC_RLOC, EngineRequest, None, _engineRequestDecoder)
+    _setDecoder (OPC_GLOC, EngineRequest, None, _engineRequestDecoder)
+    _setDecoder (OPC_PLOC, EngineReport, None, _engineReportDecoder)
+    _setDecoder (OPC_DSPD, SpeedDirection, None, _speedDirectionDecoder)
+    _setDecoder (OPC_DFNON, EngineFunction, None, _engineFunctionDecoder)
+    _setDecoder (OPC_DFNOF, EngineFunction, None, _engineFunctionDecoder)
+    _setDecoder (OPC_NAME, NodeName, None, _nodeNameDecoder)
+
+_buildDecoders()
+
+# Decode a CBUS frame. msg can be a python-can Msg or the data bytes of the frame (bytes, bytearray, list)
+# Returns one of the message types above, or None for frames which are not CBUS messages
+# (empty, remote or extended frames). Frames shorter than required by their opcode are
+# returned as CBUSMessage
+def decodeCBUSMessage (msg):
+    if isinstance (msg, can.Message):
+        if msg.is_extended_id or msg.is_remote_frame:
+            return None
+        data = msg.data
+    elif isinstance (msg, list):
+        data = bytes (msg)
     else:
-        msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_RTOF], is_extended_id=False)        
-    bus.send(msg)    
+        data = msg
+    if len (data) == 0:
+        return None
+    if len (data) < _frameLengths[data[0]]:
+        return CBUSMessage (data[0], bytes (data[1:]))
+    return _decoders[data[0]] (data)
+
+# Decode a list of frames (python-can Msg or data bytes) in one call
+# Returns the list of decoded messages, with None for frames which are not CBUS messages
+def decodeCBUSMessages (frames):
+    decoders = _decoders
+    frameLengths = _frameLengths
+    result = []
+    append = result.append
+    for frame in frames:
+        if isinstance (frame, can.Message):
+            if frame.is_extended_id or frame.is_remote_frame:
+                append (None)
+                continue
+            frame = frame.data
+        elif isinstance (frame, list):
+            frame = bytes (frame)
+        length = len (frame)
+        if length == 0:
+            append (None)
+        elif length < frameLengths[frame[0]]:
+            append (CBUSMessage (frame[0], bytes (frame[1:])))
+        else:
+            append (decoders[frame[0]] (frame))
+    return result
+
+# *** FRAME ENCODERS ***
+# Encoders return the data bytes of a CBUS frame (opcode first) as bytes, or None when a parameter
+# is invalid. Frames can then be sent with sendFrame, or queued and sent in one call with sendMany
+# Frames without parameters are built once, other ones are packed with precompiled structures
+_FRAME_RTON = bytes ([OPC_RTON])
+_FRAME_RTOF = bytes ([OPC_RTOF])
+_FRAME_RESTP = bytes ([OPC_RESTP])
+_FRAME_QNN = bytes ([OPC_QNN])
+_FRAME_RQMN = bytes ([OPC_RQMN])
+_PACK_BYTE = struct.Struct ('>BB').pack                  # Opcode, 8 bits value
+_PACK_2BYTES = struct.Struct ('>BBB').pack               # Opcode, 8 bits value, 8 bits value
+_PACK_3BYTES = struct.Struct ('>BBBB').pack              # Opcode, three 8 bits values
+_PACK_NODE = struct.Struct ('>BH').pack                  # Opcode, node number
+_PACK_NODE_BYTE = struct.Struct ('>BHB').pack            # Opcode, node number, 8 bits value
+_PACK_NODE_2BYTES = struct.Struct ('>BHBB').pack         # Opcode, node number, 8 bits value, 8 bits value
+_PACK_NODE_EVENT = struct.Struct ('>BHH').pack           # Opcode, node number, event number
+_PACK_NODE_EVENT_2BYTES = struct.Struct ('>BHHBB').pack  # Opcode, node number, event number, 8 bits value, 8 bits value
+
+# Accessory event opcode selection : (base opcode, isON, number of data bytes) -> opcode
+# Base opcode is OPC_ACON for long events, OPC_ASON for short events, OPC_ARON and OPC_ARSON for responses
+ACCESSORY_OPCODE_TABLE = {}
+for (_is_short, _is_response, _is_on), _opcodes in ACCESSORY_OPCODES.items():
+    for _datalen, _opcode in enumerate (_opcodes):
+        ACCESSORY_OPCODE_TABLE[(ACCESSORY_OPCODES[(_is_short, _is_response, True)][0], _is_on, _datalen)] = _opcode
 
-def requestSession (dcc_loc_number):
+def encodeTrackPower (power_on):
+    if power_on == True:
+        return _FRAME_RTON
+    return _FRAME_RTOF
+
+# Addresses 0 to 127 are sent as short addresses, 128 to 10239 as long addresses (2 upper bits set)
+def encodeRequestSession (dcc_loc_number):
     if dcc_loc_number > 10239:    # 0x27FF is the highest address allowed by NMRA
-        return
+        return None
     if dcc_loc_number <= 127:
-        msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_RLOC, 0, dcc_loc_number], is_extended_id=False)        
-    # TODO : add support for long address
-    bus.send(msg)
-    
-def releaseSession (session):
-    msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_KLOC, session], is_extended_id=False)
-    bus.send(msg)
-    
-# speed_mode : 0 to 3
-# service_mode : False / True
-# sound_control_mode : False / True
-def setCABSessionMode (session, speed_mode, service_mode = False, sound_control_mode = False):
+        return _PACK_2BYTES (OPC_RLOC, 0, dcc_loc_number)
+    return _PACK_2BYTES (OPC_RLOC, 0xC0 | (dcc_loc_number>>8), dcc_loc_number&0xFF)
+
+# OPC_GLOC flags
+GLOC_STEAL = 0x01         # Take the session of another cab, which gets OPC_ERR session cancelled
+GLOC_SHARE = 0x02         # Share the session of another cab
+
+# Like encodeRequestSession, but the command station can give a session already used by another cab (flags GLOC_xxx)
+def encodeGetSession (dcc_loc_number, flags):
+    if dcc_loc_number > 10239:
+        return None
+    if dcc_loc_number <= 127:
+        return _PACK_3BYTES (OPC_GLOC, 0, dcc_loc_number, flags)
+    return _PACK_3BYTES (OPC_GLOC, 0xC0 | (dcc_loc_number>>8), dcc_loc_number&0xFF, flags)
+
+def encodeReleaseSession (session):
+    return _PACK_BYTE (OPC_KLOC, session)
+
+def encodeCABSessionMode (session, speed_mode, service_mode = False, sound_control_mode = False):
     if speed_mode > 3:  # check illegal value for speed_mode
-        return
+        return None
     Dat2 = speed_mode   # set bits 0 / 1
     if service_mode == True:
         Dat2 = Dat2 + 4   # set bit 2
     if sound_control_mode == True:
         Dat2 = Dat2 + 8   # set bit 3
-    msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_STMOD, session, Dat2], is_extended_id=False)
-    bus.send(msg)
-    
-def keepAliveSession (session):
-    msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_DKEEP, session], is_extended_id=False)
-    bus.send(msg)
-    
-def setSpeedAndDirection (session, speed, forward):
-    Dat2 = speed
+    return _PACK_2BYTES (OPC_STMOD, session, Dat2)
+
+def encodeKeepAliveSession (session):
+    return _PACK_BYTE (OPC_DKEEP, session)
+
+def encodeSpeedAndDirection (session, speed, forward):
     if forward == True:
-        Dat2 = Dat2 + 0x80   # set forward direction flag
-    msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_DSPD, session, Dat2], is_extended_id=False)
-    bus.send(msg)
-    
-def emergencyStop ():
-    msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_RESTP], is_extended_id=False)
-    bus.send(msg)
-    
-# *** LOCO DECODER FUNCTIONS ***
-def setEngineFunction (session, function, activate):
+        return _PACK_2BYTES (OPC_DSPD, session, speed + 0x80)   # set forward direction flag
+    return _PACK_2BYTES (OPC_DSPD, session, speed)
+
+def encodeEmergencyStop ():
+    return _FRAME_RESTP
+
+def encodeEngineFunction (session, function, activate):
     if activate == True:
-        msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_DFNON, session, function], is_extended_id=False)
-    else:
-        msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_DFNOF, session, function], is_extended_id=False)
-    bus.send(msg)    
-    
-# *** NODE VARIABLES READ/WRITE ***
-def setNodeVariable (node_number, variable_number, variable_value):
+        return _PACK_2BYTES (OPC_DFNON, session, function)
+    return _PACK_2BYTES (OPC_DFNOF, session, function)
+
+# group : 1 = F0 to F4, 2 = F5 to F8, 3 = F9 to F12, 4 = F13 to F20, 5 = F21 to F28
+# value : state of the functions of the group, in DCC format (F0 is bit 4 in group 1)
+def encodeEngineFunctionGroup (session, group, value):
+    if group < 1 or group > 5:
+        return None
+    return _PACK_2BYTES (OPC_DFUN, session, group) + bytes ([value])
+
+def encodeSetNodeVariable (node_number, variable_number, variable_value):
     if variable_number < 1 or variable_number > 255:
-        return
-    msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_NVSET, node_number>>8, node_number&0xFF, \
-                                                     variable_number, variable_value], is_extended_id=False)
-    bus.send(msg)
-    
-def readNodeVariable (node_number, variable_number):
-    msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_NVRD, node_number>>8, node_number&0xFF, \
-                                                     variable_number], is_extended_id=False)
-    bus.send(msg)
+        return None
+    return _PACK_NODE_2BYTES (OPC_NVSET, node_number, variable_number, variable_value)
 
-# *** TEACHING EVENTS AND EVENT VARIABLES ***
-def activateLearnMode (node_number):
-    msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_NNLRN, node_number>>8, node_number&0xFF], is_extended_id=False)
-    bus.send(msg)
-    
-# For teaching device numbers using device addressing, node_number must be 0. event_number shall contain then the device address
-def sendEventToLearn (node_number, event_number, event_variable, event_value):
+def encodeReadNodeVariable (node_number, variable_number):
+    return _PACK_NODE_BYTE (OPC_NVRD, node_number, variable_number)
+
+def encodeActivateLearnMode (node_number):
+    return _PACK_NODE (OPC_NNLRN, node_number)
+
+def encodeEventToLearn (node_number, event_number, event_variable, event_value):
     if event_variable < 1  or event_variable > 255 :
-        return
-    msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_EVLRN, node_number>>8, node_number&0xFF, \
-                                                     event_number>>8, event_number&0xFF, \
-                                                     event_variable, event_value], is_extended_id=False)
-    bus.send(msg)
-    
-def exitLearnMode (node_number):
-    msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_NNULN, node_number>>8, node_number&0xFF], is_extended_id=False)
-    bus.send(msg)
-    
-def removeEvent (node_number, event_number):
-    msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_EVULN, node_number>>8, node_number&0xFF, \
-                                                     event_number>>8, event_number&0xFF], is_extended_id=False)
-    bus.send(msg)
+        return None
+    return _PACK_NODE_EVENT_2BYTES (OPC_EVLRN, node_number, event_number, event_variable, event_value)
 
-# *** ACCESSORY EVENT REQUEST ***
-def accessoryRequestEventLong (node_number, event_number):
-    msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_AREQ, node_number>>8, node_number&0xFF, event_number>>8, \
-                                                     event_number&0xFF], is_extended_id=False)
-    bus.send(msg)
-    
-def accessoryRequestEventShort (node_number, device_number):
-    msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ASRQ, node_number>>8, node_number&0xFF, device_number>>8, \
-                                                     device_number&0xFF], is_extended_id=False)
-    bus.send(msg)
-    
+def encodeExitLearnMode (node_number):
+    return _PACK_NODE (OPC_NNULN, node_number)
+
+def encodeRemoveEvent (node_number, event_number):
+    return _PACK_NODE_EVENT (OPC_EVULN, node_number, event_number)
+
+def encodeAccessoryRequestEventLong (node_number, event_number):
+    return _PACK_NODE_EVENT (OPC_AREQ, node_number, event_number)
+
+def encodeAccessoryRequestEventShort (node_number, device_number):
+    return _PACK_NODE_EVENT (OPC_ASRQ, node_number, device_number)
+
+# Accessory event of any kind : base_opcode is OPC_ACON, OPC_ASON, OPC_ARON or OPC_ARSON (see ACCESSORY_OPCODE_TABLE)
 # data can be None or array of 1, 2 or 3 data bytes
-def accessoryEventLong (node_number, event_number, isON, data):
+def encodeAccessoryEvent (base_opcode, node_number, event_number, isON, data):
     if data == None:
-        if isON == False:
-            msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ACOF, node_number>>8, node_number&0xFF, \
-                                                             event_number>>8, event_number&0xFF], \
-                               is_extended_id=False)
-        else:
-            msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ACON, node_number>>8, node_number&0xFF, \
-                                                             event_number>>8, event_number&0xFF], \
-                               is_extended_id=False)           
-    else:
-        datalen = len(data)
-        if datalen == 1:
-            if isON == False:
-                msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ACOF1, node_number>>8, node_number&0xFF, \
-                                                                 event_number>>8, event_number&0xFF, data[0]], \
-                                   is_extended_id=False)
-            else:
-                msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ACON1, node_number>>8, node_number&0xFF, \
-                                                                 event_number>>8, event_number&0xFF, data[0]], \
-                                   is_extended_id=False)           
-            
-        elif datalen == 2:
-            if isON == False:
-                msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ACOF2, node_number>>8, node_number&0xFF, \
-                                                                 event_number>>8, event_number&0xFF, \
-                                                                 data[0], data[1]], is_extended_id=False)
-            else:
-                msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ACON2, node_number>>8, node_number&0xFF, \
-                                                                 event_number>>8, event_number&0xFF, \
-                                                                 data[0], data[1]], is_extended_id=False)           
-
-        elif datalen == 3:
-            if isON == False:
-                msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ACOF3, node_number>>8, node_number&0xFF, \
-                                                                 event_number>>8, event_number&0xFF, \
-                                                                 data[0], data[1], data[2]], \
-                                   is_extended_id=False)
-            else:
-                msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ACON3, node_number>>8, node_number&0xFF, \
-                                                                 event_number>>8, event_number&0xFF, data[0], \
-                                                                 data[1], data[2]], \
-                                   is_extended_id=False)           
-        
-        else:
-            return    # Invalid number of bytes
-    bus.send (msg)
+        opcode = ACCESSORY_OPCODE_TABLE.get ((base_opcode, isON != False, 0))
+        if opcode == None:
+            return None
+        return _PACK_NODE_EVENT (opcode, node_number, event_number)
+    opcode = ACCESSORY_OPCODE_TABLE.get ((base_opcode, isON != False, len (data)))
+    if opcode == None:
+        return None    # Invalid number of bytes
+    return _PACK_NODE_EVENT (opcode, node_number, event_number) + bytes (data)
+
+# Long and short events are the most frequent frames : their opcodes are also stored in tuples
+# indexed by [isON][number of data bytes], which is faster than the dictionary lookup
+_LONG_EVENT_OPCODES = (ACCESSORY_OPCODES[(False, False, False)], ACCESSORY_OPCODES[(False, False, True)])
+_SHORT_EVENT_OPCODES = (ACCESSORY_OPCODES[(True, False, False)], ACCESSORY_OPCODES[(True, False, True)])
 
-def accessoryEventShort (node_number, device_number, isON, data):
+def encodeAccessoryEventLong (node_number, event_number, isON, data):
     if data == None:
-        if isON == False:
-            msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ASOF, node_number>>8, node_number&0xFF, \
-                                                             device_number>>8, device_number&0xFF], \
-                               is_extended_id=False)
+        return _PACK_NODE_EVENT (_LONG_EVENT_OPCODES[isON != False][0], node_number, event_number)
+    datalen = len (data)
+    if datalen < 1 or datalen > 3:
+        return None    # Invalid number of bytes
+    return _PACK_NODE_EVENT (_LONG_EVENT_OPCODES[isON != False][datalen], node_number, event_number) + bytes (data)
+
+def encodeAccessoryEventShort (node_number, device_number, isON, data):
+    if data == None:
+        return _PACK_NODE_EVENT (_SHORT_EVENT_OPCODES[isON != False][0], node_number, device_number)
+    datalen = len (data)
+    if datalen < 1 or datalen > 3:
+        return None    # Invalid number of bytes
+    return _PACK_NODE_EVENT (_SHORT_EVENT_OPCODES[isON != False][datalen], node_number, device_number) + bytes (data)
+
+def encodeReadNodeParameter (node_number, parameter_index):
+    return _PACK_NODE_BYTE (OPC_RQNPN, node_number, parameter_index)
+
+def encodeReadNumberOfEvents (node_number):
+    return _PACK_NODE (OPC_RQEVN, node_number)
+
+def encodeReadEventVariable (node_number, event_index, event_variable):
+    return _PACK_NODE_2BYTES (OPC_REVAL, node_number, event_index, event_variable)
+
+def encodeClearAllEvents (node_number):
+    return _PACK_NODE (OPC_NNCLR, node_number)
+
+def encodeQueryAllNodes ():
+    return _FRAME_QNN
+
+def encodeRequestModuleName ():
+    return _FRAME_RQMN
+
+def encodeReadAllEvents (node_number):
+    return _PACK_NODE (OPC_NERD, node_number)
+
+def encodeReadEventFromNumber (node_number, event_number):
+    if event_number < 0 or event_number > 255:
+        return None
+    return _PACK_NODE_BYTE (OPC_NENRD, node_number, event_number)
+
+# The node restarts in its bootloader (see pyCBUS_bootloader)
+def encodeBootMode (node_number):
+    return _PACK_NODE (OPC_BOOTM, node_number)
+
+# *** PRIORITIES AND TRANSMIT SCHEDULER ***
+# Priority classes of the frames. Lower classes are transmitted first by the transmit scheduler,
+# and get higher priority bits in the CAN arbitration identifier
+PRIORITY_EMERGENCY = 0    # Emergency stop
+PRIORITY_POWER = 1        # Track power
+PRIORITY_HIGH = 2         # Loco control
+PRIORITY_NORMAL = 3       # Accessory events and everything else
+PRIORITY_LOW = 4          # Node configuration
+# (major priority, minor priority) used in the CAN arbitration identifier for each class
+PRIORITY_BITS = [(0, 0), (0, 1), (1, 0), (2, 2), (2, 3)]
+
+# Default priority class of each opcode, used when no priority is given to sendFrame
+framePriorities = [PRIORITY_NORMAL] * 256
+for _opcode in (OPC_RESTP, OPC_ESTOP):
+    framePriorities[_opcode] = PRIORITY_EMERGENCY
+for _opcode in (OPC_RTON, OPC_RTOF, OPC_TON, OPC_TOF):
+    framePriorities[_opcode] = PRIORITY_POWER
+for _opcode in (OPC_DSPD, OPC_DFNON, OPC_DFNOF, OPC_DFUN, OPC_DKEEP, OPC_RLOC, OPC_GLOC, OPC_KLOC, OPC_STMOD):
+    framePriorities[_opcode] = PRIORITY_HIGH
+for _opcode in (OPC_NVSET, OPC_NVRD, OPC_NNLRN, OPC_NNULN, OPC_NNCLR, OPC_EVLRN, OPC_EVULN, OPC_NERD, OPC_NENRD, \
+                OPC_RQEVN, OPC_REVAL, OPC_RQNPN, OPC_RQMN, OPC_QNN):
+    framePriorities[_opcode] = PRIORITY_LOW
+
+CAN_BITRATE = 125000      # CBUS bitrate
+
+# Number of bits on the bus of a CAN frame with dlc data bytes, including the worst case of stuff bits
+# and the interframe space
+def frameBits (dlc, is_extended_id = False):
+    if is_extended_id:
+        return 67 + 8*dlc + (54 + 8*dlc - 1) // 4
+    return 47 + 8*dlc + (34 + 8*dlc - 1) // 4
+
+# Transmit queue sorted by priority class, emptied by a thread at the rate allowed by a token bucket
+# max_load : fraction of the bus bitrate that can be used by this program
+# max_queue : number of frames in the queue above which callers are blocked (or refused in non blocking mode).
+# Emergency and power frames are always accepted, are sent before all other frames and are not rate limited
+# burst_bits : size of the token bucket, i.e. number of bits which can be sent back to back
+class TransmitScheduler:
+    def __init__ (self, send, max_load = 0.8, max_queue = 1000, burst_bits = 1200, bitrate = CAN_BITRATE):
+        self.send = send
+        self.rate = bitrate * max_load
+        self.max_queue = max_queue
+        self.burst_bits = burst_bits
+        self.tokens = burst_bits
+        self.last_refill = time.monotonic()
+        self.queue = []           # Heap of (priority class, sequence number, python-can Msg)
+        self.sequence = 0
+        self.lock = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread (target=self._transmitThread, daemon=True)
+        self.thread.start()
+
+    # Send the frames still in the queue, then stop the transmit thread
+    def close (self):
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+        self.thread.join()
+
+    def depth (self):
+        return len (self.queue)
+
+    # Queue a frame. If the queue is full, wait until there is room when block is True (at most timeout seconds
+    # if timeout is not None). Returns False if the frame has not been queued
+    def submit (self, msg, priority, block = True, timeout = None):
+        with self.lock:
+            if priority > PRIORITY_POWER:
+                if block:
+                    if not self.lock.wait_for (lambda: len (self.queue) < self.max_queue or not self.running, timeout):
+                        return False
+                elif len (self.queue) >= self.max_queue:
+                    return False
+            if not self.running:
+                return False
+            self.sequence = self.sequence + 1
+            heapq.heappush (self.queue, (priority, self.sequence, msg))
+            self.lock.notify_all()
+        return True
+
+    def _transmitThread (self):
+        with self.lock:
+            while self.running or len (self.queue) > 0:
+                if len (self.queue) == 0:
+                    self.lock.wait()
+                    continue
+                priority, sequence, msg = self.queue[0]
+                now = time.monotonic()
+                self.tokens = min (self.burst_bits, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                bits = frameBits (msg.dlc, msg.is_extended_id)
+                if priority > PRIORITY_POWER and self.tokens < bits:
+                    # Wait for tokens. A more urgent frame queued meanwhile is sent first
+                    self.lock.wait ((bits - self.tokens) / self.rate)
+                    continue
+                heapq.heappop (self.queue)
+                self.tokens = self.tokens - bits
+                self.lock.notify_all()
+                self.lock.release()
+                try:
+                    self._sendWithRetry (msg, priority)
+                finally:
+                    self.lock.acquire()
+
+    # Send a frame, waiting when the socket transmit buffer is full. Emergency stop and track power frames are
+    # retried until they are sent, other frames are dropped after 100 failed attempts
+    def _sendWithRetry (self, msg, priority):
+        retry = 0
+        while True:
+            try:
+                self.send (msg)
+                return
+            except can.CanOperationError as error:
+                retry = retry + 1
+                if retry == 100:
+                    frame = 'CBUS ID %d data %s' % (msg.arbitration_id, bytes (msg.data).hex())
+                    if priority > PRIORITY_POWER:
+                        print ('pyCBUS: frame dropped (%s), send failed 100 times : %s' % (frame, error), file = sys.stderr)
+                        return
+                    print ('pyCBUS: send failed 100 times, still retrying (%s) : %s' % (frame, error), file = sys.stderr)
+                time.sleep (0.001)
+            except Exception:
+                traceback.print_exc()
+                return
+
+# *** CBUS INTERFACE ***
+# A CBUSInterface owns a CAN bus with its CBUS CAN identifier and priorities, its receive and send handlers,
+# its receiver thread and its transmit scheduler. A program can drive several CAN segments (can0, can1, ...)
+# with one interface per segment. Frames can be sent from several threads : bus access is serialized by a lock
+# The module functions (setup, setCBUS_ID, sendFrame, setTrackPower, ...) use the default interface, defaultInterface
+#
+#   segment2 = CBUSInterface (channel = 'can1')
+#   segment2.setCBUS_ID (100)
+#   segment2.startReceiver()
+#   segment2.setTrackPower (True)
+class CBUSInterface:
+    # bus : an already opened python-can bus. If bus is None and channel is given, the channel is opened
+    # with python-can bustype and config (see open), otherwise open must be called before the interface is used
+    def __init__ (self, channel = None, bustype = 'socketcan', bus = None, **config):
+        if bus == None:
+            bus = 0
+        self.bus = bus
+        self.CBUS_ID = 0x2FF            # CAN identifier, priority bits included
+        self.major_priority = 0         # value is 0 (max) to 2 (3 is not allowed)
+        self.minor_priority = 0         # value is 0 (max) to 3
+        # Handler table indexed by CBUS opcode (data[0] of the CAN frame)
+        # Each slot holds the list of callbacks registered for this opcode. Lists are never modified
+        # in place (a new list is stored instead), so the receiver thread can walk them without locking
+        # Writers (add / remove of message and send handlers) are serialized by handlers_lock
+        self.messageHandlers = [[] for opcode in range (256)]
+        self.handlers_lock = threading.Lock()
+        # Callbacks called for every received frame, whatever its opcode (monitors, loggers, ...)
+        self.anyMessageHandlers = []
+        # Callbacks called with the python-can Msg of each frame sent through this interface, after it has been sent
+        # The Msg must not be kept by the callback, as it can be reused for the next frame (see sendMany)
+        self.sendHandlers = []
+        self.receiver = 0
+        self.transmitScheduler = 0
+        self.send_lock = threading.Lock()
+        if bus == 0 and channel != None:
+            self.open (channel, bustype, **config)
+
+    # Open a CAN channel with any python-can interface (socketcan, slcan, virtual, ...)
+    # config : other python-can parameters (bitrate, ...). If bustype is None, python-can configuration is used
+    def open (self, channel = 'can0', bustype = 'socketcan', **config):
+        if bustype == None:
+            self.bus = can.interface.Bus (channel = channel, **config)
         else:
-            msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ASON, node_number>>8, node_number&0xFF, \
-                                                             device_number>>8, device_number&0xFF], \
-                               is_extended_id=False)           
-    else:
-        datalen = len(data)
-        if datalen == 1:
-            if isON == False:
-                msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ASOF1, node_number>>8, node_number&0xFF, \
-                                                                 device_number>>8, device_number&0xFF, data[0]], \
-                                   is_extended_id=False)
+            self.bus = can.interface.Bus (channel = channel, interface = bustype, **config)
+
+    # Stop the receiver thread and the transmit scheduler, then close the bus
+    def shutdown (self):
+        self.stopReceiver()
+        self.stopTransmitScheduler()
+        if self.bus != 0:
+            self.bus.shutdown()
+            self.bus = 0
+
+    # Set CAN identifier used in CBUS messages
+    def setCBUS_ID (self, can_id):
+        self.CBUS_ID=can_id+(self.major_priority<<9)+(self.minor_priority<<7)
+
+    # Return the CAN arbitration identifier for a priority class
+    def priorityCANID (self, priority):
+        major, minor = PRIORITY_BITS[priority]
+        return (self.CBUS_ID & 0x7F) | (major<<9) | (minor<<7)
+
+    # Get next CBUS message in reception queue
+    # Function is non blocking and returns None if no CAN message has been received
+    # Do not use this function while the event driven receiver is running (see startReceiver)
+    def getNextCBUSMessage (self):
+        msg = self.bus.recv (0)    # 0 : Make bus.recv non blocking
+        return msg
+
+    # *** EVENT DRIVEN RECEPTION ***
+    # Register a callback for a given opcode. Callback is called with the python-can Msg as only parameter
+    # from the receiver thread, so it must not block. Use opcode = None to receive all frames
+    def addMessageHandler (self, opcode, callback):
+        with self.handlers_lock:
+            if opcode == None:
+                self.anyMessageHandlers = self.anyMessageHandlers + [callback]
             else:
-                msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ASON1, node_number>>8, node_number&0xFF, \
-                                                                 device_number>>8, device_number&0xFF, data[0]], \
-                                   is_extended_id=False)           
-            
-        elif datalen == 2:
-            if isON == False:
-                msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ASOF2, node_number>>8, node_number&0xFF, \
-                                                                 device_number>>8, device_number&0xFF, \
-                                                                 data[0], data[1]], is_extended_id=False)
+                self.messageHandlers[opcode] = self.messageHandlers[opcode] + [callback]
+
+    def removeMessageHandler (self, opcode, callback):
+        with self.handlers_lock:
+            if opcode == None:
+                self.anyMessageHandlers = [handler for handler in self.anyMessageHandlers if handler != callback]
             else:
-                msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ASON2, node_number>>8, node_number&0xFF, \
-                                                                 device_number>>8, device_number&0xFF, \
-                                                                 data[0], data[1]], is_extended_id=False)           
-
-        elif datalen == 3:
-            if isON == False:
-                msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ASOF3, node_number>>8, node_number&0xFF, \
-                                                                 device_number>>8, device_number&0xFF, \
-                                                                 data[0], data[1], data[2]], \
-                                   is_extended_id=False)
+                self.messageHandlers[opcode] = [handler for handler in self.messageHandlers[opcode] if handler != callback]
+
+    # Call all handlers registered for a received frame
+    # Extended and remote frames are not CBUS opcodes and are only given to the "all frames" handlers
+    # An exception in a handler is reported but does not stop the dispatch of the frame to other handlers
+    def dispatchCBUSMessage (self, msg):
+        for handler in self.anyMessageHandlers:
+            try:
+                handler (msg)
+            except Exception:
+                traceback.print_exc()
+        if msg.is_extended_id or msg.is_remote_frame or msg.dlc == 0:
+            return
+        for handler in self.messageHandlers[msg.data[0]]:
+            try:
+                handler (msg)
+            except Exception:
+                traceback.print_exc()
+
+    # Start the receiver thread : it blocks on the CAN socket and dispatches each frame to the
+    # registered handlers as soon as it is received (no polling)
+    # The bus must be opened before
+    def startReceiver (self):
+        if self.receiver != 0:
+            return
+        self.receiver = can.Notifier (self.bus, [self.dispatchCBUSMessage], timeout=1.0)
+
+    def stopReceiver (self):
+        if self.receiver == 0:
+            return
+        self.receiver.stop()
+        self.receiver = 0
+
+    # *** FRAME TRANSMISSION ***
+    def addSendHandler (self, callback):
+        with self.handlers_lock:
+            self.sendHandlers = self.sendHandlers + [callback]
+
+    def removeSendHandler (self, callback):
+        with self.handlers_lock:
+            self.sendHandlers = [handler for handler in self.sendHandlers if handler != callback]
+
+    def _notifySendHandlers (self, msg):
+        for handler in self.sendHandlers:
+            try:
+                handler (msg)
+            except Exception:
+                traceback.print_exc()
+
+    # Route all frames sent by sendFrame and sendMany through a TransmitScheduler (see TransmitScheduler for parameters)
+    def startTransmitScheduler (self, max_load = 0.8, max_queue = 1000, burst_bits = 1200):
+        if self.transmitScheduler != 0:
+            return
+        self.transmitScheduler = TransmitScheduler (self.sendMessage, max_load, max_queue, burst_bits)
+
+    def stopTransmitScheduler (self):
+        if self.transmitScheduler == 0:
+            return
+        scheduler = self.transmitScheduler
+        self.transmitScheduler = 0
+        scheduler.close()
+
+    # Number of frames waiting in the transmit scheduler queue (0 when the scheduler is not running)
+    def transmitQueueDepth (self):
+        scheduler = self.transmitScheduler
+        if scheduler == 0:
+            return 0
+        return scheduler.depth()
+
+    # Send a python-can Msg on the bus as is (no transmit scheduler), then call the send handlers
+    def sendMessage (self, msg):
+        with self.send_lock:
+            self.bus.send (msg)
+        if self.sendHandlers:
+            self._notifySendHandlers (msg)
+
+    # Send one CBUS frame. data is the frame content (opcode first), for example the value returned by an encoder
+    # Nothing is sent if data is None (invalid parameters given to the encoder)
+    # priority : priority class of the frame (PRIORITY_xxx). If None, the default class of the opcode is used when
+    # the transmit scheduler is running, otherwise the frame is sent with CBUS_ID
+    # When the transmit scheduler is running, the frame is queued. If the queue is full, the function waits
+    # for room when block is True (for at most timeout seconds). Returns False if the frame has not been sent or queued
+    def sendFrame (self, data, priority = None, block = True, timeout = None):
+        if data == None:
+            return False
+        scheduler = self.transmitScheduler
+        if scheduler == 0:
+            # Fast path : frame sent directly from the calling thread
+            if priority == None:
+                can_id = self.CBUS_ID
             else:
-                msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_ASON3, node_number>>8, node_number&0xFF, \
-                                                                 device_number>>8, device_number&0xFF, \
-                                                                 data[0], data[1], data[2]], \
-                                   is_extended_id=False)           
-        
-        else:
-            return    # Invalid number of bytes
-    bus.send (msg)
-    
+                can_id = self.priorityCANID (priority)
+            msg = can.Message (arbitration_id=can_id, data=data, is_extended_id=False)
+            with self.send_lock:
+                self.bus.send (msg)
+            if self.sendHandlers:
+                self._notifySendHandlers (msg)
+            return True
+        if priority == None:
+            priority = framePriorities[data[0]]
+        msg = can.Message (arbitration_id=self.priorityCANID (priority), data=data, is_extended_id=False)
+        return scheduler.submit (msg, priority, block, timeout)
+
+    # Send a list of CBUS frames (as returned by the encoders) in one call. None entries are skipped
+    # When the transmit scheduler is not running, a single python-can message is reused for the whole batch :
+    # python-can backends serialize (or copy) the message in bus.send, so the message can be modified once send has returned
+    def sendMany (self, frames):
+        if self.transmitScheduler != 0:
+            for data in frames:
+                self.sendFrame (data)
+            return
+        msg = can.Message (arbitration_id=self.CBUS_ID, is_extended_id=False)
+        send = self.bus.send
+        if not self.sendHandlers:
+            with self.send_lock:
+                for data in frames:
+                    if data == None:
+                        continue
+                    msg.data = bytearray (data)
+                    msg.dlc = len (data)
+                    send (msg)
+            return
+        # Send handlers are called without the lock (as by sendFrame), so they can send frames
+        for data in frames:
+            if data == None:
+                continue
+            msg.data = bytearray (data)
+            msg.dlc = len (data)
+            with self.send_lock:
+                send (msg)
+            self._notifySendHandlers (msg)
+
+    # *** CBUS control messages ***
+    def setTrackPower (self, power_on):
+        self.sendFrame (encodeTrackPower (power_on))
+
+    def requestSession (self, dcc_loc_number):
+        self.sendFrame (encodeRequestSession (dcc_loc_number))
+
+    # flags : GLOC_STEAL or GLOC_SHARE
+    def getSession (self, dcc_loc_number, flags):
+        self.sendFrame (encodeGetSession (dcc_loc_number, flags))
+
+    def releaseSession (self, session):
+        self.sendFrame (encodeReleaseSession (session))
+
+    # speed_mode : 0 to 3
+    # service_mode : False / True
+    # sound_control_mode : False / True
+    def setCABSessionMode (self, session, speed_mode, service_mode = False, sound_control_mode = False):
+        self.sendFrame (encodeCABSessionMode (session, speed_mode, service_mode, sound_control_mode))
+
+    def keepAliveSession (self, session):
+        self.sendFrame (encodeKeepAliveSession (session))
+
+    def setSpeedAndDirection (self, session, speed, forward):
+        self.sendFrame (encodeSpeedAndDirection (session, speed, forward))
+
+    def emergencyStop (self):
+        self.sendFrame (encodeEmergencyStop())
+
+    # *** LOCO DECODER FUNCTIONS ***
+    def setEngineFunction (self, session, function, activate):
+        self.sendFrame (encodeEngineFunction (session, function, activate))
+
+    # Set all functions of a group (see encodeEngineFunctionGroup)
+    def setEngineFunctionGroup (self, session, group, value):
+        self.sendFrame (encodeEngineFunctionGroup (session, group, value))
+
+    # *** NODE VARIABLES READ/WRITE ***
+    def setNodeVariable (self, node_number, variable_number, variable_value):
+        self.sendFrame (encodeSetNodeVariable (node_number, variable_number, variable_value))
+
+    def readNodeVariable (self, node_number, variable_number):
+        self.sendFrame (encodeReadNodeVariable (node_number, variable_number))
+
+    # *** TEACHING EVENTS AND EVENT VARIABLES ***
+    def activateLearnMode (self, node_number):
+        self.sendFrame (encodeActivateLearnMode (node_number))
+
+    # For teaching device numbers using device addressing, node_number must be 0. event_number shall contain then the device address
+    def sendEventToLearn (self, node_number, event_number, event_variable, event_value):
+        self.sendFrame (encodeEventToLearn (node_number, event_number, event_variable, event_value))
+
+    def exitLearnMode (self, node_number):
+        self.sendFrame (encodeExitLearnMode (node_number))
+
+    def removeEvent (self, node_number, event_number):
+        self.sendFrame (encodeRemoveEvent (node_number, event_number))
+
+    # Node must be in learn mode
+    def clearAllEvents (self, node_number):
+        self.sendFrame (encodeClearAllEvents (node_number))
+
+    # *** ACCESSORY EVENT REQUEST ***
+    def accessoryRequestEventLong (self, node_number, event_number):
+        self.sendFrame (encodeAccessoryRequestEventLong (node_number, event_number))
+
+    def accessoryRequestEventShort (self, node_number, device_number):
+        self.sendFrame (encodeAccessoryRequestEventShort (node_number, device_number))
+
+    # data can be None or array of 1, 2 or 3 data bytes
+    def accessoryEventLong (self, node_number, event_number, isON, data):
+        self.sendFrame (encodeAccessoryEventLong (node_number, event_number, isON, data))
+
+    def accessoryEventShort (self, node_number, device_number, isON, data):
+        self.sendFrame (encodeAccessoryEventShort (node_number, device_number, isON, data))
+
+    # *** MISCELLANEOUS ***
+    def queryAllNodes (self):
+        self.sendFrame (encodeQueryAllNodes())
+
+    def readAllEvents (self, node_number):
+        self.sendFrame (encodeReadAllEvents (node_number))
+
+    def readEventFromNumber (self, node_number, event_number):
+        self.sendFrame (encodeReadEventFromNumber (node_number, event_number))
+
+    # Only the node in setup mode answers
+    def requestModuleName (self):
+        self.sendFrame (encodeRequestModuleName())
+
+    def readNumberOfEvents (self, node_number):
+        self.sendFrame (encodeReadNumberOfEvents (node_number))
+
+    # event_index is the index of the event in the node table (as given by OPC_ENRSP)
+    def readEventVariable (self, node_number, event_index, event_variable):
+        self.sendFrame (encodeReadEventVariable (node_number, event_index, event_variable))
+
+    def readNodeParameter (self, node_number, parameter_index):
+        self.sendFrame (encodeReadNodeParameter (node_number, parameter_index))
+
+    def enterBootMode (self, node_number):
+        self.sendFrame (encodeBootMode (node_number))
+
+# Interface used by the module functions
+defaultInterface = CBUSInterface()
+
+# *** DEFAULT INTERFACE FUNCTIONS ***
+# Set CAN identifier used in CBUS messages (with priorities CBUS_MAJOR_PRIORITY and CBUS_MINOR_PRIORITY)
+def setCBUS_ID (can_id):
+    global CBUS_ID
+    defaultInterface.major_priority = CBUS_MAJOR_PRIORITY
+    defaultInterface.minor_priority = CBUS_MINOR_PRIORITY
+    defaultInterface.setCBUS_ID (can_id)
+    CBUS_ID = defaultInterface.CBUS_ID
+
+# Get next CBUS message in reception queue
+# Function is non blocking and returns None if no CAN message has been received
+# Do not use this function while the event driven receiver is running (see startReceiver)
+def getNextCBUSMessage ():
+    return defaultInterface.getNextCBUSMessage()
+
+# Register a callback for a given opcode (see CBUSInterface.addMessageHandler). Use opcode = None to receive all frames
+def addMessageHandler (opcode, callback):
+    defaultInterface.addMessageHandler (opcode, callback)
+
+def removeMessageHandler (opcode, callback):
+    defaultInterface.removeMessageHandler (opcode, callback)
+
+# Start the receiver thread of the default interface. setup() must be called before
+def startReceiver ():
+    defaultInterface.startReceiver()
+
+def stopReceiver ():
+    defaultInterface.stopReceiver()
+
+# Register a callback called with each frame sent by the program (see CBUSInterface)
+def addSendHandler (callback):
+    defaultInterface.addSendHandler (callback)
+
+def removeSendHandler (callback):
+    defaultInterface.removeSendHandler (callback)
+
+def startTransmitScheduler (max_load = 0.8, max_queue = 1000, burst_bits = 1200):
+    defaultInterface.startTransmitScheduler (max_load, max_queue, burst_bits)
+
+def stopTransmitScheduler ():
+    defaultInterface.stopTransmitScheduler()
+
+def transmitQueueDepth ():
+    return defaultInterface.transmitQueueDepth()
+
+# The frame sending functions are the bound methods of defaultInterface, so that a frame sent by the module
+# functions costs no extra Python call. defaultInterface is never replaced (setup opens its bus)
+
+# Send one CBUS frame (see CBUSInterface.sendFrame)
+sendFrame = defaultInterface.sendFrame
+
+# Send a list of CBUS frames in one call (see CBUSInterface.sendMany)
+sendMany = defaultInterface.sendMany
+
+# Send a python-can Msg as is (see CBUSInterface.sendMessage)
+sendMessage = defaultInterface.sendMessage
+
+# *** CBUS control messages ***
+setTrackPower = defaultInterface.setTrackPower
+requestSession = defaultInterface.requestSession
+getSession = defaultInterface.getSession
+releaseSession = defaultInterface.releaseSession
+
+# speed_mode : 0 to 3
+# service_mode : False / True
+# sound_control_mode : False / True
+setCABSessionMode = defaultInterface.setCABSessionMode
+
+keepAliveSession = defaultInterface.keepAliveSession
+setSpeedAndDirection = defaultInterface.setSpeedAndDirection
+emergencyStop = defaultInterface.emergencyStop
+
+# *** LOCO DECODER FUNCTIONS ***
+setEngineFunction = defaultInterface.setEngineFunction
+
+# Set all functions of a group (see encodeEngineFunctionGroup)
+setEngineFunctionGroup = defaultInterface.setEngineFunctionGroup
+
+# *** NODE VARIABLES READ/WRITE ***
+setNodeVariable = defaultInterface.setNodeVariable
+readNodeVariable = defaultInterface.readNodeVariable
+
+# *** TEACHING EVENTS AND EVENT VARIABLES ***
+activateLearnMode = defaultInterface.activateLearnMode
+
+# For teaching device numbers using device addressing, node_number must be 0. event_number shall contain then the device address
+sendEventToLearn = defaultInterface.sendEventToLearn
+
+exitLearnMode = defaultInterface.exitLearnMode
+removeEvent = defaultInterface.removeEvent
+
+# Node must be in learn mode
+clearAllEvents = defaultInterface.clearAllEvents
+
+# *** ACCESSORY EVENT REQUEST ***
+accessoryRequestEventLong = defaultInterface.accessoryRequestEventLong
+accessoryRequestEventShort = defaultInterface.accessoryRequestEventShort
+
+# data can be None or array of 1, 2 or 3 data bytes
+accessoryEventLong = defaultInterface.accessoryEventLong
+accessoryEventShort = defaultInterface.accessoryEventShort
+
 # *** MISCELLANEOUS ***
-def queryAllNodes ():
-    msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_QNN], is_extended_id=False)
-    bus.send(msg)
-    
-def readAllEvents (node_number):
-    msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_NERD, node_number>>8, node_number&0xFF], is_extended_id=False)
-    bus.send(msg)
-                       
-def readEventFromNumber (node_number, event_number):
-    if event_number < 0 or event_number > 255:
-        return
-    msg = can.Message (arbitration_id=CBUS_ID, data=[OPC_NENRD, node_number>>8, node_number&0xFF, \
-                                                     event_number], is_extended_id=False)
-    bus.send(msg)
\ No newline at end of file
+queryAllNodes = defaultInterface.queryAllNodes
+readAllEvents = defaultInterface.readAllEvents
+readEventFromNumber = defaultInterface.readEventFromNumber
+
+# Only the node in setup mode answers
+requestModuleName = defaultInterface.requestModuleName
+
+readNumberOfEvents = defaultInterface.readNumberOfEvents
+
+# event_index is the index of the event in the node table (as given by OPC_ENRSP)
+readEventVariable = defaultInterface.readEventVariable
+
+readNodeParameter = defaultInterface.readNodeParameter
+enterBootMode = defaultInterface.enterBootMode
@@ -0,0 +1,122 @@
+# pyCBUS_accessories.py
+# Local index of accessory states
+#
+# AccessoryStateIndex records every accessory event seen on the bus or sent by this program
+# (ACON/ACOF, ASON/ASOF, ARON/AROF, ARSON/ARSOF with 0 to 3 data bytes), so the last known state
+# of a turnout or a sensor can be read without any bus traffic. A status request (OPC_AREQ / OPC_ASRQ)
+# is only sent when the state is unknown or older than the accepted age
+# The pyCBUS receiver must be running (pyCBUS.startReceiver)
+#
+#   index = AccessoryStateIndex()
+#   if index.queryLongEvent (1234, 5, max_age = 60).is_on:
+#       ...
+
+import threading
+import time
+from array import array
+from collections import namedtuple
+import pyCBUS
+from pyCBUS_requests import RequestTracker
+
+# State of an accessory : is_on, data bytes sent with the last event (tuple), time of the last event (time.time())
+AccessoryState = namedtuple ('AccessoryState', 'is_on data timestamp')
+
+# Short events are identified by their device number only : they are stored with this bit set in the key,
+# long events are stored with key (node number << 16) | event number
+_SHORT_EVENT_KEY = 1 << 32
+
+_ACCESSORY_OPCODES = [opcode for opcodes in pyCBUS.ACCESSORY_OPCODES.values() for opcode in opcodes]
+_LONG_RESPONSES = pyCBUS.ACCESSORY_OPCODES[(False, True, True)] + pyCBUS.ACCESSORY_OPCODES[(False, True, False)]
+_SHORT_RESPONSES = pyCBUS.ACCESSORY_OPCODES[(True, True, True)] + pyCBUS.ACCESSORY_OPCODES[(True, True, False)]
+
+class AccessoryStateIndex:
+    # tracker : RequestTracker used for the status requests, a new one is created on interface
+    # (pyCBUS module by default) if None
+    def __init__ (self, tracker = None, interface = None):
+        if tracker == None:
+            tracker = RequestTracker (interface)
+            self.own_tracker = True
+        else:
+            self.own_tracker = False
+        self.tracker = tracker
+        self.interface = tracker.interface
+        self.lock = threading.Lock()
+        # Each accessory gets a slot in the arrays below, slots[key] gives the slot of an accessory
+        self.slots = {}
+        self.states = array ('B')
+        self.timestamps = array ('d')
+        self.data = []
+        for opcode in _ACCESSORY_OPCODES:
+            self.interface.addMessageHandler (opcode, self._onAccessoryEvent)
+        self.interface.addSendHandler (self._onFrameSent)
+
+    def close (self):
+        for opcode in _ACCESSORY_OPCODES:
+            self.interface.removeMessageHandler (opcode, self._onAccessoryEvent)
+        self.interface.removeSendHandler (self._onFrameSent)
+        if self.own_tracker:
+            self.tracker.close()
+
+    def _record (self, event):
+        if event.is_short:
+            key = _SHORT_EVENT_KEY | event.event_number
+        else:
+            key = (event.node_number << 16) | event.event_number
+        with self.lock:
+            slot = self.slots.get (key)
+            if slot == None:
+                self.slots[key] = len (self.states)
+                self.states.append (event.is_on)
+                self.timestamps.append (time.time())
+                self.data.append (event.data)
+            else:
+                self.states[slot] = event.is_on
+                self.timestamps[slot] = time.time()
+                self.data[slot] = event.data
+
+    def _onAccessoryEvent (self, msg):
+        self._record (pyCBUS.decodeCBUSMessage (msg))
+
+    def _onFrameSent (self, msg):
+        event = pyCBUS.decodeCBUSMessage (msg)
+        if type (event) == pyCBUS.AccessoryEvent:
+            self._record (event)
+
+    def _get (self, key):
+        with self.lock:
+            slot = self.slots.get (key)
+            if slot == None:
+                return None
+            return AccessoryState (self.states[slot] != 0, self.data[slot], self.timestamps[slot])
+
+    # Return the last known state (AccessoryState) of a long event, or None if it is unknown
+    def getLongEvent (self, node_number, event_number):
+        return self._get ((node_number << 16) | event_number)
+
+    # Return the last known state (AccessoryState) of a short event, or None if it is unknown
+    def getShortEvent (self, device_number):
+        return self._get (_SHORT_EVENT_KEY | device_number)
+
+    # Return the state of a long event. If it is unknown or older than max_age seconds,
+    # it is requested from the producer node with OPC_AREQ
+    def queryLongEvent (self, node_number, event_number, max_age = None, timeout = 1.0, retries = 1):
+        state = self.getLongEvent (node_number, event_number)
+        if state != None and (max_age == None or time.time() - state.timestamp <= max_age):
+            return state
+        answers = [(opcode, node_number, event_number) for opcode in _LONG_RESPONSES]
+        answer = self.tracker.request (pyCBUS.encodeAccessoryRequestEventLong (node_number, event_number), answers, \
+                                       timeout, retries).result()
+        self._record (answer)    # The answer can be given by the tracker before it is recorded by _onAccessoryEvent
+        return self.getLongEvent (node_number, event_number)
+
+    # Return the state of a short event. If it is unknown or older than max_age seconds,
+    # it is requested with OPC_ASRQ (node_number is the node number of the requester)
+    def queryShortEvent (self, node_number, device_number, max_age = None, timeout = 1.0, retries = 1):
+        state = self.getShortEvent (device_number)
+        if state != None and (max_age == None or time.time() - state.timestamp <= max_age):
+            return state
+        answers = [(opcode, None, device_number) for opcode in _SHORT_RESPONSES]
+        answer = self.tracker.request (pyCBUS.encodeAccessoryRequestEventShort (node_number, device_number), answers, \
+                                       timeout, retries).result()
+        self._record (answer)
+        return self.getShortEvent (device_number)
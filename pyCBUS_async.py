@@ -0,0 +1,186 @@
+# pyCBUS_async.py
+# asyncio client for MERG CBUS, to be used by programs running an asyncio event loop
+#
+# The client owns its python-can bus. Received frames are read by the event loop itself when the
+# bus exposes a file descriptor (SocketCAN, vcan), otherwise python-can uses a helper thread
+# (virtual bus). Example :
+#
+#   async with AsyncCBUSClient (channel='vcan0') as client:
+#       await client.send ([pyCBUS.OPC_RTON])
+#       value = await client.readNodeVariable (1234, 1)
+#       async for frame in client:
+#           pyCBUS.dumpCBUSMessage (frame)
+
+import asyncio
+import can
+import pyCBUS
+from pyCBUS_sessions import SessionError
+
+class AsyncCBUSClient:
+    # bus : an already opened python-can bus (for example can.Bus (interface='virtual')). If None,
+    # the client opens channel/bustype itself and closes it when the client is closed
+    # can_id : CBUS CAN identifier (priority bits included). If None, pyCBUS.CBUS_ID is used
+    # queue_size : number of received frames kept for "async for". Oldest frames are dropped when
+    # the application does not read them fast enough (see dropped_frames)
+    def __init__ (self, channel = 'can0', bustype = 'socketcan', can_id = None, bus = None, queue_size = 1000):
+        self.channel = channel
+        self.bustype = bustype
+        self.can_id = can_id
+        self.bus = bus
+        self.own_bus = bus == None
+        self.queue_size = queue_size
+        self.queue = None
+        self.notifier = None
+        self.waiters = []
+        self.dropped_frames = 0
+
+    async def __aenter__ (self):
+        await self.open()
+        return self
+
+    async def __aexit__ (self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def open (self):
+        if self.bus == None:
+            self.bus = can.interface.Bus (channel = self.channel, interface = self.bustype)
+        self.queue = asyncio.Queue (maxsize = self.queue_size)
+        self.notifier = can.Notifier (self.bus, [self._onMessage], loop = asyncio.get_running_loop())
+
+    async def close (self):
+        if self.notifier != None:
+            self.notifier.stop()
+            self.notifier = None
+        for waiter in self.waiters:
+            if not waiter[2].done():
+                waiter[2].cancel()
+        self.waiters = []
+        if self.own_bus and self.bus != None:
+            self.bus.shutdown()
+            self.bus = None
+
+    # Called by the event loop for each received frame
+    def _onMessage (self, msg):
+        if not msg.is_extended_id and msg.dlc > 0:
+            opcode = msg.data[0]
+            for waiter in self.waiters:
+                opcodes, match, future = waiter
+                if opcode in opcodes and not future.done() and (match == None or match (msg)):
+                    future.set_result (msg)
+                    break
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped_frames = self.dropped_frames + 1
+        self.queue.put_nowait (msg)
+
+    def __aiter__ (self):
+        return self
+
+    async def __anext__ (self):
+        return await self.queue.get()
+
+    # Send one CBUS frame. data is the list of bytes of the frame, opcode first
+    async def send (self, data):
+        if self.can_id == None:
+            can_id = pyCBUS.CBUS_ID
+        else:
+            can_id = self.can_id
+        msg = can.Message (arbitration_id=can_id, data=data, is_extended_id=False)
+        retry = 0
+        while True:
+            try:
+                self.bus.send (msg, timeout = 0)
+                return
+            except can.CanOperationError:
+                # SocketCAN transmit buffer is full : give time to the bus to drain it
+                retry = retry + 1
+                if retry > 100:
+                    raise
+                await asyncio.sleep (0.001)
+
+    # Send a frame and wait for the first received frame with an opcode in response_opcodes
+    # match is an optional function called with the candidate frame, returning True if it is the answer
+    # Raises asyncio.TimeoutError if no answer is received within timeout seconds
+    async def request (self, data, response_opcodes, match = None, timeout = 1.0):
+        future = asyncio.get_running_loop().create_future()
+        waiter = (response_opcodes, match, future)
+        self.waiters.append (waiter)
+        try:
+            await self.send (data)
+            return await asyncio.wait_for (future, timeout)
+        finally:
+            self.waiters.remove (waiter)
+
+    # Same as request, for node configuration requests : a matching OPC_CMDERR from the node
+    # raises pyCBUS.CBUSCommandError
+    async def _nodeRequest (self, node_number, data, response_opcode, match, timeout):
+        def matchAnswer (msg):
+            if msg.data[1] != node_number>>8 or msg.data[2] != node_number&0xFF:
+                return False
+            if msg.data[0] == pyCBUS.OPC_CMDERR or match == None:
+                return True
+            return match (msg)
+        answer = await self.request (data, (response_opcode, pyCBUS.OPC_CMDERR), matchAnswer, timeout)
+        if answer.data[0] == pyCBUS.OPC_CMDERR:
+            raise pyCBUS.CBUSCommandError (node_number, answer.data[3])
+        return answer
+
+    # *** AWAITABLE REQUESTS ***
+    # Return the value of a node variable (OPC_NVRD -> OPC_NVANS)
+    async def readNodeVariable (self, node_number, variable_number, timeout = 1.0):
+        answer = await self._nodeRequest (node_number, pyCBUS.encodeReadNodeVariable (node_number, variable_number), \
+                                          pyCBUS.OPC_NVANS, lambda msg: msg.data[3] == variable_number, timeout)
+        return answer.data[4]
+
+    # Write a node variable and wait for the node acknowledge (OPC_NVSET -> OPC_WRACK)
+    # Raises ValueError for variable numbers outside 1 to 255
+    async def setNodeVariable (self, node_number, variable_number, variable_value, timeout = 1.0):
+        frame = pyCBUS.encodeSetNodeVariable (node_number, variable_number, variable_value)
+        if frame == None:
+            raise ValueError ('Invalid node variable number %d' % variable_number)
+        await self._nodeRequest (node_number, frame, pyCBUS.OPC_WRACK, None, timeout)
+
+    # Return a node parameter (OPC_RQNPN -> OPC_PARAN)
+    async def readNodeParameter (self, node_number, parameter_index, timeout = 1.0):
+        answer = await self._nodeRequest (node_number, pyCBUS.encodeReadNodeParameter (node_number, parameter_index), \
+                                          pyCBUS.OPC_PARAN, lambda msg: msg.data[3] == parameter_index, timeout)
+        return answer.data[4]
+
+    # Return the number of events stored in a node (OPC_RQEVN -> OPC_NUMEV)
+    async def readNumberOfEvents (self, node_number, timeout = 1.0):
+        answer = await self._nodeRequest (node_number, pyCBUS.encodeReadNumberOfEvents (node_number), \
+                                          pyCBUS.OPC_NUMEV, None, timeout)
+        return answer.data[3]
+
+    # Request an engine session (OPC_RLOC) and return the OPC_PLOC frame sent by the command station
+    # Raises pyCBUS_sessions.SessionError if the command station answers with OPC_ERR (address taken, stack full, ...),
+    # asyncio.TimeoutError if it does not answer, ValueError for addresses above 10239
+    async def requestSession (self, dcc_loc_number, timeout = 1.0):
+        frame = pyCBUS.encodeRequestSession (dcc_loc_number)
+        if frame == None:
+            raise ValueError ('Invalid loco address %d' % dcc_loc_number)
+        def matchAnswer (msg):
+            if msg.data[0] == pyCBUS.OPC_ERR:
+                return msg.dlc >= 4 and msg.data[1] == frame[1] and msg.data[2] == frame[2]
+            return msg.dlc >= 4 and msg.data[2] == frame[1] and msg.data[3] == frame[2]
+        answer = await self.request (frame, (pyCBUS.OPC_PLOC, pyCBUS.OPC_ERR), matchAnswer, timeout)
+        if answer.data[0] == pyCBUS.OPC_ERR:
+            raise SessionError (dcc_loc_number, answer.data[3])
+        return answer
+
+    # Send OPC_QNN and return the list of OPC_PNN frames received during duration seconds
+    async def queryAllNodes (self, duration = 1.0):
+        answers = []
+        loop = asyncio.get_running_loop()
+        end = loop.time() + duration
+        def collect (msg):
+            answers.append (msg)
+            return False        # Never completes the request : keep collecting until the end
+        waiter = ((pyCBUS.OPC_PNN,), collect, loop.create_future())
+        self.waiters.append (waiter)
+        try:
+            await self.send ([pyCBUS.OPC_QNN])
+            await asyncio.sleep (max (0, end - loop.time()))
+        finally:
+            self.waiters.remove (waiter)
+        return answers
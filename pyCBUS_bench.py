@@ -0,0 +1,330 @@
+# pyCBUS_bench.py
+# Benchmarks of pyCBUS message processing
+# Run it on the target computer (Raspberry Pi) to get representative numbers : python3 pyCBUS_bench.py
+# No CBUS hardware is needed : frames are sent on python-can virtual bus (default), or on a Linux vcan interface :
+#   sudo ip link add dev vcan0 type vcan && sudo ip link set up vcan0
+#   python3 pyCBUS_bench.py --channel vcan0 --bustype socketcan --json results.json
+# Results are also written as JSON, so they can be compared between versions
+
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+import can
+import pyCBUS
+from pyCBUS_metrics import BusMetrics
+from pyCBUS_requests import RequestTracker
+
+# Frames representative of a busy layout : accessory events, node configuration and loco control
+SAMPLE_FRAMES = [
+    bytes ([pyCBUS.OPC_ACON, 0x04, 0xD2, 0x00, 0x01]),
+    bytes ([pyCBUS.OPC_ACOF, 0x04, 0xD2, 0x00, 0x01]),
+    bytes ([pyCBUS.OPC_ASON1, 0x00, 0x10, 0x01, 0x20, 0x55]),
+    bytes ([pyCBUS.OPC_ARON2, 0x04, 0xD2, 0x00, 0x02, 0x11, 0x22]),
+    bytes ([pyCBUS.OPC_NVANS, 0x04, 0xD2, 0x05, 0x80]),
+    bytes ([pyCBUS.OPC_ENRSP, 0x04, 0xD2, 0x00, 0x64, 0x00, 0x01, 0x03]),
+    bytes ([pyCBUS.OPC_DSPD, 0x01, 0x85]),
+    bytes ([pyCBUS.OPC_PLOC, 0x01, 0xC4, 0xD2, 0x85, 0x00, 0x00, 0x00]),
+    bytes ([pyCBUS.OPC_DKEEP, 0x01]),
+    bytes ([pyCBUS.OPC_WRACK, 0x04, 0xD2]),
+]
+
+# Decode frames one by one with decodeCBUSMessage
+def benchDecode (count):
+    frames = SAMPLE_FRAMES * (count // len (SAMPLE_FRAMES))
+    decode = pyCBUS.decodeCBUSMessage
+    start = time.perf_counter()
+    for frame in frames:
+        decode (frame)
+    return len (frames) / (time.perf_counter() - start)
+
+# Decode frames by lists of 100 frames with decodeCBUSMessages
+def benchDecodeBatch (count):
+    frames = SAMPLE_FRAMES * 10
+    batches = count // len (frames)
+    start = time.perf_counter()
+    for batch in range (batches):
+        pyCBUS.decodeCBUSMessages (frames)
+    return batches * len (frames) / (time.perf_counter() - start)
+
+# Accessory event helper as it was implemented before the encoder layer, used as reference
+def legacyAccessoryEventLong (node_number, event_number, isON, data):
+    if data == None:
+        if isON == False:
+            msg = can.Message (arbitration_id=pyCBUS.CBUS_ID, data=[pyCBUS.OPC_ACOF, node_number>>8, node_number&0xFF, \
+                                                                    event_number>>8, event_number&0xFF], \
+                               is_extended_id=False)
+        else:
+            msg = can.Message (arbitration_id=pyCBUS.CBUS_ID, data=[pyCBUS.OPC_ACON, node_number>>8, node_number&0xFF, \
+                                                                    event_number>>8, event_number&0xFF], \
+                               is_extended_id=False)
+    else:
+        datalen = len(data)
+        if datalen == 1:
+            if isON == False:
+                msg = can.Message (arbitration_id=pyCBUS.CBUS_ID, data=[pyCBUS.OPC_ACOF1, node_number>>8, node_number&0xFF, \
+                                                                        event_number>>8, event_number&0xFF, data[0]], \
+                                   is_extended_id=False)
+            else:
+                msg = can.Message (arbitration_id=pyCBUS.CBUS_ID, data=[pyCBUS.OPC_ACON1, node_number>>8, node_number&0xFF, \
+                                                                        event_number>>8, event_number&0xFF, data[0]], \
+                                   is_extended_id=False)
+        else:
+            return    # Only 0 and 1 data bytes are used by the benchmark
+    pyCBUS.bus.send (msg)
+
+# Accessory events sent one by one with the legacy helper
+def benchLegacyAccessoryEvents (count):
+    start = time.perf_counter()
+    for event in range (count):
+        legacyAccessoryEventLong (1234, event & 0xFF, (event & 1) == 0, None)
+    return count / (time.perf_counter() - start)
+
+# Accessory events sent one by one with pyCBUS.accessoryEventLong
+def benchAccessoryEvents (count):
+    start = time.perf_counter()
+    for event in range (count):
+        pyCBUS.accessoryEventLong (1234, event & 0xFF, (event & 1) == 0, None)
+    return count / (time.perf_counter() - start)
+
+# Accessory events encoded then sent by bursts of 100 events with pyCBUS.sendMany
+def benchAccessoryEventsBurst (count):
+    encode = pyCBUS.encodeAccessoryEventLong
+    start = time.perf_counter()
+    for burst in range (count // 100):
+        pyCBUS.sendMany ([encode (1234, event, (event & 1) == 0, None) for event in range (100)])
+    return (count // 100) * 100 / (time.perf_counter() - start)
+
+# Helpers measured by benchHelpers : name -> (encoder, helper, arguments for iteration i)
+HELPERS = {
+    'accessoryEventLong': (pyCBUS.encodeAccessoryEventLong, pyCBUS.accessoryEventLong, lambda i: (1234, i & 0xFF, (i & 1) == 0, None)),
+    'accessoryEventShort': (pyCBUS.encodeAccessoryEventShort, pyCBUS.accessoryEventShort, lambda i: (1234, i & 0xFF, (i & 1) == 0, [i & 0xFF])),
+    'setNodeVariable': (pyCBUS.encodeSetNodeVariable, pyCBUS.setNodeVariable, lambda i: (1234, (i & 0x7F) + 1, i & 0xFF)),
+    'readNodeVariable': (pyCBUS.encodeReadNodeVariable, pyCBUS.readNodeVariable, lambda i: (1234, (i & 0x7F) + 1)),
+    'setSpeedAndDirection': (pyCBUS.encodeSpeedAndDirection, pyCBUS.setSpeedAndDirection, lambda i: (1, i & 0x7F, (i & 1) == 0)),
+    'setEngineFunction': (pyCBUS.encodeEngineFunction, pyCBUS.setEngineFunction, lambda i: (1, i % 29, (i & 1) == 0)),
+    'keepAliveSession': (pyCBUS.encodeKeepAliveSession, pyCBUS.keepAliveSession, lambda i: (i & 0xFF,)),
+    'sendEventToLearn': (pyCBUS.encodeEventToLearn, pyCBUS.sendEventToLearn, lambda i: (1234, i & 0xFF, 1, i & 0xFF)),
+}
+
+# Encode and send throughput of each helper, in frames per second
+# Arguments are built before the measure, so only the encoder (and the send path for helpers) is measured
+def benchHelpers (count):
+    results = {}
+    for name, (encoder, helper, arguments) in HELPERS.items():
+        calls = [arguments (i) for i in range (count)]
+        start = time.perf_counter()
+        for call in calls:
+            encoder (*call)
+        encode_rate = count / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for call in calls:
+            helper (*call)
+        results[name] = {'encode': encode_rate, 'send': count / (time.perf_counter() - start)}
+    return results
+
+# Simulated CBUS node answering configuration requests, on its own python-can bus (same channel as pyCBUS)
+# It also counts all the frames it receives and the time of the last OPC_RESTP (emergency stop) received
+class ResponderNode:
+    def __init__ (self, channel, bustype, node_number = 1234):
+        self.bus = can.Bus (interface = bustype, channel = channel)
+        self.node_number = node_number
+        self.received = 0
+        self.estop_time = 0
+        self.estop_event = threading.Event()
+        self.notifier = can.Notifier (self.bus, [self._onMessage], timeout=1.0)
+
+    def close (self):
+        self.notifier.stop()
+        self.bus.shutdown()
+
+    def _answer (self, data):
+        self.bus.send (can.Message (arbitration_id=0x7F, data=data, is_extended_id=False))
+
+    def _onMessage (self, msg):
+        self.received = self.received + 1
+        if msg.dlc == 0 or msg.is_extended_id:
+            return
+        data = msg.data
+        opcode = data[0]
+        if opcode == pyCBUS.OPC_RESTP:
+            self.estop_time = time.perf_counter()
+            self.estop_event.set()
+            return
+        if msg.dlc < 3 or (data[1] << 8) | data[2] != self.node_number:
+            return
+        if opcode == pyCBUS.OPC_NVRD:
+            self._answer (bytes ([pyCBUS.OPC_NVANS, data[1], data[2], data[3], data[3]]))
+        elif opcode == pyCBUS.OPC_RQNPN:
+            self._answer (bytes ([pyCBUS.OPC_PARAN, data[1], data[2], data[3], 0]))
+        elif opcode == pyCBUS.OPC_NVSET:
+            self._answer (bytes ([pyCBUS.OPC_WRACK, data[1], data[2]]))
+
+# Frames received through the pyCBUS receiver (receive thread, dispatch, decode) in frames per second
+# The frames are sent by a second python-can bus on the same channel
+def benchReceive (count, channel, bustype):
+    sender = can.Bus (interface = bustype, channel = channel)
+    received = [0]
+    done = threading.Event()
+    def onFrame (msg):
+        pyCBUS.decodeCBUSMessage (msg)
+        received[0] = received[0] + 1
+        if received[0] == count:
+            done.set()
+    pyCBUS.addMessageHandler (None, onFrame)
+    messages = [can.Message (arbitration_id=0x7F, data=SAMPLE_FRAMES[i % len (SAMPLE_FRAMES)], is_extended_id=False) \
+                for i in range (count)]
+    try:
+        start = time.perf_counter()
+        for msg in messages:
+            while True:
+                try:
+                    sender.send (msg)
+                    break
+                except can.CanOperationError:
+                    time.sleep (0.0005)    # Socket transmit buffer full (vcan)
+        done.wait (30)
+        return {'frames_per_second': received[0] / (time.perf_counter() - start), 'lost': count - received[0]}
+    finally:
+        pyCBUS.removeMessageHandler (None, onFrame)
+        sender.shutdown()
+
+def _percentile (values, fraction):
+    return values[min (len (values) - 1, int (len (values) * fraction))]
+
+# Request -> answer latency through the responder node, in milliseconds
+# window : number of requests in flight (1 : requests sent one by one)
+def benchLatency (count, window = 1):
+    tracker = RequestTracker()
+    try:
+        latencies = []
+        def timedRead (variable):
+            sent = time.perf_counter()
+            future = tracker.readNodeVariable (1234, variable)
+            future.add_done_callback (lambda future: latencies.append (time.perf_counter() - sent))
+            return future
+        start = time.perf_counter()
+        tracker.pipeline ([(i % 255) + 1 for i in range (count)], timedRead, window)
+        duration = time.perf_counter() - start
+        latencies.sort()
+        return {'requests_per_second': count / duration, 'min_ms': latencies[0] * 1000, \
+                'median_ms': _percentile (latencies, 0.5) * 1000, 'p99_ms': _percentile (latencies, 0.99) * 1000, \
+                'max_ms': latencies[-1] * 1000}
+    finally:
+        tracker.close()
+
+# Accessory events sent as fast as possible during duration seconds through the transmit scheduler,
+# which limits the bus load to max_load of the CBUS bitrate. Measures the frames sent, the bus load estimated by
+# BusMetrics, the transmit queue depth, the frames lost by the responder and the latency of an emergency stop
+# sent while the queue is full
+def benchSustainedLoad (duration, responder, max_load = 1.0):
+    metrics = BusMetrics (window = max (1, int (duration)))
+    pyCBUS.startTransmitScheduler (max_load = max_load)
+    stop = threading.Event()
+    submitted = [0]
+    def produce ():
+        event = 0
+        while not stop.is_set():
+            if pyCBUS.sendFrame (pyCBUS.encodeAccessoryEventLong (1234, event & 0xFFFF, True, None), timeout = 0.1):
+                submitted[0] = submitted[0] + 1
+            event = event + 1
+    received_before = responder.received
+    producer = threading.Thread (target=produce, daemon=True)
+    start = time.perf_counter()
+    producer.start()
+    max_depth = 0
+    estop_latency = None
+    while time.perf_counter() - start < duration:
+        time.sleep (0.05)
+        max_depth = max (max_depth, pyCBUS.transmitQueueDepth())
+        if estop_latency == None and time.perf_counter() - start > duration / 2:
+            responder.estop_event.clear()
+            sent = time.perf_counter()
+            pyCBUS.emergencyStop()
+            if responder.estop_event.wait (1.0):
+                estop_latency = (responder.estop_time - sent) * 1000
+    stop.set()
+    producer.join()
+    pyCBUS.stopTransmitScheduler()    # Sends the frames still queued
+    elapsed = time.perf_counter() - start
+    time.sleep (0.2)
+    snapshot = metrics.snapshot()
+    metrics.close()
+    sent = snapshot['tx_frames']
+    return {'frames_per_second': sent / elapsed, 'bus_load': snapshot['bits'] / (elapsed * pyCBUS.CAN_BITRATE), \
+            'max_queue_depth': max_depth, 'lost': sent - (responder.received - received_before), \
+            'estop_latency_ms': estop_latency}
+
+# Progress messages are written to stderr, so the JSON results can be written to stdout
+def _progress (text):
+    print (text, file = sys.stderr)
+
+# Run all the benchmarks and return the results in a dictionary
+# channel, bustype : python-can channel and interface used for the send and receive benchmarks
+# The benchmarks run on the default interface of pyCBUS, which must not have its receiver or transmit scheduler running.
+# Its bus is replaced by a bus opened on channel during the benchmarks, and restored afterwards
+def runBenchmarks (count = 200000, channel = 'pyCBUS_bench', bustype = 'virtual', duration = 5.0):
+    if pyCBUS.defaultInterface.receiver != 0 or pyCBUS.defaultInterface.transmitScheduler != 0:
+        raise RuntimeError ('Stop the pyCBUS receiver and transmit scheduler before running the benchmarks')
+    results = {'python': platform.python_version(), 'python_can': can.__version__, 'machine': platform.machine(), \
+               'bustype': bustype, 'time': time.strftime ('%Y-%m-%dT%H:%M:%S'), 'count': count}
+    results['decode'] = benchDecode (count)
+    results['decode_batch'] = benchDecodeBatch (count)
+    _progress ('Decode, one frame per call    : %.0f frames/s' % results['decode'])
+    _progress ('Decode, batches of 100 frames : %.0f frames/s' % results['decode_batch'])
+    # Without responder, frames sent on the bus are not received by anybody,
+    # so only pyCBUS and python-can overhead is measured
+    previous_bus = pyCBUS.defaultInterface.bus
+    previous_gpio = pyCBUS.GPIO
+    pyCBUS.setup (channel, bustype, canpicap = False)
+    try:
+        results['legacy_accessory_events'] = benchLegacyAccessoryEvents (count)
+        results['accessory_events'] = benchAccessoryEvents (count)
+        results['accessory_events_burst'] = benchAccessoryEventsBurst (count)
+        _progress ('Accessory events, legacy helper      : %.0f frames/s' % results['legacy_accessory_events'])
+        _progress ('Accessory events, accessoryEventLong : %.0f frames/s' % results['accessory_events'])
+        _progress ('Accessory events, sendMany bursts    : %.0f frames/s' % results['accessory_events_burst'])
+        results['helpers'] = benchHelpers (count // 4)
+        for name, rates in results['helpers'].items():
+            _progress ('%-22s : encode %.0f frames/s, send %.0f frames/s' % (name, rates['encode'], rates['send']))
+        pyCBUS.startReceiver()
+        results['receive'] = benchReceive (count // 4, channel, bustype)
+        _progress ('Receive and decode : %.0f frames/s, %d lost' % (results['receive']['frames_per_second'], results['receive']['lost']))
+        responder = ResponderNode (channel, bustype)
+        try:
+            results['latency'] = benchLatency (2000)
+            results['latency_window16'] = benchLatency (2000, 16)
+            for name in ('latency', 'latency_window16'):
+                latency = results[name]
+                _progress ('NVRD -> NVANS (%s) : %.0f requests/s, median %.3f ms, p99 %.3f ms' % \
+                       (name, latency['requests_per_second'], latency['median_ms'], latency['p99_ms']))
+            results['sustained_load'] = benchSustainedLoad (duration, responder)
+            load = results['sustained_load']
+            _progress ('Sustained load : %.0f frames/s, bus load %.2f, max queue %d, %d lost' % \
+                   (load['frames_per_second'], load['bus_load'], load['max_queue_depth'], load['lost']))
+            if load['estop_latency_ms'] != None:
+                _progress ('Emergency stop latency under load : %.3f ms' % load['estop_latency_ms'])
+        finally:
+            responder.close()
+    finally:
+        pyCBUS.defaultInterface.shutdown()
+        pyCBUS.setup (bus = previous_bus, canpicap = False)
+        pyCBUS.GPIO = previous_gpio
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser (description = 'pyCBUS benchmarks')
+    parser.add_argument ('--channel', default = 'pyCBUS_bench', help = 'python-can channel (default : virtual bus)')
+    parser.add_argument ('--bustype', default = 'virtual', help = 'python-can interface, for example socketcan for vcan0')
+    parser.add_argument ('--count', type = int, default = 200000, help = 'number of frames of the throughput benchmarks')
+    parser.add_argument ('--duration', type = float, default = 5.0, help = 'duration of the sustained load benchmark, in seconds')
+    parser.add_argument ('--json', help = 'file receiving the results in JSON format (- for standard output)')
+    arguments = parser.parse_args()
+    results = runBenchmarks (arguments.count, arguments.channel, arguments.bustype, arguments.duration)
+    if arguments.json == '-':
+        json.dump (results, sys.stdout, indent = 2)
+    elif arguments.json != None:
+        with open (arguments.json, 'w') as output:
+            json.dump (results, output, indent = 2)
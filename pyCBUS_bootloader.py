@@ -0,0 +1,357 @@
+# pyCBUS_bootloader.py
+# Firmware upload to CBUS nodes through the MERG CBUS bootloader
+#
+# The node is put in boot mode with OPC_BOOTM, then the bootloader is driven with extended CAN frames :
+#   control frames (ID 0x00000004) : address (3 bytes), reserved, control bits, command, checksum (2 bytes)
+#   data frames (ID 0x00000005) : 8 bytes written at the current address, which is then incremented
+#   replies (ID 0x10000004) : 1 byte, 1 = OK, 0 = error, 2 = boot mode confirmed
+# In acknowledge mode, the bootloader answers each data frame. BootloaderUploader keeps up to window data frames
+# waiting for their acknowledge, and checks the checksum of the whole image at the end (CMD_CHK_RUN).
+# Bootloader frames do not contain the node number : all the nodes of a CAN segment in boot mode would accept them,
+# so nodes of the same segment are updated one after the other. Nodes on different segments (one CBUSInterface
+# per segment) are updated at the same time by updateNodes
+# The pyCBUS receiver must be running (pyCBUS.startReceiver)
+#
+#   image = loadIntelHex ('CANACC5.hex')
+#   BootloaderUploader (window = 2, max_load = 0.3).uploadNode (1234, image)
+
+import threading
+import time
+import can
+import pyCBUS
+
+BOOT_CONTROL_ID = 0x00000004
+BOOT_DATA_ID = 0x00000005
+BOOT_REPLY_ID = 0x10000004
+
+# Control bits
+MODE_WRT_UNLCK = 0x01
+MODE_ERASE_ONLY = 0x02
+MODE_AUTO_ERASE = 0x04
+MODE_AUTO_INC = 0x08
+MODE_ACK = 0x10
+
+# Commands
+CMD_NOP = 0
+CMD_RESET = 1
+CMD_RST_CHKSM = 2
+CMD_CHK_RUN = 3
+CMD_BOOT_TEST = 4
+
+# Replies
+REPLY_ERROR = 0
+REPLY_OK = 1
+REPLY_BOOT = 2
+
+# PIC18 memory areas : the bootloader itself is below PROGRAM_START and is never written
+PROGRAM_START = 0x000800
+CONFIG_START = 0x300000
+EEPROM_START = 0xF00000
+
+# Exception raised when an upload fails
+class BootloaderError (Exception):
+    pass
+
+# *** INTEL HEX FILES ***
+# Firmware image : memory address -> byte value, as read from an Intel HEX file
+class FirmwareImage:
+    def __init__ (self, memory = None):
+        if memory == None:
+            memory = {}
+        self.memory = memory
+
+    # Return the 8 bytes blocks to write in [start, end[, as a list of (address, bytes)
+    # Blocks are aligned on 8 bytes, bytes missing in the image are written as 0xFF (erased flash)
+    def blocks (self, start, end):
+        addresses = sorted (set (address & ~7 for address in self.memory if start <= address < end))
+        return [(address, bytes (self.memory.get (address + offset, 0xFF) for offset in range (8))) for address in addresses]
+
+# Read an Intel HEX file (records 00 data, 01 end of file, 02 extended segment address, 04 extended linear address)
+def loadIntelHex (filename):
+    with open (filename, 'r') as hexfile:
+        return parseIntelHex (hexfile)
+
+# Parse the lines of an Intel HEX file and return a FirmwareImage. Raises ValueError for invalid lines
+def parseIntelHex (lines):
+    memory = {}
+    base = 0
+    for number, line in enumerate (lines, 1):
+        line = line.strip()
+        if line == '':
+            continue
+        if line[0] != ':':
+            raise ValueError ('Line %d is not an Intel HEX record' % number)
+        try:
+            record = bytes.fromhex (line[1:])
+        except ValueError:
+            raise ValueError ('Line %d is not an Intel HEX record' % number)
+        if len (record) < 5 or len (record) != record[0] + 5:
+            raise ValueError ('Invalid record length at line %d' % number)
+        if sum (record) & 0xFF != 0:
+            raise ValueError ('Invalid checksum at line %d' % number)
+        length = record[0]
+        offset = (record[1] << 8) | record[2]
+        record_type = record[3]
+        data = record[4:4 + length]
+        if record_type == 0x00:
+            for position, value in enumerate (data):
+                memory[base + offset + position] = value
+        elif record_type == 0x01:
+            break
+        elif record_type == 0x02:
+            base = ((data[0] << 8) | data[1]) << 4
+        elif record_type == 0x04:
+            base = ((data[0] << 8) | data[1]) << 16
+        # Start address records (03, 05) are not used by the bootloader
+    return FirmwareImage (memory)
+
+# *** UPLOAD ***
+# Token bucket limiting the bus load of the bootloader frames sent on an interface
+class _LoadBudget:
+    def __init__ (self, max_load, bitrate = pyCBUS.CAN_BITRATE):
+        self.rate = max_load * bitrate
+        self.burst_bits = 2 * pyCBUS.frameBits (8, True)
+        self.tokens = self.burst_bits
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Wait until bits can be sent
+    def take (self, bits):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min (self.burst_bits, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens = self.tokens - bits
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep (delay)
+
+class BootloaderUploader:
+    # window : number of data frames sent before their acknowledge is received. The PIC bootloader has few CAN
+    # receive buffers : keep it small on real hardware
+    # max_load : fraction of the bus bitrate used by the bootloader frames, so the layout keeps running during the upload
+    # timeout : time in seconds to wait for a bootloader reply. retries : number of times the whole image is sent again
+    # after an error (frames do not contain their address, so a lost frame can not be sent again alone)
+    # interface : object used to send frames and register the reply handler : pyCBUS module by default
+    def __init__ (self, window = 2, max_load = 0.3, timeout = 1.0, retries = 1, interface = None):
+        if interface == None:
+            interface = pyCBUS
+        self.interface = interface
+        self.window = window
+        self.budget = _LoadBudget (max_load)
+        self.timeout = timeout
+        self.retries = retries
+        self.lock = threading.Condition()
+        self.replies = []
+        self.busy = threading.Lock()    # One upload at a time per segment
+        self.interface.addMessageHandler (None, self._onFrame)
+
+    def close (self):
+        self.interface.removeMessageHandler (None, self._onFrame)
+
+    def _onFrame (self, msg):
+        if not msg.is_extended_id or msg.arbitration_id != BOOT_REPLY_ID or msg.dlc < 1:
+            return
+        with self.lock:
+            self.replies.append (msg.data[0])
+            self.lock.notify_all()
+
+    def _send (self, can_id, data):
+        self.budget.take (pyCBUS.frameBits (8, True))
+        self.interface.sendMessage (can.Message (arbitration_id=can_id, data=data, is_extended_id=True))
+
+    def _sendControl (self, address, control, command, checksum = 0):
+        self._send (BOOT_CONTROL_ID, bytes ([address & 0xFF, (address >> 8) & 0xFF, (address >> 16) & 0xFF, 0, \
+                                             control, command, checksum & 0xFF, (checksum >> 8) & 0xFF]))
+
+    # Wait for count replies, return them
+    def _waitReplies (self, count):
+        with self.lock:
+            if not self.lock.wait_for (lambda: len (self.replies) >= count, self.timeout):
+                raise BootloaderError ('No reply from bootloader')
+            replies = self.replies[:count]
+            del self.replies[:count]
+            return replies
+
+    def _clearReplies (self):
+        with self.lock:
+            self.replies = []
+
+    # Put a node in boot mode and check that the bootloader answers
+    def enterBootMode (self, node_number, boot_delay = 0.5):
+        self._clearReplies()
+        self.interface.sendFrame (pyCBUS.encodeBootMode (node_number))
+        time.sleep (boot_delay)    # Node restarts in its bootloader
+        for attempt in range (3):
+            self._clearReplies()
+            self._sendControl (0, 0, CMD_BOOT_TEST)
+            try:
+                if self._waitReplies (1)[0] == REPLY_BOOT:
+                    return
+            except BootloaderError:
+                pass
+        raise BootloaderError ('Node %d did not enter boot mode' % node_number)
+
+    # Send the blocks of an area, with up to window data frames waiting for their acknowledge
+    # Returns the sum of the bytes sent
+    def _sendBlocks (self, blocks, control, progress, done, total):
+        checksum = 0
+        address = None
+        in_flight = 0
+        for block_address, data in blocks:
+            if block_address != address:
+                # Gap in the image : wait for the frames in flight, then move the write address
+                for reply in self._waitReplies (in_flight):
+                    if reply != REPLY_OK:
+                        raise BootloaderError ('Bootloader write error')
+                in_flight = 0
+                self._sendControl (block_address, control, CMD_NOP)
+            if in_flight >= self.window:
+                if self._waitReplies (1)[0] != REPLY_OK:
+                    raise BootloaderError ('Bootloader write error')
+                in_flight = in_flight - 1
+            self._send (BOOT_DATA_ID, data)
+            in_flight = in_flight + 1
+            checksum = checksum + sum (data)
+            address = block_address + 8
+            done = done + 1
+            if progress != None:
+                progress (done, total)
+        for reply in self._waitReplies (in_flight):
+            if reply != REPLY_OK:
+                raise BootloaderError ('Bootloader write error')
+        return checksum
+
+    # Write an image in a node already in boot mode, check its checksum and restart the node
+    def writeImage (self, image, write_config = False, write_eeprom = False, progress = None):
+        areas = [image.blocks (PROGRAM_START, CONFIG_START)]
+        if write_config:
+            areas.append (image.blocks (CONFIG_START, CONFIG_START + 0x100))
+        if write_eeprom:
+            areas.append (image.blocks (EEPROM_START, EEPROM_START + 0x10000))
+        total = sum (len (blocks) for blocks in areas)
+        if total == 0:
+            raise BootloaderError ('Image has no program memory data')
+        control = MODE_WRT_UNLCK | MODE_AUTO_ERASE | MODE_AUTO_INC | MODE_ACK
+        self._clearReplies()
+        self._sendControl (areas[0][0][0], control, CMD_RST_CHKSM)
+        checksum = 0
+        done = 0
+        for blocks in areas:
+            checksum = checksum + self._sendBlocks (blocks, control, progress, done, total)
+            done = done + len (blocks)
+        # The bootloader adds the two's complement of the checksum of the data it received : the result must be 0
+        self._sendControl (0, control, CMD_CHK_RUN, (-checksum) & 0xFFFF)
+        if self._waitReplies (1)[0] != REPLY_OK:
+            raise BootloaderError ('Checksum error')
+        self._sendControl (0, 0, CMD_RESET)
+
+    # Put a node in boot mode and upload an image. The whole image is sent again up to retries times after an error
+    # progress : function called with (frames sent, total frames), None for no progress report
+    def uploadNode (self, node_number, image, write_config = False, write_eeprom = False, progress = None):
+        with self.busy:
+            self.enterBootMode (node_number)
+            for attempt in range (self.retries + 1):
+                try:
+                    self.writeImage (image, write_config, write_eeprom, progress)
+                    return
+                except BootloaderError:
+                    if attempt == self.retries:
+                        raise
+                    time.sleep (self.timeout)   # Let the late replies arrive before they are cleared
+
+# Update several nodes. jobs : list of (interface, node_number, image), interface being a CBUSInterface
+# (or the pyCBUS module). Nodes of the same interface are updated one after the other, interfaces in parallel
+# Each interface gets its own bus load budget (max_load), as each segment has its own bandwidth
+# Returns a dictionary (interface, node_number) -> None if the update succeeded, or the exception
+def updateNodes (jobs, window = 2, max_load = 0.3, timeout = 1.0, retries = 1, progress = None):
+    segments = {}
+    for interface, node_number, image in jobs:
+        segments.setdefault (interface, []).append ((node_number, image))
+    results = {}
+    def updateSegment (interface, nodes):
+        uploader = BootloaderUploader (window, max_load, timeout, retries, interface)
+        try:
+            for node_number, image in nodes:
+                try:
+                    if progress == None:
+                        uploader.uploadNode (node_number, image)
+                    else:
+                        uploader.uploadNode (node_number, image, progress = lambda done, total: progress (node_number, done, total))
+                    results[(interface, node_number)] = None
+                except Exception as error:
+                    results[(interface, node_number)] = error
+        finally:
+            uploader.close()
+    threads = [threading.Thread (target=updateSegment, args=(interface, nodes)) for interface, nodes in segments.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+# *** SIMULATED BOOTLOADER ***
+# Node running the CBUS bootloader protocol on a python-can bus, for tests without hardware
+# After OPC_BOOTM for its node number, it answers the bootloader frames and stores the written bytes in memory
+# drop : set of data frame numbers (counted from 0 since the last CMD_RST_CHKSM) not acknowledged, to test errors
+class SimulatedBootloader:
+    def __init__ (self, bus, node_number, drop = None):
+        self.bus = bus
+        self.node_number = node_number
+        self.boot_mode = False
+        self.memory = {}
+        self.address = 0
+        self.control = 0
+        self.checksum = 0
+        self.frames = 0
+        self.resets = 0
+        if drop == None:
+            drop = set()
+        self.drop = drop
+        self.notifier = can.Notifier (bus, [self._onMessage], timeout=1.0)
+
+    def close (self):
+        self.notifier.stop()
+
+    def _reply (self, value):
+        self.bus.send (can.Message (arbitration_id=BOOT_REPLY_ID, data=[value], is_extended_id=True))
+
+    def _onMessage (self, msg):
+        if not msg.is_extended_id:
+            if msg.dlc >= 3 and msg.data[0] == pyCBUS.OPC_BOOTM and (msg.data[1] << 8) | msg.data[2] == self.node_number:
+                self.boot_mode = True
+            return
+        if not self.boot_mode or msg.dlc != 8:
+            return
+        data = msg.data
+        if msg.arbitration_id == BOOT_CONTROL_ID:
+            self.address = data[0] | (data[1] << 8) | (data[2] << 16)
+            self.control = data[4]
+            command = data[5]
+            if command == CMD_BOOT_TEST:
+                self._reply (REPLY_BOOT)
+            elif command == CMD_RST_CHKSM:
+                self.checksum = 0
+                self.frames = 0
+            elif command == CMD_CHK_RUN:
+                if (self.checksum + (data[6] | (data[7] << 8))) & 0xFFFF == 0:
+                    self._reply (REPLY_OK)
+                else:
+                    self._reply (REPLY_ERROR)
+            elif command == CMD_RESET:
+                self.boot_mode = False
+                self.resets = self.resets + 1
+        elif msg.arbitration_id == BOOT_DATA_ID:
+            frame = self.frames
+            self.frames = self.frames + 1
+            if frame in self.drop:
+                self.drop.discard (frame)
+                return      # Frame lost : not written, not acknowledged
+            if self.control & MODE_WRT_UNLCK:
+                for offset in range (8):
+                    self.memory[self.address + offset] = data[offset]
+            self.checksum = self.checksum + sum (data)
+            if self.control & MODE_AUTO_INC:
+                self.address = self.address + 8
+            if self.control & MODE_ACK:
+                self._reply (REPLY_OK)
@@ -0,0 +1,358 @@
+# pyCBUS_broker.py
+# Sharing one CAN bus between several local processes
+#
+# CBUSBroker runs in the only process which opens the CAN bus. It writes every received frame in a ring of
+# fixed size records in shared memory, and sends the frames queued by the client processes. Each client has its own
+# transmit ring in the shared memory, written only by the client and read only by the broker, so no lock is needed.
+# Frames sent for a client are also written in the receive ring, so the other clients see them
+# (like the other sockets of a socketcan interface). Waiting processes are woken up with Unix datagram sockets,
+# the frames themselves are only exchanged through the shared memory.
+# BrokerBus is a python-can bus reading and writing the shared memory, so client processes use pyCBUS as usual.
+# Linux only (shared memory, abstract Unix sockets, fcntl)
+#
+#   Broker process :
+#       broker = CBUSBroker ('layout', channel = 'can0', bustype = 'socketcan')
+#       broker.run()
+#   Client processes :
+#       pyCBUS.setup (bus = BrokerBus ('layout'))
+#       pyCBUS.startReceiver()
+
+import fcntl
+import os
+import select
+import socket
+import struct
+import tempfile
+import threading
+import time
+import traceback
+from multiprocessing import resource_tracker, shared_memory
+import can
+
+# Shared memory layout (little endian) :
+#   header (64 bytes) : 'CBSB', version (1 byte), 3 bytes padding, receive ring size, number of client slots,
+#                       transmit ring size (4 bytes each), 4 bytes padding, number of frames written in the receive ring (8 bytes)
+#   client slots (64 bytes each) : frames written by the client (8 bytes), frames read by the broker (8 bytes), waiting (1 byte)
+#   receive ring : records of sequence number + 1 (8 bytes, 0 while the record is written), timestamp (double),
+#                  CAN identifier (4 bytes), DLC, flags, origin (0 : bus, n : client slot n - 1), 1 byte padding, data (8 bytes)
+#   client transmit rings : records of CAN identifier (4 bytes), DLC, flags, 2 bytes padding, data (8 bytes)
+_SHM_MAGIC = b'CBSB'
+_SHM_VERSION = 1
+_SHM_HEADER = struct.Struct ('<4sBxxxIIIxxxx')
+_SHM_HEADER_SIZE = 64
+_WRITE_COUNT_OFFSET = 24
+_CLIENT_SIZE = 64
+_CLIENT_WAITING_OFFSET = 16
+_COUNTER = struct.Struct ('<Q')
+_RX_RECORD = struct.Struct ('<QdIBBBx8s')
+_RX_FRAME = struct.Struct ('<dIBBBx8s')        # Receive record without its sequence number
+_TX_RECORD = struct.Struct ('<IBBxx8s')
+
+# Frame flags
+FLAG_EXTENDED = 0x01
+FLAG_REMOTE = 0x02
+
+# Read a counter written by another process. A 64 bits value can be written in two parts on 32 bits
+# processors, so it is read until two reads give the same value
+def _readCounter (buffer, offset):
+    value = _COUNTER.unpack_from (buffer, offset)[0]
+    while True:
+        check = _COUNTER.unpack_from (buffer, offset)[0]
+        if check == value:
+            return value
+        value = check
+
+def _socketName (name, slot):
+    if slot == None:
+        return '\0pyCBUS-broker-' + name
+    return '\0pyCBUS-broker-' + name + '-' + str (slot)
+
+def _lockFileName (name, slot):
+    directory = '/dev/shm'
+    if not os.path.isdir (directory):
+        directory = tempfile.gettempdir()
+    return os.path.join (directory, 'pyCBUS-broker-' + name + '-' + str (slot) + '.lock')
+
+# Attach to an existing shared memory block without letting the resource tracker of this process
+# destroy it when the process exits (Python < 3.13 registers attached blocks as if they were created)
+def _attachSharedMemory (name):
+    try:
+        return shared_memory.SharedMemory (name = name, track = False)
+    except TypeError:
+        memory = shared_memory.SharedMemory (name = name)
+        try:
+            resource_tracker.unregister (memory._name, 'shared_memory')
+        except Exception:
+            pass
+        return memory
+
+def _frameFlags (msg):
+    flags = 0
+    if msg.is_extended_id:
+        flags = flags | FLAG_EXTENDED
+    if msg.is_remote_frame:
+        flags = flags | FLAG_REMOTE
+    return flags
+
+class CBUSBroker:
+    # name : name of the broker, used by the clients (BrokerBus) to find its shared memory
+    # channel, bustype : python-can channel and interface opened by the broker, or bus : an already opened python-can bus
+    # ring_size : number of frames kept in the receive ring. A client which is more than ring_size frames late loses frames
+    # max_clients : number of client slots, tx_size : number of frames in the transmit ring of each client
+    def __init__ (self, name = 'pyCBUS', channel = 'can0', bustype = 'socketcan', bus = None, ring_size = 4096, \
+                  max_clients = 16, tx_size = 256):
+        if bus == None:
+            bus = can.interface.Bus (channel = channel, interface = bustype)
+        self.bus = bus
+        self.name = name
+        self.ring_size = ring_size
+        self.max_clients = max_clients
+        self.tx_size = tx_size
+        self.client_offset = _SHM_HEADER_SIZE
+        self.rx_offset = self.client_offset + max_clients * _CLIENT_SIZE
+        self.tx_offset = self.rx_offset + ring_size * _RX_RECORD.size
+        size = self.tx_offset + max_clients * tx_size * _TX_RECORD.size
+        self.memory = shared_memory.SharedMemory (name = 'pyCBUS-broker-' + name, create = True, size = size)
+        self.buffer = self.memory.buf
+        self.buffer[:size] = bytes (size)
+        _SHM_HEADER.pack_into (self.buffer, 0, _SHM_MAGIC, _SHM_VERSION, ring_size, max_clients, tx_size)
+        self.write_count = 0
+        self.publish_lock = threading.Lock()
+        self.wakeup = socket.socket (socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.wakeup.bind (_socketName (name, None))
+        self.wakeup.setblocking (False)
+        self.notify = socket.socket (socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.notify.setblocking (False)
+        self.running = True
+        self.threads = [threading.Thread (target=self._receiveThread, daemon=True), \
+                        threading.Thread (target=self._transmitThread, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    # Run until close is called from another thread (or until the process is stopped)
+    def run (self):
+        try:
+            while self.running:
+                time.sleep (0.5)
+        finally:
+            self.close()
+
+    # Stop the broker and destroy the shared memory. Clients still attached stop receiving frames
+    def close (self):
+        if not self.running:
+            return
+        self.running = False
+        for thread in self.threads:
+            if thread != threading.current_thread():
+                thread.join()
+        self.wakeup.close()
+        self.notify.close()
+        self.buffer.release()
+        self.memory.close()
+        self.memory.unlink()
+        self.bus.shutdown()
+
+    # Write a frame in the receive ring and wake up the waiting clients
+    # origin : 0 for a frame received from the bus, client slot + 1 for a frame sent for a client
+    def _publish (self, msg, origin):
+        buffer = self.buffer
+        with self.publish_lock:
+            sequence = self.write_count
+            position = self.rx_offset + (sequence % self.ring_size) * _RX_RECORD.size
+            # Sequence number is cleared while the record is written, so readers can detect a record being overwritten
+            _COUNTER.pack_into (buffer, position, 0)
+            _RX_FRAME.pack_into (buffer, position + 8, msg.timestamp or time.time(), msg.arbitration_id, msg.dlc, \
+                                 _frameFlags (msg), origin, bytes (msg.data))
+            _COUNTER.pack_into (buffer, position, sequence + 1)
+            self.write_count = sequence + 1
+            _COUNTER.pack_into (buffer, _WRITE_COUNT_OFFSET, self.write_count)
+        for slot in range (self.max_clients):
+            waiting = self.client_offset + slot * _CLIENT_SIZE + _CLIENT_WAITING_OFFSET
+            if buffer[waiting] != 0:
+                buffer[waiting] = 0
+                try:
+                    self.notify.sendto (b'\0', _socketName (self.name, slot))
+                except OSError:
+                    pass        # Client has stopped
+
+    def _receiveThread (self):
+        while self.running:
+            try:
+                msg = self.bus.recv (0.5)
+            except can.CanError:
+                traceback.print_exc()
+                time.sleep (0.5)
+                continue
+            if msg != None and not msg.is_error_frame:
+                self._publish (msg, 0)
+
+    def _send (self, msg):
+        for retry in range (100):
+            try:
+                self.bus.send (msg)
+                return True
+            except can.CanOperationError:
+                time.sleep (0.001)     # Socket transmit buffer full
+        traceback.print_exc()
+        return False
+
+    def _transmitThread (self):
+        buffer = self.buffer
+        while self.running:
+            select.select ([self.wakeup], [], [], 0.5)
+            try:
+                while True:
+                    self.wakeup.recv (16)
+            except BlockingIOError:
+                pass
+            for slot in range (self.max_clients):
+                control = self.client_offset + slot * _CLIENT_SIZE
+                head = _readCounter (buffer, control)
+                tail = _COUNTER.unpack_from (buffer, control + 8)[0]
+                ring = self.tx_offset + slot * self.tx_size * _TX_RECORD.size
+                while tail < head:
+                    can_id, dlc, flags, data = _TX_RECORD.unpack_from (buffer, ring + (tail % self.tx_size) * _TX_RECORD.size)
+                    msg = can.Message (arbitration_id=can_id, data=data[:dlc], dlc=dlc, is_extended_id=(flags & FLAG_EXTENDED) != 0, \
+                                       is_remote_frame=(flags & FLAG_REMOTE) != 0)
+                    tail = tail + 1
+                    _COUNTER.pack_into (buffer, control + 8, tail)
+                    if self._send (msg):
+                        msg.timestamp = time.time()
+                        self._publish (msg, slot + 1)
+
+# python-can bus of a client process, connected to a CBUSBroker
+# Received frames are read from the shared memory ring, frames to send are written in the transmit ring of the client
+# Only the frames received after the bus is created are returned. overruns counts the frames lost because
+# the client was more than ring_size frames late
+class BrokerBus (can.BusABC):
+    def __init__ (self, channel = 'pyCBUS', can_filters = None, **kwargs):
+        self.memory = _attachSharedMemory ('pyCBUS-broker-' + channel)
+        self.buffer = self.memory.buf
+        magic, version, self.ring_size, max_clients, self.tx_size = _SHM_HEADER.unpack_from (self.buffer, 0)
+        if magic != _SHM_MAGIC or version != _SHM_VERSION:
+            self.buffer.release()
+            self.memory.close()
+            raise can.CanInitializationError ('Shared memory of broker ' + channel + ' has not been created by CBUSBroker')
+        self.broker = channel
+        self.rx_offset = _SHM_HEADER_SIZE + max_clients * _CLIENT_SIZE
+        tx_offset = self.rx_offset + self.ring_size * _RX_RECORD.size
+        # Client slot : the first slot whose lock file can be locked. The lock is released by the system
+        # when the process stops, so the slot of a stopped client can be used again
+        self.lock_file = None
+        for slot in range (max_clients):
+            lock_file = open (_lockFileName (channel, slot), 'a')
+            try:
+                fcntl.flock (lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                continue
+            self.lock_file = lock_file
+            self.slot = slot
+            break
+        if self.lock_file == None:
+            self.buffer.release()
+            self.memory.close()
+            raise can.CanInitializationError ('All the client slots of broker ' + channel + ' are used')
+        self.control = _SHM_HEADER_SIZE + self.slot * _CLIENT_SIZE
+        self.tx_ring = tx_offset + self.slot * self.tx_size * _TX_RECORD.size
+        # Frames left by the previous client of the slot are dropped
+        self.head = _readCounter (self.buffer, self.control + 8)
+        _COUNTER.pack_into (self.buffer, self.control, self.head)
+        self.buffer[self.control + _CLIENT_WAITING_OFFSET] = 0
+        self.wakeup = socket.socket (socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.wakeup.bind (_socketName (channel, self.slot))
+        self.wakeup.setblocking (False)
+        self.next_sequence = _readCounter (self.buffer, _WRITE_COUNT_OFFSET)
+        self.overruns = 0
+        self.send_lock = threading.Lock()
+        self.channel_info = 'pyCBUS broker ' + channel + ' client ' + str (self.slot)
+        super().__init__ (channel = channel, can_filters = can_filters, **kwargs)
+
+    # Queue a frame in the transmit ring. If the ring is full, waits for room until timeout seconds
+    # (None : no limit, as python-can buses), then raises CanOperationError. timeout <= 0 raises at once
+    def send (self, msg, timeout = None):
+        with self.send_lock:
+            tail = _readCounter (self.buffer, self.control + 8)
+            if self.head - tail >= self.tx_size:
+                if timeout != None and timeout <= 0:
+                    raise can.CanOperationError ('Transmit ring of broker client is full')
+                deadline = None
+                if timeout != None:
+                    deadline = time.monotonic() + timeout
+                while self.head - _readCounter (self.buffer, self.control + 8) >= self.tx_size:
+                    if deadline != None and time.monotonic() > deadline:
+                        raise can.CanOperationError ('Transmit ring of broker client is full')
+                    time.sleep (0.0005)
+            _TX_RECORD.pack_into (self.buffer, self.tx_ring + (self.head % self.tx_size) * _TX_RECORD.size, \
+                                  msg.arbitration_id, msg.dlc, _frameFlags (msg), bytes (msg.data))
+            self.head = self.head + 1
+            _COUNTER.pack_into (self.buffer, self.control, self.head)
+        try:
+            self.wakeup.sendto (b'\0', _socketName (self.broker, None))
+        except OSError:
+            pass        # Broker wakes up by itself every 0.5 s
+
+    # Return the next frame of the receive ring (frames sent by this client excepted), None if there is none
+    def _readFrame (self):
+        buffer = self.buffer
+        origin_self = self.slot + 1
+        while True:
+            sequence = self.next_sequence
+            write_count = _readCounter (buffer, _WRITE_COUNT_OFFSET)
+            if sequence >= write_count:
+                return None
+            if write_count - sequence > self.ring_size:
+                # Records have been overwritten before this client read them
+                self.overruns = self.overruns + write_count - self.ring_size - sequence
+                self.next_sequence = write_count - self.ring_size
+                continue
+            position = self.rx_offset + (sequence % self.ring_size) * _RX_RECORD.size
+            timestamp, can_id, dlc, flags, origin, data = _RX_FRAME.unpack_from (buffer, position + 8)
+            if _COUNTER.unpack_from (buffer, position)[0] != sequence + 1:
+                continue    # Record overwritten while it was read : next loop counts the overrun
+            self.next_sequence = sequence + 1
+            if origin == origin_self:
+                continue
+            return can.Message (timestamp=timestamp, arbitration_id=can_id, data=data[:dlc], dlc=dlc, \
+                                is_extended_id=(flags & FLAG_EXTENDED) != 0, is_remote_frame=(flags & FLAG_REMOTE) != 0, \
+                                channel=self.broker)
+
+    def _recv_internal (self, timeout):
+        msg = self._readFrame()
+        if msg != None:
+            return msg, False
+        if timeout == None:
+            deadline = None
+        else:
+            deadline = time.monotonic() + timeout
+        waiting = self.control + _CLIENT_WAITING_OFFSET
+        while True:
+            # Waiting flag is set before the ring is checked again, so a frame written meanwhile always sends a wake up
+            self.buffer[waiting] = 1
+            msg = self._readFrame()
+            if msg != None:
+                self.buffer[waiting] = 0
+                return msg, False
+            if deadline == None:
+                remaining = None
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.buffer[waiting] = 0
+                    return None, False
+            select.select ([self.wakeup], [], [], remaining)
+            try:
+                while True:
+                    self.wakeup.recv (16)
+            except BlockingIOError:
+                pass
+
+    def shutdown (self):
+        super().shutdown()
+        if self.lock_file == None:
+            return
+        self.wakeup.close()
+        self.buffer.release()
+        self.memory.close()
+        self.lock_file.close()
+        self.lock_file = None
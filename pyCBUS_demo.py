@@ -2,21 +2,11 @@
 # A small demonstration program to show how to use pyCBUS module
 
 import pyCBUS
-import time
-import threading
 
-CBUSMessage=0
-StopThread=False
-
-# Dedicated thread function to process incoming CBUS messages
-def CBUS_receive_func ():
-    global StopThread
-    while True:
-        CBUSMessage = pyCBUS.getNextCBUSMessage()
-        # pyCBUS.dumpCBUSMessage (CBUSMessage)   # Uncomment this line to show incoming CBUS message
-        time.sleep (0.001)    # Needed if we don't want Python to take 100% of the CPU...
-        if StopThread:
-            break             # Exit the thread function and stop thread
+# Function called by pyCBUS receiver thread for each incoming CBUS message
+def CBUS_receive_func (CBUSMessage):
+    # pyCBUS.dumpCBUSMessage (CBUSMessage)   # Uncomment this line to show incoming CBUS message
+    pass
            
 def listCommands ():
     print ('0 : Exit program')
@@ -47,9 +37,9 @@ pyCBUS.setGreenLED (state=True)
 pyCBUS.setYellowLED (state=False)
 pyCBUS.setRedLED (state=False)
 
-# Create CBUS reception thread
-CBUSThread = threading.Thread (target=CBUS_receive_func, args=())
-CBUSThread.start()
+# Register our reception function for all messages and start CBUS reception thread
+pyCBUS.addMessageHandler (None, CBUS_receive_func)
+pyCBUS.startReceiver()
 
 # Command loop
 Command = -1
@@ -69,5 +59,4 @@ while Command != 0:
         testAccessoryEvents()
 
 # Program termination
-StopThread = True
-CBUSThread.join()    # This will kill the thread (can be omitted, but better practice)
\ No newline at end of file
+pyCBUS.stopReceiver()    # Stop reception thread (can be omitted, but better practice)
\ No newline at end of file
@@ -0,0 +1,283 @@
+# pyCBUS_events.py
+# Backup and restore of node event tables
+#
+# EventBackup reads the events stored in nodes (OPC_NERD -> OPC_ENRSP stream, OPC_RQEVN -> OPC_NUMEV)
+# and their event variables (OPC_REVAL -> OPC_NEVAL), several nodes at the same time, and restores
+# them with learn mode (OPC_NNLRN, OPC_EVLRN, OPC_NNULN). Tables can be saved in a compact binary snapshot file
+# syncNode only sends the differences between a desired table and the table stored in the node
+# The pyCBUS receiver must be running (pyCBUS.startReceiver)
+#
+#   backup = EventBackup()
+#   tables, errors = backup.backupNodes ([100, 101, 102], max_nodes = 4)
+#   saveSnapshot ('layout.cbev', tables)
+#   ...
+#   for table in loadSnapshot ('layout.cbev').values():
+#       backup.restoreNode (table)
+
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import pyCBUS
+from pyCBUS_requests import RequestTracker
+
+# Node parameter giving the number of event variables per event
+PARAM_EV_PER_EVENT = 5
+
+# Event table of a node
+# events : dictionary (event node number, event number) -> bytes of the event variables (EV1 first)
+# indexes : dictionary index of the event in the node table -> (event node number, event number)
+class NodeEventTable:
+    def __init__ (self, node_number, ev_count = 0):
+        self.node_number = node_number
+        self.ev_count = ev_count
+        self.events = {}
+        self.indexes = {}
+
+# Collects the OPC_ENRSP frames sent by a node while it is being read
+class _EventCollector:
+    def __init__ (self, table):
+        self.table = table
+        self.condition = threading.Condition()
+        self.last_frame = time.monotonic()
+
+class EventBackup:
+    # tracker : RequestTracker used for the requests, a new one is created on interface (pyCBUS module by default) if None
+    def __init__ (self, tracker = None, interface = None):
+        if tracker == None:
+            tracker = RequestTracker (interface)
+            self.own_tracker = True
+        else:
+            self.own_tracker = False
+        self.tracker = tracker
+        self.interface = tracker.interface
+        self.lock = threading.Lock()
+        self.collectors = {}    # node number -> _EventCollector of the nodes being read
+        self.interface.addMessageHandler (pyCBUS.OPC_ENRSP, self._onEventResponse)
+
+    def close (self):
+        self.interface.removeMessageHandler (pyCBUS.OPC_ENRSP, self._onEventResponse)
+        if self.own_tracker:
+            self.tracker.close()
+
+    def _onEventResponse (self, msg):
+        answer = pyCBUS.decodeCBUSMessage (msg)
+        with self.lock:
+            collector = self.collectors.get (answer.node_number)
+        if collector == None:
+            return
+        with collector.condition:
+            event = (answer.event_node, answer.event_number)
+            collector.table.indexes[answer.index] = event
+            collector.table.events.setdefault (event, b'')
+            collector.last_frame = time.monotonic()
+            collector.condition.notify()
+
+    # Read the event table of one node
+    # ev_count : number of event variables to read for each event. If None, it is read from the node parameters
+    # idle_timeout : the OPC_ENRSP stream is considered finished when no frame is received during this time.
+    # Missing events are then read one by one with OPC_NENRD
+    # window : number of requests in flight for the node
+    def backupNode (self, node_number, ev_count = None, idle_timeout = 0.5, window = 4, timeout = 1.0, retries = 2):
+        if ev_count == None:
+            ev_count = self.tracker.readNodeParameter (node_number, PARAM_EV_PER_EVENT, timeout, retries).result().value
+        table = NodeEventTable (node_number, ev_count)
+        count = self.tracker.readNumberOfEvents (node_number, timeout, retries).result().count
+        collector = _EventCollector (table)
+        with self.lock:
+            self.collectors[node_number] = collector
+        try:
+            if count > 0:
+                self.interface.sendFrame (pyCBUS.encodeReadAllEvents (node_number))
+                with collector.condition:
+                    collector.last_frame = time.monotonic()
+                    while len (table.indexes) < count:
+                        remaining = collector.last_frame + idle_timeout - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        collector.condition.wait (remaining)
+            self._readMissingEvents (table, count, window, timeout, retries)
+        finally:
+            with self.lock:
+                del self.collectors[node_number]
+        if ev_count > 0:
+            requests = [(index, ev) for index in sorted (table.indexes) for ev in range (1, ev_count + 1)]
+            answers = self.tracker.pipeline (requests, lambda request: self.tracker.readEventVariable (node_number, \
+                                             request[0], request[1], timeout, retries), window)
+            values = {}
+            for answer in answers:
+                values.setdefault (answer.index, bytearray (ev_count))[answer.ev_index - 1] = answer.value
+            for index, event in table.indexes.items():
+                table.events[event] = bytes (values[index])
+        return table
+
+    # Read with OPC_NENRD the events not received in the OPC_ENRSP stream
+    # Indexes in the node table are not always contiguous : unknown indexes are tried in increasing
+    # order until all events are found. An index without event is answered with OPC_CMDERR
+    def _readMissingEvents (self, table, count, window, timeout, retries):
+        index = 0
+        while len (table.indexes) < count and index < 255:
+            missing = count - len (table.indexes)
+            candidates = []
+            while len (candidates) < min (missing, window) and index < 255:
+                index = index + 1
+                if index not in table.indexes:
+                    candidates.append (index)
+            futures = [self.tracker.readEventFromNumber (table.node_number, candidate, timeout, retries) for candidate in candidates]
+            for future in futures:
+                try:
+                    future.result()     # Event is stored in the table by _onEventResponse
+                except pyCBUS.CBUSCommandError:
+                    pass
+
+    # Read the event tables of several nodes, with at most max_nodes nodes read at the same time
+    # A node which fails (no answer, CMDERR, ...) does not stop the backup of the other nodes
+    # Returns (tables, errors) : dictionary node number -> NodeEventTable for the nodes read,
+    # dictionary node number -> exception for the nodes which failed
+    def backupNodes (self, node_numbers, max_nodes = 4, ev_count = None, window = 4):
+        with ThreadPoolExecutor (max_workers = max_nodes) as executor:
+            futures = dict ((node_number, executor.submit (self.backupNode, node_number, ev_count, window = window)) \
+                            for node_number in node_numbers)
+        tables = {}
+        errors = {}
+        for node_number, future in futures.items():
+            error = future.exception()
+            if error == None:
+                tables[node_number] = future.result()
+            else:
+                errors[node_number] = error
+        return tables, errors
+
+    # Teach one event variable to a node in learn mode and return a Future for the OPC_WRACK answer
+    def teachEvent (self, node_number, event_node, event_number, event_variable, event_value, timeout = 1.0, retries = 2):
+        return self.tracker.request (pyCBUS.encodeEventToLearn (event_node, event_number, event_variable, event_value), \
+                                     [(pyCBUS.OPC_WRACK, node_number, None), (pyCBUS.OPC_CMDERR, node_number, None)], \
+                                     timeout, retries)
+
+    # Teach all events of a table to its node. If clear is True, all events of the node are deleted first
+    def restoreNode (self, table, clear = False, window = 4, timeout = 1.0, retries = 2):
+        node_number = table.node_number
+        self.interface.sendFrame (pyCBUS.encodeActivateLearnMode (node_number))
+        try:
+            if clear:
+                self.tracker.request (pyCBUS.encodeClearAllEvents (node_number), [(pyCBUS.OPC_WRACK, node_number, None), \
+                                      (pyCBUS.OPC_CMDERR, node_number, None)], timeout, retries).result()
+            writes = [(event, ev + 1, value) for event, values in table.events.items() for ev, value in enumerate (values)]
+            self.tracker.pipeline (writes, lambda write: self.teachEvent (node_number, write[0][0], write[0][1], \
+                                   write[1], write[2], timeout, retries), window)
+        finally:
+            self.interface.sendFrame (pyCBUS.encodeExitLearnMode (node_number))
+
+    # Send to a node only the changes needed to get the desired table (NodeEventTable)
+    # current : table stored in the node, for example from a previous backup or snapshot. If None, it is read
+    # from the node. When the node acknowledges the changes, current is updated to stay a valid cache
+    # All changes are sent in one learn mode session, with up to window frames waiting for their acknowledge
+    # Nothing is sent if the node already stores the desired table. Returns a SyncResult
+    def syncNode (self, desired, current = None, window = 4, timeout = 1.0, retries = 2):
+        node_number = desired.node_number
+        if current == None:
+            current = self.backupNode (node_number, desired.ev_count, window = window, timeout = timeout, retries = retries)
+        changes = []    # (frame, event, event variable number, value), event variable number is 0 to remove the event
+        for event in current.events:
+            if event not in desired.events:
+                changes.append ((pyCBUS.encodeRemoveEvent (event[0], event[1]), event, 0, 0))
+        for event, values in desired.events.items():
+            current_values = current.events.get (event, b'')
+            for ev, value in enumerate (values):
+                if ev >= len (current_values) or current_values[ev] != value:
+                    changes.append ((pyCBUS.encodeEventToLearn (event[0], event[1], ev + 1, value), event, ev + 1, value))
+        result = SyncResult (node_number)
+        if len (changes) == 0:
+            return result
+        answers = [(pyCBUS.OPC_WRACK, node_number, None), (pyCBUS.OPC_CMDERR, node_number, None)]
+        in_flight = deque()
+        self.interface.sendFrame (pyCBUS.encodeActivateLearnMode (node_number))
+        try:
+            for change in changes:
+                if len (in_flight) >= window:
+                    self._applyChange (current, result, *in_flight.popleft())
+                in_flight.append ((change, self.tracker.request (change[0], answers, timeout, retries)))
+            while len (in_flight) > 0:
+                self._applyChange (current, result, *in_flight.popleft())
+        finally:
+            self.interface.sendFrame (pyCBUS.encodeExitLearnMode (node_number))
+        return result
+
+    # Wait for the acknowledge of a change sent by syncNode and update the cached table and the result
+    def _applyChange (self, current, result, change, future):
+        frame, event, ev, value = change
+        try:
+            future.result()
+        except (pyCBUS.CBUSCommandError, TimeoutError) as error:
+            result.errors.append ((frame, error))
+            return
+        if ev == 0:
+            del current.events[event]
+            for index in [index for index, indexed_event in current.indexes.items() if indexed_event == event]:
+                del current.indexes[index]
+            result.removed = result.removed + 1
+        else:
+            values = bytearray (current.events.get (event, b'')).ljust (max (ev, current.ev_count), b'\x00')
+            values[ev - 1] = value
+            current.events[event] = bytes (values)
+            result.taught = result.taught + 1
+
+# Result of EventBackup.syncNode
+# taught : number of event variables taught (OPC_EVLRN), removed : number of events removed (OPC_EVULN)
+# errors : list of (frame, exception) for the frames which were not acknowledged by the node
+class SyncResult:
+    def __init__ (self, node_number):
+        self.node_number = node_number
+        self.taught = 0
+        self.removed = 0
+        self.errors = []
+
+    def ok (self):
+        return len (self.errors) == 0
+
+# *** SNAPSHOT FILES ***
+# File format (big endian) :
+#   header : 'CBEV', version (1 byte), number of nodes (2 bytes)
+#   for each node : node number (2 bytes), EVs per event (1 byte), number of events (2 bytes)
+#     for each event : event node number (2 bytes), event number (2 bytes), index (1 byte), EVs
+_SNAPSHOT_MAGIC = b'CBEV'
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct ('>4sBH')
+_SNAPSHOT_NODE = struct.Struct ('>HBH')
+_SNAPSHOT_EVENT = struct.Struct ('>HHB')
+
+# tables : dictionary node number -> NodeEventTable
+def saveSnapshot (filename, tables):
+    data = [_SNAPSHOT_HEADER.pack (_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, len (tables))]
+    for table in tables.values():
+        data.append (_SNAPSHOT_NODE.pack (table.node_number, table.ev_count, len (table.events)))
+        event_indexes = dict ((event, index) for index, event in table.indexes.items())
+        for event, values in table.events.items():
+            data.append (_SNAPSHOT_EVENT.pack (event[0], event[1], event_indexes.get (event, 0)))
+            data.append (bytes (values).ljust (table.ev_count, b'\x00')[:table.ev_count])
+    with open (filename, 'wb') as snapshot:
+        snapshot.write (b''.join (data))
+
+# Returns a dictionary node number -> NodeEventTable
+def loadSnapshot (filename):
+    with open (filename, 'rb') as snapshot:
+        data = snapshot.read()
+    magic, version, node_count = _SNAPSHOT_HEADER.unpack_from (data, 0)
+    if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+        raise ValueError ('%s is not a CBUS event snapshot' % filename)
+    offset = _SNAPSHOT_HEADER.size
+    tables = {}
+    for node in range (node_count):
+        node_number, ev_count, event_count = _SNAPSHOT_NODE.unpack_from (data, offset)
+        offset = offset + _SNAPSHOT_NODE.size
+        table = NodeEventTable (node_number, ev_count)
+        for event in range (event_count):
+            event_node, event_number, index = _SNAPSHOT_EVENT.unpack_from (data, offset)
+            offset = offset + _SNAPSHOT_EVENT.size
+            table.events[(event_node, event_number)] = data[offset:offset + ev_count]
+            offset = offset + ev_count
+            if index != 0:
+                table.indexes[index] = (event_node, event_number)
+        tables[node_number] = table
+    return tables
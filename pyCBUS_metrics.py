@@ -0,0 +1,299 @@
+# pyCBUS_metrics.py
+# Bus instrumentation
+#
+# BusMetrics counts the frames received and sent by the program per opcode and per node, estimates the
+# bus load from the length of the frames, measures the time between configuration requests and their answers
+# (OPC_NVRD -> OPC_NVANS, OPC_QNN -> OPC_PNN, ...) and reports the transmit queue depth.
+# Counting a frame costs a few list and dictionary updates, so the metrics can be left enabled.
+# snapshot returns all the metrics in a dictionary, startHTTPServer publishes them in Prometheus text format
+# The pyCBUS receiver must be running (pyCBUS.startReceiver)
+#
+#   metrics = BusMetrics()
+#   metrics.startHTTPServer (9108)      # http://127.0.0.1:9108/metrics
+#   ...
+#   print (metrics.snapshot()['bus_load'])
+
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pyCBUS
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+# Requests for which the answer latency is measured : request opcode, answer opcodes, several answers
+# Requests with several answers (broadcasts, event table read) measure the latency of each answer
+_LATENCY_PAIRS = (
+    (pyCBUS.OPC_NVRD, (pyCBUS.OPC_NVANS,), False),
+    (pyCBUS.OPC_NVSET, (pyCBUS.OPC_WRACK,), False),
+    (pyCBUS.OPC_RQNPN, (pyCBUS.OPC_PARAN,), False),
+    (pyCBUS.OPC_RQEVN, (pyCBUS.OPC_NUMEV,), False),
+    (pyCBUS.OPC_REVAL, (pyCBUS.OPC_NEVAL,), False),
+    (pyCBUS.OPC_NERD, (pyCBUS.OPC_ENRSP,), True),
+    (pyCBUS.OPC_QNN, (pyCBUS.OPC_PNN,), True),
+    (pyCBUS.OPC_RQMN, (pyCBUS.OPC_NAME,), False),
+    (pyCBUS.OPC_RLOC, (pyCBUS.OPC_PLOC, pyCBUS.OPC_ERR), False),
+    (pyCBUS.OPC_AREQ, pyCBUS.ACCESSORY_OPCODES[(False, True, True)] + pyCBUS.ACCESSORY_OPCODES[(False, True, False)], False),
+)
+
+# Opcodes of the frames carrying a node number in data bytes 1-2
+_NODE_OPCODES = frozenset (opcode for opcode in range (256) if 'node_number' in pyCBUS.OPCODE_TABLE[opcode].message_type._fields)
+
+# Request opcode -> several answers, answer opcode -> list of (request opcode, name of the pair)
+_REQUESTS = {}
+_ANSWERS = {}
+for _request, _answers, _multiple in _LATENCY_PAIRS:
+    _REQUESTS[_request] = _multiple
+    for _answer in _answers:
+        _ANSWERS.setdefault (_answer, []).append ((_request, pyCBUS.OPCODE_TABLE[_request].name + '->' + pyCBUS.OPCODE_TABLE[_answer].name))
+
+class _LatencyHistogram:
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__ (self):
+        self.counts = [0] * (len (LATENCY_BUCKETS) + 1)     # Last bucket : above the last bound
+        self.total = 0.0
+        self.count = 0
+
+    def observe (self, latency):
+        self.counts[bisect_left (LATENCY_BUCKETS, latency)] += 1
+        self.total = self.total + latency
+        self.count = self.count + 1
+
+    # Cumulative counts (Prometheus histogram), the last bound is None (+Inf)
+    def buckets (self):
+        result = []
+        cumulative = 0
+        for bound, count in zip (LATENCY_BUCKETS + (None,), self.counts):
+            cumulative = cumulative + count
+            result.append ((bound, cumulative))
+        return result
+
+class BusMetrics:
+    # window : duration in seconds over which the bus load is averaged
+    # max_latency : time in seconds after which a request without answer is no longer waited for
+    # bitrate : CAN bus bitrate used for the bus load
+    # interface : object used to register the receive and send handlers : pyCBUS module by default
+    # max_pending : number of requests without answer kept per request opcode and node, the oldest ones are dropped
+    def __init__ (self, window = 10, max_latency = 5.0, bitrate = pyCBUS.CAN_BITRATE, interface = None, max_pending = 256):
+        if interface == None:
+            interface = pyCBUS
+        self.interface = interface
+        self.window = window
+        self.max_latency = max_latency
+        self.max_pending = max_pending
+        self.bitrate = bitrate
+        self.lock = threading.Lock()
+        self.server = None
+        self.reset()
+        self.interface.addMessageHandler (None, self._onFrameReceived)
+        self.interface.addSendHandler (self._onFrameSent)
+
+    def close (self):
+        self.interface.removeMessageHandler (None, self._onFrameReceived)
+        self.interface.removeSendHandler (self._onFrameSent)
+        self.stopHTTPServer()
+
+    # Clear all the metrics
+    def reset (self):
+        with self.lock:
+            self.rx_frames = 0
+            self.tx_frames = 0
+            self.rx_opcodes = [0] * 256
+            self.tx_opcodes = [0] * 256
+            self.rx_nodes = {}      # Node number -> number of frames
+            self.tx_nodes = {}
+            self.bits = 0           # Bits of all the frames seen on the bus
+            # Bits per second of the last window seconds. bucket_bits[second % window] holds the bits of second
+            self.bucket_bits = [0] * (self.window + 1)
+            self.second = int (time.monotonic())
+            self.pending = {}       # (request opcode, node number) -> deque of request times, or time for several answers
+            self.latencies = {}     # Name of the pair -> _LatencyHistogram
+
+    # Move the current second of the bus load buckets to now. Lock must be held
+    def _advance (self, second):
+        if second == self.second:
+            return
+        for elapsed in range (min (second - self.second, len (self.bucket_bits))):
+            self.bucket_bits[(self.second + elapsed + 1) % len (self.bucket_bits)] = 0
+        self.second = second
+
+    # Lock must be held
+    def _countBits (self, msg, now):
+        bits = pyCBUS.frameBits (msg.dlc, msg.is_extended_id)
+        self.bits = self.bits + bits
+        second = int (now)
+        if second != self.second:
+            self._advance (second)
+        self.bucket_bits[second % len (self.bucket_bits)] += bits
+
+    def _onFrameReceived (self, msg):
+        now = time.monotonic()
+        with self.lock:
+            self.rx_frames = self.rx_frames + 1
+            self._countBits (msg, now)
+            if msg.is_extended_id or msg.is_remote_frame or msg.dlc == 0:
+                return
+            data = msg.data
+            opcode = data[0]
+            self.rx_opcodes[opcode] += 1
+            node_number = None
+            if opcode in _NODE_OPCODES and msg.dlc >= 3:
+                node_number = (data[1] << 8) | data[2]
+                self.rx_nodes[node_number] = self.rx_nodes.get (node_number, 0) + 1
+            answers = _ANSWERS.get (opcode)
+            if answers != None:
+                self._onAnswer (answers, node_number, now)
+
+    def _onFrameSent (self, msg):
+        now = time.monotonic()
+        with self.lock:
+            self.tx_frames = self.tx_frames + 1
+            self._countBits (msg, now)
+            if msg.is_extended_id or msg.is_remote_frame or msg.dlc == 0:
+                return
+            data = msg.data
+            opcode = data[0]
+            self.tx_opcodes[opcode] += 1
+            node_number = None
+            if opcode in _NODE_OPCODES and msg.dlc >= 3:
+                node_number = (data[1] << 8) | data[2]
+                self.tx_nodes[node_number] = self.tx_nodes.get (node_number, 0) + 1
+            multiple = _REQUESTS.get (opcode)
+            if multiple == True:
+                self.pending[(opcode, node_number)] = now
+            elif multiple == False:
+                sent = self.pending.get ((opcode, node_number))
+                if sent == None:
+                    sent = deque (maxlen = self.max_pending)
+                    self.pending[(opcode, node_number)] = sent
+                # Requests never answered (node missing) are dropped here, not only when an answer arrives
+                while len (sent) > 0 and now - sent[0] > self.max_latency:
+                    sent.popleft()
+                sent.append (now)
+
+    # Measure the latency of an answer. Lock must be held
+    def _onAnswer (self, answers, node_number, now):
+        for request, name in answers:
+            if request in _NODE_OPCODES:
+                key = (request, node_number)
+            else:
+                key = (request, None)
+            sent = self.pending.get (key)
+            if sent == None:
+                continue
+            if _REQUESTS[request]:
+                if now - sent > self.max_latency:
+                    del self.pending[key]
+                    continue
+                latency = now - sent
+            else:
+                while len (sent) > 0 and now - sent[0] > self.max_latency:
+                    sent.popleft()
+                if len (sent) == 0:
+                    del self.pending[key]
+                    continue
+                latency = now - sent.popleft()
+            histogram = self.latencies.get (name)
+            if histogram == None:
+                histogram = _LatencyHistogram()
+                self.latencies[name] = histogram
+            histogram.observe (latency)
+            return
+
+    # Return all the metrics in a dictionary :
+    #   rx_frames, tx_frames : number of frames received and sent
+    #   rx_opcodes, tx_opcodes : opcode name -> number of frames (only opcodes seen)
+    #   rx_nodes, tx_nodes : node number -> number of frames carrying this node number
+    #   bus_load : average bus load (0 to 1) over the last window seconds, bus_load_peak : load of the busiest second
+    #   bits : number of bits of all the frames, latency : name of the pair -> {count, sum, buckets}
+    #   queue_depth : number of frames waiting in the transmit scheduler
+    def snapshot (self):
+        now = time.monotonic()
+        with self.lock:
+            self._advance (int (now))
+            # Current second is not complete : it is not used for the load
+            current = self.second % len (self.bucket_bits)
+            seconds = [bits for position, bits in enumerate (self.bucket_bits) if position != current]
+            result = {
+                'rx_frames': self.rx_frames,
+                'tx_frames': self.tx_frames,
+                'rx_opcodes': dict ((pyCBUS.OPCODE_TABLE[opcode].name, count) for opcode, count in enumerate (self.rx_opcodes) if count > 0),
+                'tx_opcodes': dict ((pyCBUS.OPCODE_TABLE[opcode].name, count) for opcode, count in enumerate (self.tx_opcodes) if count > 0),
+                'rx_nodes': dict (self.rx_nodes),
+                'tx_nodes': dict (self.tx_nodes),
+                'bits': self.bits,
+                'bus_load': sum (seconds) / float (len (seconds) * self.bitrate),
+                'bus_load_peak': max (seconds) / float (self.bitrate),
+                'latency': dict ((name, {'count': histogram.count, 'sum': histogram.total, 'buckets': histogram.buckets()}) \
+                                 for name, histogram in self.latencies.items()),
+            }
+        result['queue_depth'] = self.interface.transmitQueueDepth()
+        return result
+
+    # *** PROMETHEUS ENDPOINT ***
+    # Serve the metrics in Prometheus text format on http://address:port/metrics, from a daemon thread
+    # The server only listens on localhost by default
+    def startHTTPServer (self, port = 9108, address = '127.0.0.1'):
+        if self.server != None:
+            return
+        metrics = self
+
+        class MetricsHandler (BaseHTTPRequestHandler):
+            def do_GET (self):
+                if self.path != '/metrics':
+                    self.send_error (404)
+                    return
+                body = formatPrometheus (metrics.snapshot()).encode ('utf-8')
+                self.send_response (200)
+                self.send_header ('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header ('Content-Length', str (len (body)))
+                self.end_headers()
+                self.wfile.write (body)
+
+            def log_message (self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer ((address, port), MetricsHandler)
+        self.server.daemon_threads = True
+        threading.Thread (target=self.server.serve_forever, daemon=True).start()
+
+    def stopHTTPServer (self):
+        if self.server == None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+
+# Format a snapshot (see BusMetrics.snapshot) in Prometheus text format
+def formatPrometheus (snapshot):
+    lines = ['# TYPE cbus_frames_total counter']
+    for direction in ('rx', 'tx'):
+        for opcode, count in sorted (snapshot[direction + '_opcodes'].items()):
+            lines.append ('cbus_frames_total{direction="%s",opcode="%s"} %d' % (direction, opcode, count))
+    lines.append ('# TYPE cbus_all_frames_total counter')
+    for direction in ('rx', 'tx'):
+        lines.append ('cbus_all_frames_total{direction="%s"} %d' % (direction, snapshot[direction + '_frames']))
+    lines.append ('# TYPE cbus_node_frames_total counter')
+    for direction in ('rx', 'tx'):
+        for node_number, count in sorted (snapshot[direction + '_nodes'].items()):
+            lines.append ('cbus_node_frames_total{direction="%s",node="%d"} %d' % (direction, node_number, count))
+    lines.append ('# TYPE cbus_bits_total counter')
+    lines.append ('cbus_bits_total %d' % snapshot['bits'])
+    lines.append ('# TYPE cbus_bus_load_ratio gauge')
+    lines.append ('cbus_bus_load_ratio %.4f' % snapshot['bus_load'])
+    lines.append ('# TYPE cbus_bus_load_peak_ratio gauge')
+    lines.append ('cbus_bus_load_peak_ratio %.4f' % snapshot['bus_load_peak'])
+    lines.append ('# TYPE cbus_transmit_queue_depth gauge')
+    lines.append ('cbus_transmit_queue_depth %d' % snapshot['queue_depth'])
+    lines.append ('# TYPE cbus_request_latency_seconds histogram')
+    for name, histogram in sorted (snapshot['latency'].items()):
+        for bound, count in histogram['buckets']:
+            if bound == None:
+                bound = '+Inf'
+            lines.append ('cbus_request_latency_seconds_bucket{pair="%s",le="%s"} %d' % (name, bound, count))
+        lines.append ('cbus_request_latency_seconds_sum{pair="%s"} %.6f' % (name, histogram['sum']))
+        lines.append ('cbus_request_latency_seconds_count{pair="%s"} %d' % (name, histogram['count']))
+    return '\n'.join (lines) + '\n'
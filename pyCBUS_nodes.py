@@ -0,0 +1,164 @@
+# pyCBUS_nodes.py
+# Registry of the CBUS nodes present on the layout
+#
+# NodeRegistry collects the OPC_PNN answers to OPC_QNN, and keeps them in a cache indexed by node number.
+# Frames sent by the nodes for other reasons (events, acknowledges, answers requested by other tools, ...)
+# keep the entries alive, so the layout does not need to be queried again. Entries which are not refreshed
+# expire after ttl seconds. Node parameters (OPC_RQNPN -> OPC_PARAN) and names (OPC_RQMN -> OPC_NAME)
+# are read only when requested, then kept in the cache
+# The pyCBUS receiver must be running (pyCBUS.startReceiver)
+#
+#   registry = NodeRegistry()
+#   registry.discover()          # Only needed once, when the registry is empty
+#   for node in registry.getNodes():
+#       print (node.node_number, node.manufacturer, node.module_id, registry.getParameter (node.node_number, 7))
+
+import threading
+import time
+import pyCBUS
+from pyCBUS_requests import RequestTracker
+
+# Node parameters giving the information also reported by OPC_PNN
+PARAM_MANUFACTURER = 1
+PARAM_MODULE_ID = 3
+PARAM_FLAGS = 8
+
+# Frames sent by a node and carrying its node number : they show that the node is still present
+_NODE_FRAMES = [pyCBUS.OPC_RQNN, pyCBUS.OPC_NNACK, pyCBUS.OPC_WRACK, pyCBUS.OPC_CMDERR, pyCBUS.OPC_NVANS, \
+                pyCBUS.OPC_NUMEV, pyCBUS.OPC_EVNLF, pyCBUS.OPC_ENRSP, pyCBUS.OPC_NEVAL, pyCBUS.OPC_PARAN]
+for _opcodes in pyCBUS.ACCESSORY_OPCODES.values():
+    _NODE_FRAMES.extend (_opcodes)
+
+# Cached information about a node. manufacturer, module_id and flags are None until
+# they are received in OPC_PNN or read from the node parameters
+class NodeInfo:
+    __slots__ = ('node_number', 'manufacturer', 'module_id', 'flags', 'last_seen', 'parameters', 'name')
+
+    def __init__ (self, node_number):
+        self.node_number = node_number
+        self.manufacturer = None
+        self.module_id = None
+        self.flags = None
+        self.last_seen = time.monotonic()
+        self.parameters = {}    # Parameter index -> value
+        self.name = None
+
+class NodeRegistry:
+    # ttl : time in seconds after which a node which has not sent any frame is removed from the registry
+    # tracker : RequestTracker used for the requests, a new one is created on interface (pyCBUS module by default) if None
+    def __init__ (self, ttl = 300, tracker = None, interface = None):
+        if tracker == None:
+            tracker = RequestTracker (interface)
+            self.own_tracker = True
+        else:
+            self.own_tracker = False
+        self.tracker = tracker
+        self.interface = tracker.interface
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.nodes = {}    # Node number -> NodeInfo
+        self.interface.addMessageHandler (pyCBUS.OPC_PNN, self._onNodeReport)
+        self.interface.addMessageHandler (pyCBUS.OPC_NNREL, self._onNodeRelease)
+        for opcode in _NODE_FRAMES:
+            self.interface.addMessageHandler (opcode, self._onNodeFrame)
+
+    def close (self):
+        self.interface.removeMessageHandler (pyCBUS.OPC_PNN, self._onNodeReport)
+        self.interface.removeMessageHandler (pyCBUS.OPC_NNREL, self._onNodeRelease)
+        for opcode in _NODE_FRAMES:
+            self.interface.removeMessageHandler (opcode, self._onNodeFrame)
+        if self.own_tracker:
+            self.tracker.close()
+
+    # Return the entry of a node, creating it if needed. Lock must be held
+    def _touch (self, node_number):
+        node = self.nodes.get (node_number)
+        if node == None:
+            node = NodeInfo (node_number)
+            self.nodes[node_number] = node
+        else:
+            node.last_seen = time.monotonic()
+        return node
+
+    def _onNodeReport (self, msg):
+        report = pyCBUS.decodeCBUSMessage (msg)
+        with self.lock:
+            node = self._touch (report.node_number)
+            node.manufacturer = report.manufacturer
+            node.module_id = report.module_id
+            node.flags = report.flags
+
+    def _onNodeRelease (self, msg):
+        with self.lock:
+            self.nodes.pop (pyCBUS.decodeCBUSMessage (msg).node_number, None)
+
+    def _onNodeFrame (self, msg):
+        frame = pyCBUS.decodeCBUSMessage (msg)
+        if frame[0] == pyCBUS.OPC_CMDERR or frame.node_number == 0:
+            # Short events can be sent with node number 0. CMDERR is sometimes sent by a node being configured
+            # before it gets a node number : do not create entries for them, only refresh known nodes
+            with self.lock:
+                node = self.nodes.get (frame.node_number)
+                if node != None:
+                    node.last_seen = time.monotonic()
+            return
+        with self.lock:
+            node = self._touch (frame.node_number)
+            if frame[0] == pyCBUS.OPC_PARAN:
+                node.parameters[frame.index] = frame.value
+
+    # Remove the nodes which have not been seen for ttl seconds
+    def expire (self):
+        limit = time.monotonic() - self.ttl
+        with self.lock:
+            for node_number in [node.node_number for node in self.nodes.values() if node.last_seen < limit]:
+                del self.nodes[node_number]
+
+    # Broadcast OPC_QNN and wait during duration seconds for the answers
+    # Use it when the registry is empty (at startup), the registry is kept up to date by the traffic afterwards
+    def discover (self, duration = 1.0):
+        self.interface.sendFrame (pyCBUS.encodeQueryAllNodes())
+        time.sleep (duration)
+
+    # Return the NodeInfo of a node, or None if it is not known (or expired)
+    def getNode (self, node_number):
+        self.expire()
+        with self.lock:
+            return self.nodes.get (node_number)
+
+    # Return the list of the known nodes, sorted by node number
+    def getNodes (self):
+        self.expire()
+        with self.lock:
+            return [self.nodes[node_number] for node_number in sorted (self.nodes)]
+
+    # Return a node parameter. It is read from the node (OPC_RQNPN) only the first time
+    def getParameter (self, node_number, parameter_index, timeout = 1.0, retries = 2):
+        with self.lock:
+            node = self.nodes.get (node_number)
+            if node != None and parameter_index in node.parameters:
+                return node.parameters[parameter_index]
+        value = self.tracker.readNodeParameter (node_number, parameter_index, timeout, retries).result().value
+        with self.lock:
+            node = self._touch (node_number)
+            node.parameters[parameter_index] = value
+            if parameter_index == PARAM_MANUFACTURER and node.manufacturer == None:
+                node.manufacturer = value
+            elif parameter_index == PARAM_MODULE_ID and node.module_id == None:
+                node.module_id = value
+            elif parameter_index == PARAM_FLAGS and node.flags == None:
+                node.flags = value
+        return value
+
+    # Return the module name of a node. It is read from the node (OPC_RQMN) only the first time
+    # OPC_RQMN does not contain a node number : only the node in setup mode answers, so the node must be
+    # put in setup mode (usually with its push button) before its name can be read
+    def getName (self, node_number, timeout = 1.0, retries = 0):
+        with self.lock:
+            node = self.nodes.get (node_number)
+            if node != None and node.name != None:
+                return node.name
+        name = self.tracker.request (pyCBUS.encodeRequestModuleName(), [(pyCBUS.OPC_NAME, None, None)], timeout, retries).result().name
+        with self.lock:
+            self._touch (node_number).name = name
+        return name
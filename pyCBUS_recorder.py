@@ -0,0 +1,247 @@
+# pyCBUS_recorder.py
+# Binary recording and replay of the CBUS traffic
+#
+# TrafficRecorder appends every frame received or sent by the program to a binary log file, with
+# buffered writes. Each frame is stored in a fixed size record (timestamp, CAN identifier, DLC, flags,
+# 8 data bytes), so a log can be read at any position without parsing it from the start. Log files are
+# rotated when they reach max_size : log.cbrec is renamed log.cbrec.1, log.cbrec.1 is renamed log.cbrec.2, ...
+# TrafficLog memory-maps a log file for fast filtered scans, and replay sends recorded frames on a bus
+# at original speed, at a scaled speed or as fast as possible (load tests)
+# The pyCBUS receiver must be running (pyCBUS.startReceiver) for received frames to be recorded
+#
+#   recorder = TrafficRecorder ('layout.cbrec')
+#   ...
+#   recorder.close()
+#   for frame in TrafficLog ('layout.cbrec').frames (node_number = 1234):
+#       pyCBUS.dumpCBUSMessage (frame.toMessage())
+#   replay (TrafficLog ('layout.cbrec').frames(), speed = 2.0)
+
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+import can
+import pyCBUS
+
+# File format (little endian) :
+#   header : 'CBRC', version (1 byte), 3 bytes padding
+#   records : timestamp (double, seconds since epoch), CAN identifier (4 bytes), DLC (1 byte), flags (1 byte),
+#             2 bytes padding, data (8 bytes, unused bytes are 0)
+_LOG_MAGIC = b'CBRC'
+_LOG_VERSION = 1
+_LOG_HEADER = struct.Struct ('<4sBxxx')
+_LOG_RECORD = struct.Struct ('<dIBBxx8s')
+
+# Record flags
+FLAG_EXTENDED = 0x01      # Extended (29 bits) CAN identifier
+FLAG_REMOTE = 0x02        # Remote frame
+FLAG_ERROR = 0x04         # Error frame
+FLAG_SENT = 0x08          # Frame sent by the program (not received)
+
+# A recorded frame. data is bytes of dlc length
+class RecordedFrame (namedtuple ('RecordedFrame', 'timestamp arbitration_id dlc flags data')):
+    __slots__ = ()
+
+    # Return the frame as a python-can Msg
+    def toMessage (self):
+        return can.Message (timestamp=self.timestamp, arbitration_id=self.arbitration_id, data=self.data, dlc=self.dlc, \
+                            is_extended_id=(self.flags & FLAG_EXTENDED) != 0, is_remote_frame=(self.flags & FLAG_REMOTE) != 0, \
+                            is_error_frame=(self.flags & FLAG_ERROR) != 0)
+
+# Opcodes of the frames carrying a node number in data bytes 1-2, and an event (or device) number in data bytes 3-4
+_NODE_OPCODES = frozenset (opcode for opcode in range (256) if 'node_number' in pyCBUS.OPCODE_TABLE[opcode].message_type._fields)
+_EVENT_OPCODES = frozenset (opcode for opcode in range (256) if pyCBUS.OPCODE_TABLE[opcode].message_type in \
+                            (pyCBUS.EventMessage, pyCBUS.EventVariableRead, pyCBUS.EventLearn, pyCBUS.AccessoryEvent))
+
+# Return the list of the log files written by a recorder with the given file name, oldest first
+def recordedFiles (filename, max_files = 100):
+    files = [filename + '.' + str (number) for number in range (max_files, 0, -1) if os.path.exists (filename + '.' + str (number))]
+    if os.path.exists (filename):
+        files.append (filename)
+    return files
+
+class TrafficRecorder:
+    # filename : log file. Frames are appended if it already exists
+    # max_size : size in bytes from which the log file is rotated, None to never rotate
+    # max_files : number of rotated files kept (filename.1 to filename.max_files)
+    # buffer_size : write buffer size. Frames are written to disk when the buffer is full, by flush and by close
+    # interface : object used to register the receive and send handlers : pyCBUS module by default
+    def __init__ (self, filename, max_size = 64*1024*1024, max_files = 10, buffer_size = 64*1024, interface = None):
+        if interface == None:
+            interface = pyCBUS
+        self.interface = interface
+        self.filename = filename
+        self.max_size = max_size
+        self.max_files = max_files
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.file = None
+        self._open()
+        self.interface.addMessageHandler (None, self._onFrameReceived)
+        self.interface.addSendHandler (self._onFrameSent)
+
+    def close (self):
+        self.interface.removeMessageHandler (None, self._onFrameReceived)
+        self.interface.removeSendHandler (self._onFrameSent)
+        with self.lock:
+            self.file.close()
+
+    # Write the buffered frames to the log file
+    def flush (self):
+        with self.lock:
+            self.file.flush()
+
+    # Lock must be held (or recorder not started)
+    def _open (self):
+        self.file = open (self.filename, 'ab', buffering = self.buffer_size)
+        self.size = self.file.tell()
+        if self.size == 0:
+            self.file.write (_LOG_HEADER.pack (_LOG_MAGIC, _LOG_VERSION))
+            self.size = _LOG_HEADER.size
+
+    # Lock must be held
+    def _rotate (self):
+        self.file.close()
+        if self.max_files > 0:
+            for number in range (self.max_files - 1, 0, -1):
+                name = self.filename + '.' + str (number)
+                if os.path.exists (name):
+                    os.replace (name, self.filename + '.' + str (number + 1))
+            os.replace (self.filename, self.filename + '.1')
+        else:
+            os.remove (self.filename)
+        self._open()
+
+    def _record (self, msg, flags, timestamp):
+        if msg.is_extended_id:
+            flags = flags | FLAG_EXTENDED
+        if msg.is_remote_frame:
+            flags = flags | FLAG_REMOTE
+        if msg.is_error_frame:
+            flags = flags | FLAG_ERROR
+        record = _LOG_RECORD.pack (timestamp, msg.arbitration_id, msg.dlc, flags, bytes (msg.data))
+        with self.lock:
+            if self.file.closed:
+                return
+            if self.max_size != None and self.size >= self.max_size:
+                self._rotate()
+            self.file.write (record)
+            self.size = self.size + _LOG_RECORD.size
+
+    def _onFrameReceived (self, msg):
+        timestamp = msg.timestamp
+        if timestamp == 0:
+            timestamp = time.time()
+        self._record (msg, 0, timestamp)
+
+    # Sent messages are created by pyCBUS without timestamp
+    def _onFrameSent (self, msg):
+        self._record (msg, FLAG_SENT, time.time())
+
+class TrafficLog:
+    # filename : log file written by TrafficRecorder. The file is memory-mapped, not read in memory
+    def __init__ (self, filename):
+        with open (filename, 'rb') as log:
+            size = os.fstat (log.fileno()).st_size
+            if size < _LOG_HEADER.size:
+                raise ValueError (filename + ' is not a CBUS traffic log')
+            self.map = mmap.mmap (log.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, version = _LOG_HEADER.unpack_from (self.map, 0)
+        if magic != _LOG_MAGIC or version != _LOG_VERSION:
+            self.map.close()
+            raise ValueError (filename + ' is not a CBUS traffic log')
+        # An incomplete last record (recorder stopped while writing) is ignored
+        self.count = (size - _LOG_HEADER.size) // _LOG_RECORD.size
+
+    def close (self):
+        self.map.close()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__ (self):
+        return self.count
+
+    def __getitem__ (self, position):
+        if position < 0:
+            position = position + self.count
+        if position < 0 or position >= self.count:
+            raise IndexError ('Record index out of range')
+        timestamp, can_id, dlc, flags, data = _LOG_RECORD.unpack_from (self.map, _LOG_HEADER.size + position * _LOG_RECORD.size)
+        return RecordedFrame (timestamp, can_id, dlc, flags, data[:dlc])
+
+    # Return the recorded frames matching all the given filters, in recording order
+    # opcodes : list of CBUS opcodes. node_number : node number carried by the frame (requests, answers, events, ...)
+    # event_number : event or device number of event frames. start, end : timestamp range (end excluded)
+    # sent : True for the frames sent by the recording program only, False for the received frames only
+    # Filters are applied to the raw records, frames are only built for the matching records
+    def frames (self, opcodes = None, node_number = None, event_number = None, start = None, end = None, sent = None):
+        if opcodes != None:
+            opcodes = frozenset (opcodes)
+        if node_number != None:
+            node_bytes = struct.pack ('>H', node_number)
+        if event_number != None:
+            event_bytes = struct.pack ('>H', event_number)
+        cbus_filter = opcodes != None or node_number != None or event_number != None
+        # Records are unpacked one by one from the map : no buffer export pins the map, so the log can be closed
+        # while a scan is in progress (the scan then stops)
+        unpack = _LOG_RECORD.unpack_from
+        end_offset = _LOG_HEADER.size + self.count * _LOG_RECORD.size
+        for offset in range (_LOG_HEADER.size, end_offset, _LOG_RECORD.size):
+            try:
+                timestamp, can_id, dlc, flags, data = unpack (self.map, offset)
+            except ValueError:
+                return      # Log closed
+            if start != None and timestamp < start:
+                continue
+            if end != None and timestamp >= end:
+                continue
+            if sent != None and ((flags & FLAG_SENT) != 0) != sent:
+                continue
+            if cbus_filter:
+                if flags & (FLAG_EXTENDED | FLAG_REMOTE | FLAG_ERROR) or dlc == 0:
+                    continue
+                opcode = data[0]
+                if opcodes != None and opcode not in opcodes:
+                    continue
+                if node_number != None and (opcode not in _NODE_OPCODES or data[1:3] != node_bytes):
+                    continue
+                if event_number != None and (opcode not in _EVENT_OPCODES or data[3:5] != event_bytes):
+                    continue
+            yield RecordedFrame (timestamp, can_id, dlc, flags, data[:dlc])
+
+# Send recorded frames (RecordedFrame, for example from TrafficLog.frames) on a bus
+# speed : 1.0 to send the frames with their recorded timing, 2.0 twice as fast, ..., None to send them as fast as possible
+# interface : object used to send the frames : pyCBUS module by default. Frames are sent as recorded
+# (CAN identifier included), without going through the transmit scheduler
+# stop_event : threading.Event stopping the replay when set
+# Returns the number of frames sent
+def replay (frames, speed = 1.0, interface = None, stop_event = None):
+    if interface == None:
+        interface = pyCBUS
+    sent = 0
+    first = None
+    for frame in frames:
+        if stop_event != None and stop_event.is_set():
+            break
+        if frame.flags & FLAG_ERROR:
+            continue
+        if speed != None:
+            if first == None:
+                first = frame.timestamp
+                start = time.perf_counter()
+            delay = start + (frame.timestamp - first) / speed - time.perf_counter()
+            if delay > 0:
+                if stop_event != None:
+                    if stop_event.wait (delay):
+                        break
+                else:
+                    time.sleep (delay)
+        interface.sendMessage (frame.toMessage())
+        sent = sent + 1
+    return sent
@@ -0,0 +1,257 @@
+# pyCBUS_requests.py
+# Request / response correlation for CBUS configuration requests
+#
+# Requests such as OPC_NVRD or OPC_NVSET are answered by frames (OPC_NVANS, OPC_WRACK, OPC_CMDERR)
+# which must be matched with the request. RequestTracker sends the request, matches the answers
+# by (opcode, node number, index) and returns a concurrent.futures.Future. Requests which are not
+# answered in time are sent again, then fail with TimeoutError.
+# The pyCBUS receiver must be running (pyCBUS.startReceiver) for answers to be received
+#
+#   tracker = RequestTracker()
+#   values = tracker.readNodeVariables (1234, range (1, 256), window = 16)
+
+import heapq
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+import pyCBUS
+
+# Functions returning the value of the decoded answer compared with the request index, for answers which have one
+# Answers not listed here are matched on opcode and node number only, in the order requests were sent
+_ANSWER_INDEXES = {
+    pyCBUS.OPC_NVANS: lambda answer: answer.index,
+    pyCBUS.OPC_PARAN: lambda answer: answer.index,
+    pyCBUS.OPC_ENRSP: lambda answer: answer.index,
+    pyCBUS.OPC_NEVAL: lambda answer: (answer.index, answer.ev_index),
+    # Session requests (OPC_RLOC, OPC_GLOC) are matched on the loco address. For the OPC_ERR errors
+    # answering them, the two data bytes are the loco address
+    pyCBUS.OPC_PLOC: lambda answer: answer.address,
+    pyCBUS.OPC_ERR: lambda answer: ((answer.data1 & 0x3F) << 8) | answer.data2,
+}
+# Accessory responses (OPC_ARON, OPC_ARSOF, ...) are matched on their event or device number
+for (_is_short, _is_response, _is_on), _opcodes in pyCBUS.ACCESSORY_OPCODES.items():
+    if _is_response:
+        for _opcode in _opcodes:
+            _ANSWER_INDEXES[_opcode] = lambda answer: answer.event_number
+
+# A request waiting for its answer
+class PendingRequest:
+    __slots__ = ('frame', 'answers', 'future', 'timeout', 'retries', 'deadline')
+
+    def __init__ (self, frame, answers, timeout, retries):
+        self.frame = frame
+        self.answers = answers
+        self.future = Future()
+        self.timeout = timeout
+        self.retries = retries
+        self.deadline = 0
+
+class RequestTracker:
+    # interface : object used to send frames and register receive handlers : pyCBUS module by default
+    def __init__ (self, interface = None):
+        if interface == None:
+            interface = pyCBUS
+        self.interface = interface
+        self.lock = threading.Condition()
+        self.pending = {}         # (opcode, node number, index) -> list of PendingRequest, oldest first
+        self.deadlines = []       # Heap of (deadline, sequence number, PendingRequest)
+        self.sequence = 0
+        self.opcodes = set()      # Opcodes for which a receive handler is registered
+        self.thread = None
+        self.running = True
+
+    # Unregister the receive handlers and stop the timeout thread. Pending requests are cancelled
+    def close (self):
+        with self.lock:
+            self.running = False
+            for opcode in self.opcodes:
+                self.interface.removeMessageHandler (opcode, self._onMessage)
+            self.opcodes = set()
+            for deadline, sequence, request in self.deadlines:
+                request.future.cancel()
+            self.deadlines = []
+            self.pending = {}
+            self.lock.notify()
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+
+    # Send a request frame and return a Future which receives the decoded answer
+    # answers : list of (opcode, node number, index) accepted as answer to the request.
+    # node number or index can be None to accept any value
+    # An OPC_CMDERR answer sets pyCBUS.CBUSCommandError as exception of the Future
+    # If no answer is received within timeout seconds, the request is sent again up to retries times,
+    # then the Future gets a TimeoutError exception
+    def request (self, frame, answers, timeout = 1.0, retries = 2):
+        request = PendingRequest (frame, answers, timeout, retries)
+        with self.lock:
+            if not self.running:
+                raise RuntimeError ('RequestTracker is closed')
+            for key in answers:
+                if key[0] not in self.opcodes:
+                    self.interface.addMessageHandler (key[0], self._onMessage)
+                    self.opcodes.add (key[0])
+                self.pending.setdefault (key, []).append (request)
+            self._schedule (request)
+            if self.thread == None:
+                self.thread = threading.Thread (target=self._timeoutThread, daemon=True)
+                self.thread.start()
+        self.interface.sendFrame (frame)
+        return request.future
+
+    # Lock must be held
+    def _schedule (self, request):
+        request.deadline = time.monotonic() + request.timeout
+        self.sequence = self.sequence + 1
+        heapq.heappush (self.deadlines, (request.deadline, self.sequence, request))
+        self.lock.notify()
+
+    # Remove a request from the pending table, which also cancels its timeout. Lock must be held
+    def _remove (self, request):
+        request.deadline = 0
+        for key in request.answers:
+            requests = self.pending.get (key)
+            if requests != None and request in requests:
+                requests.remove (request)
+                if len (requests) == 0:
+                    del self.pending[key]
+
+    # Receive handler for all opcodes used as answer
+    def _onMessage (self, msg):
+        answer = pyCBUS.decodeCBUSMessage (msg)
+        opcode = answer[0]
+        node_number = getattr (answer, 'node_number', None)
+        getIndex = _ANSWER_INDEXES.get (opcode)
+        if getIndex == None:
+            index = None
+        else:
+            index = getIndex (answer)
+        with self.lock:
+            requests = self.pending.get ((opcode, node_number, index))
+            if requests == None and index != None:
+                requests = self.pending.get ((opcode, node_number, None))
+                if requests == None:
+                    requests = self.pending.get ((opcode, None, index))
+            if requests == None:
+                requests = self.pending.get ((opcode, None, None))
+            if requests == None:
+                return
+            request = requests[0]
+            self._remove (request)
+        try:
+            if opcode == pyCBUS.OPC_CMDERR:
+                request.future.set_exception (pyCBUS.CBUSCommandError (answer.node_number, answer.error))
+            else:
+                request.future.set_result (answer)
+        except InvalidStateError:
+            pass        # Future cancelled by the caller
+
+    # Single thread handling the timeouts of all requests
+    # Frames are sent and futures are completed without the lock : sendFrame can block (transmit queue full), and
+    # the receiver thread needs the lock to deliver the answers
+    def _timeoutThread (self):
+        with self.lock:
+            while self.running:
+                if len (self.deadlines) == 0:
+                    self.lock.wait()
+                    continue
+                now = time.monotonic()
+                if self.deadlines[0][0] > now:
+                    self.lock.wait (self.deadlines[0][0] - now)
+                    continue
+                resend = []
+                expired = []
+                while len (self.deadlines) > 0 and self.deadlines[0][0] <= now:
+                    deadline, sequence, request = heapq.heappop (self.deadlines)
+                    if request.future.done() or deadline != request.deadline:
+                        continue
+                    if request.retries > 0:
+                        request.retries = request.retries - 1
+                        self._schedule (request)
+                        resend.append (request.frame)
+                    else:
+                        self._remove (request)
+                        expired.append (request)
+                self.lock.release()
+                try:
+                    for frame in resend:
+                        try:
+                            self.interface.sendFrame (frame)
+                        except Exception:
+                            traceback.print_exc()    # Request times out if the frame could not be sent
+                    for request in expired:
+                        try:
+                            request.future.set_exception (TimeoutError ('No answer to CBUS request ' + request.frame.hex()))
+                        except InvalidStateError:
+                            pass    # Future cancelled by the caller
+                finally:
+                    self.lock.acquire()
+
+    # *** NODE VARIABLES ***
+    # Read one node variable. The Future result is the decoded OPC_NVANS answer
+    def readNodeVariable (self, node_number, variable_number, timeout = 1.0, retries = 2):
+        return self.request (pyCBUS.encodeReadNodeVariable (node_number, variable_number), \
+                             [(pyCBUS.OPC_NVANS, node_number, variable_number), (pyCBUS.OPC_CMDERR, node_number, None)], \
+                             timeout, retries)
+
+    # Write one node variable. The Future result is the decoded OPC_WRACK answer
+    def setNodeVariable (self, node_number, variable_number, variable_value, timeout = 1.0, retries = 2):
+        frame = pyCBUS.encodeSetNodeVariable (node_number, variable_number, variable_value)
+        if frame == None:
+            raise ValueError ('Invalid node variable number %d' % variable_number)
+        return self.request (frame, [(pyCBUS.OPC_WRACK, node_number, None), (pyCBUS.OPC_CMDERR, node_number, None)], \
+                             timeout, retries)
+
+    # *** NODE PARAMETERS AND EVENTS ***
+    # Read one node parameter. The Future result is the decoded OPC_PARAN answer
+    def readNodeParameter (self, node_number, parameter_index, timeout = 1.0, retries = 2):
+        return self.request (pyCBUS.encodeReadNodeParameter (node_number, parameter_index), \
+                             [(pyCBUS.OPC_PARAN, node_number, parameter_index), (pyCBUS.OPC_CMDERR, node_number, None)], \
+                             timeout, retries)
+
+    # Read the number of events stored in a node. The Future result is the decoded OPC_NUMEV answer
+    def readNumberOfEvents (self, node_number, timeout = 1.0, retries = 2):
+        return self.request (pyCBUS.encodeReadNumberOfEvents (node_number), \
+                             [(pyCBUS.OPC_NUMEV, node_number, None), (pyCBUS.OPC_CMDERR, node_number, None)], \
+                             timeout, retries)
+
+    # Read the event stored at a given index of a node table. The Future result is the decoded OPC_ENRSP answer
+    def readEventFromNumber (self, node_number, event_index, timeout = 1.0, retries = 2):
+        frame = pyCBUS.encodeReadEventFromNumber (node_number, event_index)
+        if frame == None:
+            raise ValueError ('Invalid event index %d' % event_index)
+        return self.request (frame, [(pyCBUS.OPC_ENRSP, node_number, event_index), (pyCBUS.OPC_CMDERR, node_number, None)], \
+                             timeout, retries)
+
+    # Read an event variable of the event stored at event_index. The Future result is the decoded OPC_NEVAL answer
+    def readEventVariable (self, node_number, event_index, event_variable, timeout = 1.0, retries = 2):
+        return self.request (pyCBUS.encodeReadEventVariable (node_number, event_index, event_variable), \
+                             [(pyCBUS.OPC_NEVAL, node_number, (event_index, event_variable)), \
+                              (pyCBUS.OPC_CMDERR, node_number, None)], timeout, retries)
+
+    # Run requests with at most window requests waiting for their answer at the same time
+    # make_request is called for each item and returns a Future. Returns the list of results
+    # The first failed request raises its exception, requests still in flight are left to complete or time out
+    def pipeline (self, items, make_request, window):
+        in_flight = deque()
+        results = []
+        for item in items:
+            if len (in_flight) >= window:
+                results.append (in_flight.popleft().result())
+            in_flight.append (make_request (item))
+        while len (in_flight) > 0:
+            results.append (in_flight.popleft().result())
+        return results
+
+    # Read several node variables of a node, with up to window reads in flight
+    # Returns a dictionary variable number -> value
+    def readNodeVariables (self, node_number, variables, window = 8, timeout = 1.0, retries = 2):
+        answers = self.pipeline (variables, lambda variable: self.readNodeVariable (node_number, variable, timeout, retries), window)
+        return dict ((answer.index, answer.value) for answer in answers)
+
+    # Write several node variables of a node given as a dictionary variable number -> value,
+    # with up to window writes waiting for their acknowledge
+    def writeNodeVariables (self, node_number, values, window = 8, timeout = 1.0, retries = 2):
+        self.pipeline (values.items(), lambda item: self.setNodeVariable (node_number, item[0], item[1], timeout, retries), window)
@@ -0,0 +1,616 @@
+# pyCBUS_sessions.py
+# Loco session management
+#
+# SessionManager keeps the loco address -> session map (see SESSION MANAGER below)
+#
+# KeepaliveScheduler sends the OPC_DKEEP keepalive of all the sessions used by the program, from a single
+# thread. Keepalives are spread over the keepalive period instead of being sent in bursts, and the
+# keepalive of a session is not sent when a speed or function frame has been sent for this session
+# during the last period, as the command station already knows the session is alive.
+# Sessions are forgotten when they are released (OPC_KLOC) or cancelled by the command station (OPC_ERR)
+# The pyCBUS receiver must be running (pyCBUS.startReceiver)
+#
+#   keepalive = KeepaliveScheduler (period = 4.0)
+#   keepalive.addSession (session)
+
+import heapq
+import math
+import struct
+import threading
+import time
+import traceback
+import pyCBUS
+from pyCBUS_requests import RequestTracker
+
+# Command station error codes (OPC_ERR) for which the data bytes are the loco address
+ERR_LOCO_STACK_FULL = 1
+ERR_LOCO_ADDRESS_TAKEN = 2
+ERR_INVALID_REQUEST = 7
+# Command station error codes (OPC_ERR) for which the first data byte is a session number
+ERR_SESSION_NOT_PRESENT = 3
+ERR_SESSION_CANCELLED = 8
+
+# Frames which keep a session alive
+_SESSION_TRAFFIC = (pyCBUS.OPC_DSPD, pyCBUS.OPC_DFNON, pyCBUS.OPC_DFNOF, pyCBUS.OPC_DFUN)
+
+# Return the n-th value of the Van der Corput sequence (0, 1/2, 1/4, 3/4, 1/8, ...)
+# Successive values are always spread evenly over [0, 1[, whatever the number of values used
+def _spread (n):
+    value = 0.0
+    weight = 0.5
+    while n > 0:
+        if n & 1:
+            value = value + weight
+        n = n >> 1
+        weight = weight / 2
+    return value
+
+class KeepaliveScheduler:
+    # period : time between two keepalives of a session, in seconds. It must be shorter than half the
+    # session timeout of the command station, as a keepalive can be skipped after speed or function traffic
+    # interface : object used to send frames and register handlers : pyCBUS module by default
+    def __init__ (self, period = 4.0, interface = None):
+        if interface == None:
+            interface = pyCBUS
+        self.interface = interface
+        self.period = period
+        self.lock = threading.Condition()
+        self.sessions = {}      # Session -> [time of the last speed or function frame, slot, phase index]
+        self.schedule = []      # Heap of (time of next keepalive, slot, session)
+        self.slot = 0           # Counter giving a different slot each time a session is added
+        # Keepalives of a session are sent at start + k * period + period * _spread (phase index). All phases
+        # are relative to the same origin, and each session gets the lowest phase index not used by another session,
+        # so keepalives stay evenly spread over the period whatever the time sessions are added or removed
+        self.start = time.monotonic()
+        self.running = True
+        for opcode in _SESSION_TRAFFIC:
+            self.interface.addMessageHandler (opcode, self._onSessionTraffic)
+        self.interface.addMessageHandler (pyCBUS.OPC_KLOC, self._onSessionRelease)
+        self.interface.addMessageHandler (pyCBUS.OPC_ERR, self._onError)
+        self.interface.addSendHandler (self._onFrameSent)
+        self.thread = threading.Thread (target=self._keepaliveThread, daemon=True)
+        self.thread.start()
+
+    def close (self):
+        for opcode in _SESSION_TRAFFIC:
+            self.interface.removeMessageHandler (opcode, self._onSessionTraffic)
+        self.interface.removeMessageHandler (pyCBUS.OPC_KLOC, self._onSessionRelease)
+        self.interface.removeMessageHandler (pyCBUS.OPC_ERR, self._onError)
+        self.interface.removeSendHandler (self._onFrameSent)
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+        self.thread.join()
+
+    # Start sending keepalives for a session
+    def addSession (self, session):
+        with self.lock:
+            if session in self.sessions:
+                return
+            self.slot = self.slot + 1
+            used = set (state[2] for state in self.sessions.values())
+            index = 0
+            while index in used:
+                index = index + 1
+            self.sessions[session] = [0, self.slot, index]
+            phase = self.start + self.period * _spread (index)
+            due = phase + self.period * math.ceil ((time.monotonic() - phase) / self.period)
+            heapq.heappush (self.schedule, (due, self.slot, session))
+            self.lock.notify()
+
+    # Stop sending keepalives for a session
+    def removeSession (self, session):
+        with self.lock:
+            self.sessions.pop (session, None)
+
+    def getSessions (self):
+        with self.lock:
+            return list (self.sessions)
+
+    def _onSessionTraffic (self, msg):
+        session = msg.data[1]
+        with self.lock:
+            state = self.sessions.get (session)
+            if state != None:
+                state[0] = time.monotonic()
+
+    def _onSessionRelease (self, msg):
+        self.removeSession (msg.data[1])
+
+    def _onError (self, msg):
+        error = pyCBUS.decodeCBUSMessage (msg)
+        if error.error == ERR_SESSION_NOT_PRESENT or error.error == ERR_SESSION_CANCELLED:
+            self.removeSession (error.data1)
+
+    def _onFrameSent (self, msg):
+        if msg.dlc < 2:
+            return
+        if msg.data[0] == pyCBUS.OPC_KLOC:
+            self._onSessionRelease (msg)
+        elif msg.data[0] in _SESSION_TRAFFIC:
+            self._onSessionTraffic (msg)
+
+    def _keepaliveThread (self):
+        with self.lock:
+            while self.running:
+                if len (self.schedule) == 0:
+                    self.lock.wait()
+                    continue
+                due, slot, session = self.schedule[0]
+                now = time.monotonic()
+                if due > now:
+                    self.lock.wait (due - now)
+                    continue
+                heapq.heappop (self.schedule)
+                state = self.sessions.get (session)
+                if state == None or state[1] != slot:
+                    continue        # Session has been removed (and maybe added again with another slot)
+                # Next keepalive keeps the same phase, so keepalives stay spread over the period
+                heapq.heappush (self.schedule, (due + self.period, slot, session))
+                if now - state[0] < self.period:
+                    continue
+                self.lock.release()
+                try:
+                    self.interface.sendFrame (pyCBUS.encodeKeepAliveSession (session))
+                except Exception:
+                    traceback.print_exc()    # Keepalive will be sent again at next period
+                finally:
+                    self.lock.acquire()
+
+# *** THROTTLE ENGINE ***
+# ThrottleEngine keeps the desired speed, direction and functions of each session, and sends the changes
+# at a fixed tick : whatever the number of updates made by the application between two ticks, at most one
+# OPC_DSPD frame (and the minimum number of function frames) is sent per session and per tick.
+# Acceleration and deceleration (momentum) and a speed curve can be applied to the requested speed
+#
+#   throttle = ThrottleEngine (tick = 0.1, acceleration = 40, deceleration = 60)
+#   throttle.setSpeed (session, 80, forward = True)     # Speed 0 (stop) to 126
+#   throttle.setFunction (session, 0, True)             # Headlights on
+
+# DFUN function groups : group number -> (first function, last function)
+_FUNCTION_GROUPS = {
+    1: (0, 4),
+    2: (5, 8),
+    3: (9, 12),
+    4: (13, 20),
+    5: (21, 28),
+}
+
+# Return the DFUN group of a function, None for functions above F28
+def _functionGroup (function):
+    for group, (first, last) in _FUNCTION_GROUPS.items():
+        if first <= function <= last:
+            return group
+    return None
+
+# Return the bitmask of the functions of a DFUN group
+def _functionGroupMask (group):
+    first, last = _FUNCTION_GROUPS[group]
+    return ((1 << (last - first + 1)) - 1) << first
+
+# Return the DFUN value of a group from the bitmask of the active functions (bit n = Fn)
+# In group 1, F0 is bit 4 and F1 to F4 are bits 0 to 3
+def _functionGroupValue (group, functions):
+    first, last = _FUNCTION_GROUPS[group]
+    if group == 1:
+        return ((functions & 1) << 4) | ((functions >> 1) & 0x0F)
+    return (functions >> first) & ((1 << (last - first + 1)) - 1)
+
+# Return a speed curve : requested speed 0..126 -> speed sent to the decoder. exponent greater than 1
+# gives more precision at low speed
+def speedCurve (exponent):
+    return lambda speed: int (round (126 * (speed / 126.0) ** exponent))
+
+class _ThrottleState:
+    def __init__ (self):
+        self.target = 0             # Requested speed (0 to 126), after the speed curve
+        self.forward = True         # Requested direction
+        self.speed = 0.0            # Current speed, following the target with momentum
+        self.current_forward = True
+        self.functions = 0          # Bitmask of the requested functions (bit n = Fn)
+        # Bitmask of the functions set by setFunction. The state of the other functions is unknown (a function may have
+        # been activated by another cab), so they are never sent, and a DFUN group frame is only sent when all the
+        # functions of the group are known
+        self.known_functions = 0
+        self.sent_speed = None      # DSPD value sent on the bus (None : nothing sent yet)
+        self.sent_functions = 0     # Bitmask of the functions sent on the bus
+        self.sent_known = 0         # Bitmask of the functions sent at least once
+        self.emergency = False
+        # False until setSpeed or emergencyStop is called : the speed of the loco is unknown,
+        # so no DSPD is sent (it would stop a loco already moving)
+        self.speed_requested = False
+
+class ThrottleEngine:
+    # tick : time between two transmissions, in seconds
+    # acceleration, deceleration : maximum speed change in speed steps per second, None for no momentum
+    # curve : function applied to the requested speed (see speedCurve), None to send the requested speed
+    # interface : object used to send frames : pyCBUS module by default
+    def __init__ (self, tick = 0.1, acceleration = None, deceleration = None, curve = None, interface = None):
+        if interface == None:
+            interface = pyCBUS
+        self.interface = interface
+        self.tick = tick
+        self.acceleration = acceleration
+        self.deceleration = deceleration
+        self.curve = curve
+        self.lock = threading.Lock()
+        self.sessions = {}      # Session -> _ThrottleState
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread (target=self._tickThread, daemon=True)
+        self.thread.start()
+
+    def close (self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _state (self, session):
+        state = self.sessions.get (session)
+        if state == None:
+            state = _ThrottleState()
+            self.sessions[session] = state
+        return state
+
+    # Set the requested speed (0 = stop, 1 to 126) and direction of a session
+    def setSpeed (self, session, speed, forward):
+        if speed < 0 or speed > 126:
+            return
+        if self.curve != None:
+            speed = self.curve (speed)
+        with self.lock:
+            state = self._state (session)
+            state.target = speed
+            state.forward = forward
+            state.emergency = False
+            state.speed_requested = True
+
+    # Stop the loco immediately (DCC emergency stop), without momentum
+    def emergencyStop (self, session):
+        with self.lock:
+            state = self._state (session)
+            state.target = 0
+            state.speed = 0.0
+            state.emergency = True
+            state.speed_requested = True
+
+    def setFunction (self, session, function, activate):
+        with self.lock:
+            state = self._state (session)
+            state.known_functions = state.known_functions | (1 << function)
+            if activate:
+                state.functions = state.functions | (1 << function)
+            else:
+                state.functions = state.functions & ~(1 << function)
+
+    # Forget a session (for example when it is released)
+    def removeSession (self, session):
+        with self.lock:
+            self.sessions.pop (session, None)
+
+    # Move the current speed towards the target speed for elapsed seconds
+    def _applyMomentum (self, state, elapsed):
+        if state.forward != state.current_forward and state.speed > 0:
+            target = 0      # Direction change : stop first
+        else:
+            state.current_forward = state.forward
+            target = state.target
+        if state.speed < target:
+            if self.acceleration == None:
+                state.speed = target
+            else:
+                state.speed = min (target, state.speed + self.acceleration * elapsed)
+        elif state.speed > target:
+            if self.deceleration == None:
+                state.speed = target
+            else:
+                state.speed = max (target, state.speed - self.deceleration * elapsed)
+        if state.speed == 0:
+            state.current_forward = state.forward
+
+    # Return the frames needed to send the changes of a session
+    def _sessionFrames (self, session, state, elapsed):
+        frames = []
+        if state.speed_requested:
+            if state.emergency:
+                dspd = 1
+            else:
+                self._applyMomentum (state, elapsed)
+                speed = int (state.speed)
+                if speed == 0:
+                    dspd = 0
+                else:
+                    dspd = speed + 1        # DCC speed step 1 is emergency stop
+            if state.current_forward:
+                dspd = dspd | 0x80
+            if dspd != state.sent_speed:
+                frames.append (pyCBUS.encodeSpeedAndDirection (session, dspd & 0x7F, state.current_forward))
+                state.sent_speed = dspd
+        known = state.known_functions
+        changed = ((state.functions ^ state.sent_functions) | (known & ~state.sent_known)) & known
+        if changed != 0:
+            groups = {}
+            function = 0
+            while changed >> function:
+                if (changed >> function) & 1:
+                    groups.setdefault (_functionGroup (function), []).append (function)
+                function = function + 1
+            for group, functions in groups.items():
+                if group != None and len (functions) > 1 and _functionGroupMask (group) & ~known == 0:
+                    # One DFUN frame is shorter than several DFNON / DFNOF frames
+                    frames.append (pyCBUS.encodeEngineFunctionGroup (session, group, _functionGroupValue (group, state.functions)))
+                else:
+                    for function in functions:
+                        frames.append (pyCBUS.encodeEngineFunction (session, function, (state.functions >> function) & 1 == 1))
+            state.sent_functions = state.functions
+            state.sent_known = known
+        return frames
+
+    def _tickThread (self):
+        last_tick = time.monotonic()
+        while not self.stop_event.wait (self.tick):
+            now = time.monotonic()
+            elapsed = now - last_tick
+            last_tick = now
+            frames = []
+            with self.lock:
+                for session, state in self.sessions.items():
+                    frames.extend (self._sessionFrames (session, state, elapsed))
+            if len (frames) > 0:
+                try:
+                    self.interface.sendMany (frames)
+                except Exception:
+                    traceback.print_exc()
+
+# *** SESSION MANAGER ***
+# SessionManager keeps the loco address -> session map of the command station, from the OPC_PLOC, OPC_KLOC
+# and OPC_ERR frames, and the last speed, direction and functions sent to each session (by this program or by other cabs)
+# acquire returns the session of a loco without any bus traffic when the program already has it. A loco used
+# by another cab (or by this program before a restart, see saveCache / loadCache) is attached with one OPC_GLOC
+# (share or steal) instead of OPC_RLOC, OPC_ERR, OPC_KLOC round trips
+#
+#   manager = SessionManager (keepalive = KeepaliveScheduler())
+#   manager.loadCache ('sessions.cbss')
+#   loco = manager.acquire (4321)
+#   pyCBUS.setSpeedAndDirection (loco.session, loco.speed, loco.forward)
+
+# Exception raised when the command station answers a session request with OPC_ERR
+class SessionError (Exception):
+    def __init__ (self, address, error):
+        Exception.__init__ (self, 'Command station refused session for loco %d (error %d)' % (address, error))
+        self.address = address
+        self.error = error
+
+# Return the functions bitmask (bit n = Fn) with the functions of a DFUN group set to value
+def _setFunctionGroup (functions, group, value):
+    first, last = _FUNCTION_GROUPS[group]
+    if group == 1:
+        value = ((value >> 4) & 1) | ((value & 0x0F) << 1)
+    mask = ((1 << (last - first + 1)) - 1) << first
+    return (functions & ~mask) | ((value << first) & mask)
+
+# Session of a loco. speed is the DSPD speed (0 stop, 1 emergency stop, 2 to 127), functions the bitmask
+# of the active functions (bit n = Fn). owned is True for the sessions acquired by this program, confirmed is
+# False for the sessions loaded from the cache file, until the command station has confirmed them
+class LocoSession:
+    __slots__ = ('address', 'session', 'speed', 'forward', 'functions', 'owned', 'confirmed')
+
+    def __init__ (self, address, session):
+        self.address = address
+        self.session = session
+        self.speed = 0
+        self.forward = True
+        self.functions = 0
+        self.owned = False
+        self.confirmed = True
+
+# Frames updating the cached state of a session
+_SESSION_STATE_FRAMES = (pyCBUS.OPC_DSPD, pyCBUS.OPC_DFNON, pyCBUS.OPC_DFNOF, pyCBUS.OPC_DFUN)
+
+class SessionManager:
+    # tracker : RequestTracker used for the session requests, a new one is created on interface
+    # (pyCBUS module by default) if None
+    # keepalive : KeepaliveScheduler to which the acquired sessions are added, None if keepalives are sent by the program
+    def __init__ (self, tracker = None, interface = None, keepalive = None):
+        if tracker == None:
+            tracker = RequestTracker (interface)
+            self.own_tracker = True
+        else:
+            self.own_tracker = False
+        self.tracker = tracker
+        self.interface = tracker.interface
+        self.keepalive = keepalive
+        self.lock = threading.Lock()
+        self.locos = {}         # Loco address -> LocoSession
+        self.sessions = {}      # Session -> LocoSession
+        self.interface.addMessageHandler (pyCBUS.OPC_PLOC, self._onEngineReport)
+        self.interface.addMessageHandler (pyCBUS.OPC_KLOC, self._onSessionRelease)
+        self.interface.addMessageHandler (pyCBUS.OPC_ERR, self._onError)
+        for opcode in _SESSION_STATE_FRAMES:
+            self.interface.addMessageHandler (opcode, self._onSessionState)
+        self.interface.addSendHandler (self._onFrameSent)
+
+    def close (self):
+        self.interface.removeMessageHandler (pyCBUS.OPC_PLOC, self._onEngineReport)
+        self.interface.removeMessageHandler (pyCBUS.OPC_KLOC, self._onSessionRelease)
+        self.interface.removeMessageHandler (pyCBUS.OPC_ERR, self._onError)
+        for opcode in _SESSION_STATE_FRAMES:
+            self.interface.removeMessageHandler (opcode, self._onSessionState)
+        self.interface.removeSendHandler (self._onFrameSent)
+        if self.own_tracker:
+            self.tracker.close()
+
+    # Lock must be held
+    def _forget (self, loco):
+        if self.locos.get (loco.address) is loco:
+            del self.locos[loco.address]
+        if self.sessions.get (loco.session) is loco:
+            del self.sessions[loco.session]
+
+    # Record a session reported by the command station, returns its LocoSession
+    def _record (self, report):
+        with self.lock:
+            loco = self.locos.get (report.address)
+            if loco == None or loco.session != report.session:
+                if loco != None:
+                    self._forget (loco)
+                previous = self.sessions.get (report.session)
+                if previous != None:
+                    self._forget (previous)     # Session number reused by the command station
+                loco = LocoSession (report.address, report.session)
+                self.locos[report.address] = loco
+                self.sessions[report.session] = loco
+            loco.speed = report.speed
+            loco.forward = report.forward
+            functions = _setFunctionGroup (loco.functions, 1, report.functions1)
+            functions = _setFunctionGroup (functions, 2, report.functions2)
+            loco.functions = _setFunctionGroup (functions, 3, report.functions3)
+            loco.confirmed = True
+            return loco
+
+    def _onEngineReport (self, msg):
+        self._record (pyCBUS.decodeCBUSMessage (msg))
+
+    def _onSessionRelease (self, msg):
+        with self.lock:
+            loco = self.sessions.get (msg.data[1])
+            if loco != None:
+                self._forget (loco)
+
+    def _onError (self, msg):
+        error = pyCBUS.decodeCBUSMessage (msg)
+        if error.error == ERR_SESSION_NOT_PRESENT or error.error == ERR_SESSION_CANCELLED:
+            with self.lock:
+                loco = self.sessions.get (error.data1)
+                if loco != None:
+                    self._forget (loco)
+
+    def _onSessionState (self, msg):
+        frame = pyCBUS.decodeCBUSMessage (msg)
+        with self.lock:
+            loco = self.sessions.get (frame.session)
+            if loco == None:
+                return
+            if frame.opcode == pyCBUS.OPC_DSPD:
+                loco.speed = frame.speed
+                loco.forward = frame.forward
+            elif frame.opcode == pyCBUS.OPC_DFUN:
+                if frame.group in _FUNCTION_GROUPS:
+                    loco.functions = _setFunctionGroup (loco.functions, frame.group, frame.value)
+            elif frame.is_on:
+                loco.functions = loco.functions | (1 << frame.function)
+            else:
+                loco.functions = loco.functions & ~(1 << frame.function)
+
+    def _onFrameSent (self, msg):
+        if msg.dlc < 2:
+            return
+        if msg.data[0] == pyCBUS.OPC_KLOC:
+            self._onSessionRelease (msg)
+        elif msg.data[0] in _SESSION_STATE_FRAMES:
+            self._onSessionState (msg)
+
+    # Send a session request and return the OPC_PLOC or OPC_ERR answer
+    def _request (self, frame, address, timeout, retries):
+        if frame == None:
+            raise ValueError ('Invalid loco address %d' % address)
+        return self.tracker.request (frame, [(pyCBUS.OPC_PLOC, None, address), (pyCBUS.OPC_ERR, None, address)], \
+                                     timeout, retries).result()
+
+    # Return the LocoSession of a loco, acquiring a session from the command station if needed
+    # A loco whose session is known is attached with one OPC_GLOC : share for the sessions loaded from the cache file,
+    # share (share = True) or steal (steal = True) for the sessions of other cabs. Other locos are requested with OPC_RLOC.
+    # If the loco is used by another cab and share and steal are False, SessionError is raised
+    def acquire (self, address, share = True, steal = False, timeout = 1.0, retries = 1):
+        with self.lock:
+            loco = self.locos.get (address)
+            if loco != None and loco.owned and loco.confirmed:
+                return loco
+        answer = None
+        if loco != None:
+            if loco.owned or (share and not steal):
+                flags = pyCBUS.GLOC_SHARE
+            elif steal:
+                flags = pyCBUS.GLOC_STEAL
+            else:
+                raise SessionError (address, ERR_LOCO_ADDRESS_TAKEN)
+            try:
+                answer = self._request (pyCBUS.encodeGetSession (address, flags), address, timeout, retries)
+            except TimeoutError:
+                answer = None       # Command station without OPC_GLOC support
+        if answer == None:
+            answer = self._request (pyCBUS.encodeRequestSession (address), address, timeout, retries)
+            if answer.opcode == pyCBUS.OPC_ERR and answer.error == ERR_LOCO_ADDRESS_TAKEN and (share or steal):
+                if steal:
+                    flags = pyCBUS.GLOC_STEAL
+                else:
+                    flags = pyCBUS.GLOC_SHARE
+                answer = self._request (pyCBUS.encodeGetSession (address, flags), address, timeout, retries)
+        if answer.opcode == pyCBUS.OPC_ERR:
+            raise SessionError (address, answer.error)
+        # The answer can be given by the tracker before it is recorded by _onEngineReport
+        loco = self._record (answer)
+        loco.owned = True
+        if self.keepalive != None:
+            self.keepalive.addSession (loco.session)
+        return loco
+
+    # Release the session of a loco (OPC_KLOC)
+    def release (self, address):
+        with self.lock:
+            loco = self.locos.get (address)
+        if loco == None:
+            return
+        self.interface.sendFrame (pyCBUS.encodeReleaseSession (loco.session))
+        with self.lock:
+            self._forget (loco)
+
+    # Return the LocoSession of a loco, or None if its session is not known. No frame is sent
+    def getLoco (self, address):
+        with self.lock:
+            return self.locos.get (address)
+
+    # Return the list of the known sessions (all cabs), sorted by loco address
+    def getLocos (self):
+        with self.lock:
+            return [self.locos[address] for address in sorted (self.locos)]
+
+    # Save the sessions owned by this program, so they can be attached again after a restart (see loadCache)
+    def saveCache (self, filename):
+        with self.lock:
+            locos = [loco for loco in self.locos.values() if loco.owned]
+        data = [_CACHE_HEADER.pack (_CACHE_MAGIC, _CACHE_VERSION, len (locos))]
+        for loco in locos:
+            data.append (_CACHE_SESSION.pack (loco.address, loco.session, loco.speed, loco.forward, loco.functions))
+        with open (filename, 'wb') as cache:
+            cache.write (b''.join (data))
+
+    # Load sessions saved by saveCache. They are attached again by acquire with OPC_GLOC share, which
+    # returns the same session if the command station still has it. Their cached speed and functions are kept
+    # until the command station reports the current ones
+    def loadCache (self, filename):
+        with open (filename, 'rb') as cache:
+            data = cache.read()
+        magic, version, count = _CACHE_HEADER.unpack_from (data, 0)
+        if magic != _CACHE_MAGIC or version != _CACHE_VERSION:
+            raise ValueError (filename + ' is not a session cache file')
+        with self.lock:
+            for position in range (count):
+                address, session, speed, forward, functions = \
+                    _CACHE_SESSION.unpack_from (data, _CACHE_HEADER.size + position * _CACHE_SESSION.size)
+                if address in self.locos or session in self.sessions:
+                    continue
+                loco = LocoSession (address, session)
+                loco.speed = speed
+                loco.forward = forward != 0
+                loco.functions = functions
+                loco.owned = True
+                loco.confirmed = False
+                self.locos[address] = loco
+                self.sessions[session] = loco
+
+# Session cache file format (big endian) :
+#   header : 'CBSS', version (1 byte), number of sessions (2 bytes)
+#   for each session : loco address (2 bytes), session (1 byte), speed (1 byte), forward (1 byte), functions (4 bytes)
+_CACHE_MAGIC = b'CBSS'
+_CACHE_VERSION = 1
+_CACHE_HEADER = struct.Struct ('>4sBH')
+_CACHE_SESSION = struct.Struct ('>HBBBI')
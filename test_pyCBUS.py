@@ -0,0 +1,79 @@
+# test_pyCBUS.py
+# Tests on python-can virtual buses, no CBUS hardware needed
+#
+#   python3 -m pytest test_pyCBUS.py      (or python3 -m unittest test_pyCBUS)
+
+import asyncio
+import random
+import unittest
+import can
+import pyCBUS
+from pyCBUS_async import AsyncCBUSClient
+from pyCBUS_bootloader import PROGRAM_START, SimulatedBootloader, parseIntelHex, updateNodes
+
+# Return the Intel HEX lines of a memory image (address -> byte value), with 16 bytes data records
+def intelHexLines (memory):
+    lines = []
+    base = None
+    for address in sorted (set (address & ~15 for address in memory)):
+        if address >> 16 != base:
+            base = address >> 16
+            record = bytes ([2, 0, 0, 4, base >> 8, base & 0xFF])
+            lines.append (':' + (record + bytes ([(-sum (record)) & 0xFF])).hex().upper())
+        record = bytes ([16, (address >> 8) & 0xFF, address & 0xFF, 0]) + \
+                 bytes (memory.get (address + offset, 0xFF) for offset in range (16))
+        lines.append (':' + (record + bytes ([(-sum (record)) & 0xFF])).hex().upper())
+    lines.append (':00000001FF')
+    return lines
+
+class BootloaderTest (unittest.TestCase):
+    # 3 nodes on 2 segments, the second node of the first segment does not acknowledge data frame 50 once
+    def testUpdateNodes (self):
+        generator = random.Random (1)
+        memory = {address: generator.randrange (256) for address in range (PROGRAM_START, PROGRAM_START + 0x400)}
+        image = parseIntelHex (intelHexLines (memory))
+        segments = []
+        nodes = []
+        try:
+            for channel, node_numbers in (('test_boot_1', (101, 102)), ('test_boot_2', (201,))):
+                interface = pyCBUS.CBUSInterface (bus = can.Bus (interface = 'virtual', channel = channel))
+                interface.startReceiver()
+                segments.append (interface)
+                for node_number in node_numbers:
+                    drop = None
+                    if node_number == 102:
+                        drop = {50}
+                    nodes.append (SimulatedBootloader (can.Bus (interface = 'virtual', channel = channel), node_number, drop))
+            jobs = [(segments[0], 101, image), (segments[0], 102, image), (segments[1], 201, image)]
+            results = updateNodes (jobs, window = 4, max_load = 0.5, timeout = 0.2)
+            self.assertEqual ({node_number: error for (interface, node_number), error in results.items()}, \
+                              {101: None, 102: None, 201: None})
+            for node in nodes:
+                self.assertEqual (node.memory, memory)
+        finally:
+            for node in nodes:
+                node.close()
+                node.bus.shutdown()
+            for interface in segments:
+                interface.shutdown()
+
+class AsyncClientTest (unittest.TestCase):
+    def testReadNodeVariable (self):
+        node = can.Bus (interface = 'virtual', channel = 'test_async')
+        def onMessage (msg):
+            if msg.dlc == 4 and msg.data[0] == pyCBUS.OPC_NVRD:
+                node.send (can.Message (arbitration_id = 5, is_extended_id = False, \
+                                        data = [pyCBUS.OPC_NVANS, msg.data[1], msg.data[2], msg.data[3], msg.data[3] * 2]))
+        notifier = can.Notifier (node, [onMessage])
+        async def readVariables ():
+            async with AsyncCBUSClient (bus = can.Bus (interface = 'virtual', channel = 'test_async')) as client:
+                return await asyncio.gather (*[client.readNodeVariable (1234, variable) for variable in range (1, 11)])
+        try:
+            answers = asyncio.run (readVariables())
+        finally:
+            notifier.stop()
+            node.shutdown()
+        self.assertEqual (answers, [variable * 2 for variable in range (1, 11)])
+
+if __name__ == '__main__':
+    unittest.main()